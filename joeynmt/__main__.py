@@ -3,13 +3,18 @@ import argparse
 from joeynmt.training import train
 from joeynmt.prediction import test
 from joeynmt.prediction import translate
+from joeynmt.data import preprocess
+from joeynmt.server import serve
 
 
 def main():
     ap = argparse.ArgumentParser("Joey NMT")
 
-    ap.add_argument("mode", choices=["train", "test", "translate"],
-                    help="train a model or test or translate")
+    ap.add_argument("mode",
+                    choices=["preprocess", "train", "test", "translate",
+                             "serve"],
+                    help="pre-process the training data, train a model "
+                         "or test or translate or serve translations")
 
     ap.add_argument("config_path", type=str,
                     help="path to YAML config file")
@@ -25,7 +30,9 @@ def main():
 
     args = ap.parse_args()
 
-    if args.mode == "train":
+    if args.mode == "preprocess":
+        preprocess(cfg_file=args.config_path)
+    elif args.mode == "train":
         train(cfg_file=args.config_path)
     elif args.mode == "test":
         test(cfg_file=args.config_path, ckpt=args.ckpt,
@@ -33,6 +40,8 @@ def main():
     elif args.mode == "translate":
         translate(cfg_file=args.config_path, ckpt=args.ckpt,
                   output_path=args.output_path)
+    elif args.mode == "serve":
+        serve(cfg_file=args.config_path, ckpt=args.ckpt)
     else:
         raise ValueError("Unknown mode")
 
@@ -10,7 +10,8 @@ class Batch:
     Input is a batch from a torch text iterator.
     """
 
-    def __init__(self, torch_batch, pad_index, use_cuda=False):
+    def __init__(self, torch_batch, pad_index, use_cuda=False,
+                 pin_memory=False):
         """
         Create a new joey batch from a torch batch.
         This batch extends torch text's batch attributes with src and trg
@@ -20,6 +21,8 @@ class Batch:
         :param torch_batch:
         :param pad_index:
         :param use_cuda:
+        :param pin_memory: copy the tensors to page-locked memory before
+            moving them to GPU, so that the copy can run asynchronously
         """
         self.src, self.src_lengths = torch_batch.src
         self.src_mask = (self.src != pad_index).unsqueeze(1)
@@ -43,21 +46,37 @@ class Batch:
             self.ntokens = (self.trg != pad_index).data.sum().item()
 
         if use_cuda:
+            if pin_memory:
+                self._pin_memory()
             self._make_cuda()
 
+    def _pin_memory(self):
+        """
+        Copy the batch to page-locked memory
+
+        :return:
+        """
+        self.src = self.src.pin_memory()
+        self.src_mask = self.src_mask.pin_memory()
+
+        if self.trg_input is not None:
+            self.trg_input = self.trg_input.pin_memory()
+            self.trg = self.trg.pin_memory()
+            self.trg_mask = self.trg_mask.pin_memory()
+
     def _make_cuda(self):
         """
         Move the batch to GPU
 
         :return:
         """
-        self.src = self.src.cuda()
-        self.src_mask = self.src_mask.cuda()
+        self.src = self.src.cuda(non_blocking=True)
+        self.src_mask = self.src_mask.cuda(non_blocking=True)
 
         if self.trg_input is not None:
-            self.trg_input = self.trg_input.cuda()
-            self.trg = self.trg.cuda()
-            self.trg_mask = self.trg_mask.cuda()
+            self.trg_input = self.trg_input.cuda(non_blocking=True)
+            self.trg = self.trg.cuda(non_blocking=True)
+            self.trg_mask = self.trg_mask.cuda(non_blocking=True)
 
     def sort_by_src_lengths(self):
         """
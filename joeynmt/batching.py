@@ -0,0 +1,411 @@
+# coding: utf-8
+"""
+Batching module: plans which examples go into which batch
+"""
+import random
+from typing import List, Iterable, Tuple
+
+import numpy as np
+import torch
+from torchtext import data
+from torchtext.data import Dataset
+
+from joeynmt.constants import EOS_TOKEN, BOS_TOKEN, PAD_TOKEN
+from joeynmt.vocabulary import Vocabulary
+
+
+def split_into_batches(src_lengths: np.array, trg_lengths: np.array,
+                        batch_size: int, batch_type: str = "sentence") \
+        -> List[np.array]:
+    """
+    Split consecutive examples into batches.
+    For token batches, the batch size is computed as in `token_batch_size_fn`.
+
+    :param src_lengths: source lengths of the examples (without EOS)
+    :param trg_lengths: target lengths of the examples (without BOS/EOS)
+    :param batch_size: size of the batches
+    :param batch_type: measure batch size by sentence count or by token count
+    :return: list of arrays with the positions of the batch examples
+    """
+    positions = np.arange(len(src_lengths))
+    if batch_type != "token":
+        return [positions[i:i + batch_size]
+                for i in range(0, len(positions), batch_size)]
+    # padded size of the longer side of each example
+    costs = np.maximum(src_lengths, trg_lengths + 2)
+    batches = []
+    start = 0
+    while start < len(positions):
+        # a batch of n examples costs n * (maximum cost among them), it holds
+        # at most batch_size // costs[start] examples (or one if larger)
+        window = costs[start:start + batch_size // costs[start] + 2]
+        sizes = np.maximum.accumulate(window) * np.arange(1, len(window) + 1)
+        # the first example that doesn't fit anymore starts the next batch
+        too_large = np.flatnonzero(sizes[1:] > batch_size)
+        end = start + (too_large[0] + 1 if len(too_large) else len(window))
+        batches.append(positions[start:end])
+        start = end
+    return batches
+
+
+def _plan_batches(src_lengths: np.array, trg_lengths: np.array,
+                  batch_size: int, batch_type: str = "sentence",
+                  shuffle: bool = False, bucket_batches: int = 100) \
+        -> List[np.array]:
+    """
+    Plan the training batches of one epoch from the lengths of the examples.
+
+    The (shuffled) examples are split into buckets of roughly
+    `bucket_batches` batches, which are sorted by source and target length,
+    so that examples of similar length end up in the same batch.
+    Token batches are packed up to the batch size including padding.
+    The order of all batches is shuffled afterwards.
+
+    :param src_lengths: source lengths of all examples (without EOS)
+    :param trg_lengths: target lengths of all examples (without BOS/EOS)
+    :param batch_size: size of the batches
+    :param batch_type: measure batch size by sentence count or by token count
+    :param shuffle: whether to shuffle the examples and batches
+    :param bucket_batches: size of the buckets that are sorted, in batches
+    :return: list of arrays with the indices of the batch examples
+    """
+    n_examples = len(src_lengths)
+    if n_examples == 0:
+        return []
+    if batch_type == "token":
+        costs = np.maximum(src_lengths, trg_lengths + 2)
+        bucket_size = int(bucket_batches * batch_size / costs.mean())
+    else:
+        bucket_size = bucket_batches * batch_size
+    bucket_size = max(bucket_size, 1)
+
+    indices = np.random.permutation(n_examples) if shuffle \
+        else np.arange(n_examples)
+    batches = []
+    for start in range(0, n_examples, bucket_size):
+        bucket = indices[start:start + bucket_size]
+        # sort by source length, then by target length
+        bucket = bucket[np.lexsort((trg_lengths[bucket], src_lengths[bucket]))]
+        batches.extend(bucket[positions] for positions in split_into_batches(
+            src_lengths[bucket], trg_lengths[bucket], batch_size, batch_type))
+    if shuffle:
+        random.shuffle(batches)
+    return batches
+
+
+def _padding_ratio(batches: List[np.array], src_lengths: np.array,
+                   trg_lengths: np.array) -> float:
+    """
+    Compute the fraction of padding in the source and target tensors
+    of the given batches (including EOS on the source side and BOS and EOS
+    on the target side).
+
+    :param batches: list of arrays with the indices of the batch examples
+    :param src_lengths: source lengths of all examples (without EOS)
+    :param trg_lengths: target lengths of all examples (without BOS/EOS)
+    :return: number of padding positions divided by the number of positions
+    """
+    if not batches:
+        return 0.
+    indices = np.concatenate(batches)
+    sizes = np.array([len(batch) for batch in batches])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    src = src_lengths[indices] + 1
+    trg = trg_lengths[indices] + 2
+    positions = np.sum(sizes * np.maximum.reduceat(src, starts)) \
+        + np.sum(sizes * np.maximum.reduceat(trg, starts))
+    return float(1 - (src.sum() + trg.sum()) / positions)
+
+
+def _pad_ids(sequences: List[np.array], vocab: Vocabulary,
+             add_bos: bool) -> (torch.Tensor, torch.Tensor):
+    """
+    Add special symbols to the given id sequences and pad them,
+    like the torchtext fields in `load_data`.
+
+    :param sequences: token ids of each example
+    :param vocab: vocabulary with special symbols
+    :param add_bos: whether to prepend BOS
+    :return: padded ids (batch_size x max_length), lengths
+    """
+    start = 1 if add_bos else 0
+    lengths = np.asarray([len(seq) for seq in sequences],
+                         dtype=np.int64) + start + 1
+    padded = np.full((len(sequences), lengths.max()),
+                     vocab.stoi[PAD_TOKEN], dtype=np.int64)
+    if add_bos:
+        padded[:, 0] = vocab.stoi[BOS_TOKEN]
+    for i, seq in enumerate(sequences):
+        padded[i, start:start + len(seq)] = seq
+        padded[i, start + len(seq)] = vocab.stoi[EOS_TOKEN]
+    return torch.from_numpy(padded), torch.from_numpy(lengths)
+
+
+def create_batch(src_ids: List[np.array], trg_ids: List[np.array],
+                  src_vocab: Vocabulary, trg_vocab: Vocabulary,
+                  sort_within_batch: bool = False) -> data.Batch:
+    """
+    Create a batch with the same attributes as a torchtext batch:
+    `src` and `trg` are tuples of padded ids and lengths.
+
+    :param src_ids: source token ids of each example
+    :param trg_ids: target token ids of each example
+    :param src_vocab: source vocabulary
+    :param trg_vocab: target vocabulary
+    :param sort_within_batch: sort by descending source length
+        (for packing RNN inputs)
+    :return: batch with `src` and `trg` attributes
+    """
+    if sort_within_batch:
+        order = np.argsort([-len(ids) for ids in src_ids], kind="stable")
+        src_ids = [src_ids[i] for i in order]
+        trg_ids = [trg_ids[i] for i in order]
+    batch = data.Batch()
+    batch.batch_size = len(src_ids)
+    batch.src = _pad_ids(src_ids, src_vocab, add_bos=False)
+    batch.trg = _pad_ids(trg_ids, trg_vocab, add_bos=True)
+    return batch
+
+
+def make_src_batches(sentences: List[List[str]], src_vocab: Vocabulary,
+                     batch_size: int, batch_type: str = "sentence") \
+        -> Iterable[Tuple[np.array, data.Batch]]:
+    """
+    Create batches of tokenized source sentences in memory, without a
+    dataset. Sentences are batched in order of descending length, so that
+    there is little padding.
+
+    :param sentences: tokens of each source sentence
+    :param src_vocab: source vocabulary
+    :param batch_size: size of the batches
+    :param batch_type: measure batch size by sentence count or by token count
+    :return: generator of the positions of the batch sentences in
+        `sentences` and batches with a `src` attribute like torchtext batches
+    """
+    src_lengths = np.array([len(tokens) for tokens in sentences],
+                           dtype=np.int64)
+    order = np.argsort(-src_lengths, kind="stable")
+    for positions in split_into_batches(
+            src_lengths[order], np.zeros_like(src_lengths), batch_size,
+            batch_type):
+        indices = order[positions]
+        batch = data.Batch()
+        batch.batch_size = len(indices)
+        batch.src = _pad_ids(
+            [np.array([src_vocab.stoi[t] for t in sentences[i]],
+                      dtype=np.int64) for i in indices],
+            src_vocab, add_bos=False)
+        yield indices, batch
+
+
+class BucketBatchIterator:
+    """
+    Iterator over training batches of a torchtext dataset.
+
+    The lengths of all examples are indexed once, and the batches of every
+    epoch are planned from this index (see `_plan_batches`): examples are
+    sorted by length within large buckets, token batches are packed up to
+    the batch size including padding, and the order of batches is shuffled.
+    The fraction of padding of the last planned epoch is kept in
+    `padding_ratio`.
+    """
+
+    def __init__(self, dataset: Dataset, batch_size: int,
+                 batch_type: str = "sentence", shuffle: bool = False) -> None:
+        """
+        Create an iterator over the training batches of a dataset.
+
+        :param dataset: torchtext dataset containing src and optionally trg
+        :param batch_size: size of the batches the iterator prepares
+        :param batch_type: measure batch size by sentence count or by token
+            count
+        :param shuffle: whether to shuffle the data before each epoch
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+        self.shuffle = shuffle
+        n_examples = len(dataset.examples)
+        self.src_lengths = np.fromiter(
+            (len(ex.src) for ex in dataset.examples), dtype=np.int64,
+            count=n_examples)
+        self.trg_lengths = np.fromiter(
+            (len(getattr(ex, "trg", ())) for ex in dataset.examples),
+            dtype=np.int64, count=n_examples)
+        self._batches = None
+        self.padding_ratio = None
+
+    def _plan_epoch(self) -> List[np.array]:
+        """
+        Decide which examples go into which batch for one epoch.
+
+        :return: list of arrays with the indices of the batch examples
+        """
+        batches = _plan_batches(self.src_lengths, self.trg_lengths,
+                                batch_size=self.batch_size,
+                                batch_type=self.batch_type,
+                                shuffle=self.shuffle)
+        self.padding_ratio = _padding_ratio(batches, self.src_lengths,
+                                            self.trg_lengths)
+        return batches
+
+    def __len__(self) -> int:
+        # plan the next epoch, it is used by the next iteration
+        if self._batches is None:
+            self._batches = self._plan_epoch()
+        return len(self._batches)
+
+    def _next_epoch(self) -> List[np.array]:
+        """
+        Take the plan of the next epoch, which `__len__` may have made
+        already. Every plan is used for a single epoch, so that the number
+        of batches reported before an epoch is the number of its batches.
+
+        :return: list of arrays with the indices of the batch examples
+        """
+        batches = self._batches if self._batches is not None \
+            else self._plan_epoch()
+        self._batches = None
+        return batches
+
+    def __iter__(self):
+        for batch_indices in self._next_epoch():
+            # sort by descending source length (for packing RNN inputs)
+            batch_indices = batch_indices[np.argsort(
+                -self.src_lengths[batch_indices], kind="stable")]
+            yield data.Batch([self.dataset.examples[i] for i in batch_indices],
+                             self.dataset)
+
+
+class LengthSortedIterator:
+    """
+    Iterator over evaluation batches of a torchtext dataset.
+
+    The whole dataset is sorted by descending source length and split into
+    batches of consecutive examples, so that every batch contains examples
+    of similar length: this minimizes padding and decoding steps that are
+    wasted on finished hypotheses.
+    `order` holds the dataset indices of the examples in iteration order,
+    to restore the original order of the outputs.
+    """
+
+    def __init__(self, dataset: Dataset, batch_size: int,
+                 batch_type: str = "sentence") -> None:
+        """
+        Create an iterator over length-sorted batches of a dataset.
+
+        :param dataset: torchtext dataset containing src and optionally trg
+        :param batch_size: size of the batches the iterator prepares
+        :param batch_type: measure batch size by sentence count or by token
+            count
+        """
+        self.dataset = dataset
+        src_lengths = np.array([len(ex.src) for ex in dataset.examples],
+                               dtype=np.int64)
+        trg_lengths = np.array([len(getattr(ex, "trg", ()))
+                                for ex in dataset.examples], dtype=np.int64)
+        self.order = np.argsort(-src_lengths, kind="stable")
+        self._batches = [self.order[positions] for positions in
+                         split_into_batches(src_lengths[self.order],
+                                             trg_lengths[self.order],
+                                             batch_size, batch_type)]
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def __iter__(self):
+        for batch_indices in self._batches:
+            yield data.Batch([self.dataset.examples[i] for i in batch_indices],
+                             self.dataset)
+
+
+class BinarizedIterator:
+    """
+    Iterator over batches of a `BinarizedDataset`.
+
+    Like the `BucketBatchIterator` used for text datasets, training
+    batches are planned from the lengths of the examples with as little
+    padding as possible, and the order of examples and batches is shuffled.
+    """
+
+    def __init__(self, dataset, batch_size: int,
+                 batch_type: str = "sentence", train: bool = False,
+                 shuffle: bool = False) -> None:
+        """
+        Create an iterator over a binarized dataset.
+
+        :param dataset: binarized dataset (see `joeynmt.data`)
+        :param batch_size: size of the batches the iterator prepares
+        :param batch_type: measure batch size by sentence count or by token
+            count
+        :param train: whether it's training time, when turned off,
+            bucketing, sorting within batches and shuffling is disabled
+        :param shuffle: whether to shuffle the data before each epoch
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+        self.train = train
+        self.shuffle = shuffle and train
+        self._batches = None
+        # fraction of padding in the batches of the last planned epoch
+        self.padding_ratio = None
+
+    def _make_batches(self, indices: np.array) -> List[np.array]:
+        """
+        Split the given examples into consecutive batches.
+
+        :param indices: indices of the examples in the dataset
+        :return: list of arrays with the indices of the batch examples
+        """
+        positions = split_into_batches(
+            src_lengths=self.dataset.src_lengths[indices],
+            trg_lengths=self.dataset.trg_lengths[indices],
+            batch_size=self.batch_size, batch_type=self.batch_type)
+        return [indices[batch_positions] for batch_positions in positions]
+
+    def _plan_epoch(self) -> List[np.array]:
+        """
+        Decide which examples go into which batch for one epoch.
+
+        :return: list of arrays with the indices of the batch examples
+        """
+        indices = self.dataset.indices
+        if not self.train:
+            return self._make_batches(indices)
+
+        src_lengths = self.dataset.src_lengths[indices]
+        trg_lengths = self.dataset.trg_lengths[indices]
+        batches = _plan_batches(src_lengths, trg_lengths,
+                                batch_size=self.batch_size,
+                                batch_type=self.batch_type,
+                                shuffle=self.shuffle)
+        self.padding_ratio = _padding_ratio(batches, src_lengths, trg_lengths)
+        return [indices[batch] for batch in batches]
+
+    def __len__(self) -> int:
+        # plan the next epoch, it is used by the next iteration
+        if self._batches is None:
+            self._batches = self._plan_epoch()
+        return len(self._batches)
+
+    def _next_epoch(self) -> List[np.array]:
+        """
+        Take the plan of the next epoch (see
+        `BucketBatchIterator._next_epoch`).
+
+        :return: list of arrays with the indices of the batch examples
+        """
+        batches = self._batches if self._batches is not None \
+            else self._plan_epoch()
+        self._batches = None
+        return batches
+
+    def __iter__(self):
+        for batch_indices in self._next_epoch():
+            src_ids, trg_ids = zip(*[self.dataset.get_ids(index)
+                                     for index in batch_indices])
+            yield create_batch(src_ids=list(src_ids), trg_ids=list(trg_ids),
+                               src_vocab=self.dataset.src_vocab,
+                               trg_vocab=self.dataset.trg_vocab,
+                               sort_within_batch=self.train)
@@ -6,14 +6,22 @@ import sys
 import random
 import os
 import os.path
-from typing import Optional
+from collections import Counter
+from typing import Optional, List, Callable, Iterable, Tuple
 
+import numpy as np
 from torchtext.datasets import TranslationDataset
 from torchtext import data
 from torchtext.data import Dataset, Iterator, Field
 
-from joeynmt.constants import UNK_TOKEN, EOS_TOKEN, BOS_TOKEN, PAD_TOKEN
-from joeynmt.vocabulary import build_vocab, Vocabulary
+from joeynmt.batching import BucketBatchIterator, BinarizedIterator
+from joeynmt.constants import UNK_TOKEN, EOS_TOKEN, BOS_TOKEN, PAD_TOKEN, \
+    DEFAULT_UNK_ID
+from joeynmt.helpers import load_config, make_logger, ConfigurationError
+from joeynmt.streaming import StreamingDataset, StreamingIterator, \
+    read_parallel
+from joeynmt.vocabulary import build_vocab, build_vocab_from_counter, \
+    Vocabulary
 
 
 def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
@@ -30,6 +38,17 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
     If you set ``random_train_subset``, a random selection of this size is used
     from the training set instead of the full training set.
 
+    If you set ``binarized`` to a directory written by
+    ``python -m joeynmt preprocess``, the training data is memory-mapped
+    from there instead of being read from text, and the vocabularies are
+    loaded from that directory.
+
+    If you set ``streaming``, the training data is read lazily from text
+    during training, so that it does not have to fit in memory. Then ``train``
+    may contain wildcards to read from several shards (e.g. "data/train.*"),
+    and examples are shuffled within a buffer of ``streaming_buffer_size``
+    examples.
+
     :param data_cfg: configuration dictionary for data
         ("data" part of configuation file)
     :return:
@@ -43,58 +62,102 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
     src_lang = data_cfg["src"]
     trg_lang = data_cfg["trg"]
     train_path = data_cfg["train"]
-    dev_path = data_cfg["dev"]
-    test_path = data_cfg.get("test", None)
     level = data_cfg["level"]
     lowercase = data_cfg["lowercase"]
     max_sent_length = data_cfg["max_sent_length"]
 
-    tok_fun = lambda s: list(s) if level == "char" else s.split()
-
-    src_field = data.Field(init_token=None, eos_token=EOS_TOKEN,
-                           pad_token=PAD_TOKEN, tokenize=tok_fun,
-                           batch_first=True, lower=lowercase,
-                           unk_token=UNK_TOKEN,
-                           include_lengths=True)
-
-    trg_field = data.Field(init_token=BOS_TOKEN, eos_token=EOS_TOKEN,
-                           pad_token=PAD_TOKEN, tokenize=tok_fun,
-                           unk_token=UNK_TOKEN,
-                           batch_first=True, lower=lowercase,
-                           include_lengths=True)
-
-    train_data = TranslationDataset(path=train_path,
-                                    exts=("." + src_lang, "." + trg_lang),
-                                    fields=(src_field, trg_field),
-                                    filter_pred=
-                                    lambda x: len(vars(x)['src'])
-                                    <= max_sent_length
-                                    and len(vars(x)['trg'])
-                                    <= max_sent_length)
-
-    src_max_size = data_cfg.get("src_voc_limit", sys.maxsize)
-    src_min_freq = data_cfg.get("src_voc_min_freq", 1)
-    trg_max_size = data_cfg.get("trg_voc_limit", sys.maxsize)
-    trg_min_freq = data_cfg.get("trg_voc_min_freq", 1)
-
-    src_vocab_file = data_cfg.get("src_vocab", None)
-    trg_vocab_file = data_cfg.get("trg_vocab", None)
-
-    src_vocab = build_vocab(field="src", min_freq=src_min_freq,
-                            max_size=src_max_size,
-                            dataset=train_data, vocab_file=src_vocab_file)
-    trg_vocab = build_vocab(field="trg", min_freq=trg_min_freq,
-                            max_size=trg_max_size,
-                            dataset=train_data, vocab_file=trg_vocab_file)
+    src_field, trg_field = make_fields(data_cfg)
+
+    binarized_path = data_cfg.get("binarized", None)
+    if binarized_path is not None:
+        # pre-processed training data and vocabularies
+        src_vocab = Vocabulary(
+            file=os.path.join(binarized_path, "src_vocab.txt"))
+        trg_vocab = Vocabulary(
+            file=os.path.join(binarized_path, "trg_vocab.txt"))
+        train_data = BinarizedDataset(
+            path=os.path.join(binarized_path, "train"),
+            exts=("." + src_lang, "." + trg_lang),
+            vocabs=(src_vocab, trg_vocab), max_sent_length=max_sent_length)
+    elif data_cfg.get("streaming", False):
+        # read training data lazily, vocabularies are built in one pass
+        train_data = StreamingDataset(
+            path=train_path, exts=("." + src_lang, "." + trg_lang),
+            tok_fun=make_tokenizer(level, lowercase),
+            max_sent_length=max_sent_length,
+            buffer_size=data_cfg.get("streaming_buffer_size", 100000))
+        src_vocab, trg_vocab, train_data.num_examples = \
+            _build_vocabs_from_stream(data_cfg, train_data.token_pairs)
+        train_data.src_vocab = src_vocab
+        train_data.trg_vocab = trg_vocab
+    else:
+        train_data = TranslationDataset(path=train_path,
+                                        exts=("." + src_lang, "." + trg_lang),
+                                        fields=(src_field, trg_field),
+                                        filter_pred=
+                                        lambda x: len(vars(x)['src'])
+                                        <= max_sent_length
+                                        and len(vars(x)['trg'])
+                                        <= max_sent_length)
+
+        src_max_size = data_cfg.get("src_voc_limit", sys.maxsize)
+        src_min_freq = data_cfg.get("src_voc_min_freq", 1)
+        trg_max_size = data_cfg.get("trg_voc_limit", sys.maxsize)
+        trg_min_freq = data_cfg.get("trg_voc_min_freq", 1)
+
+        src_vocab_file = data_cfg.get("src_vocab", None)
+        trg_vocab_file = data_cfg.get("trg_vocab", None)
+
+        src_vocab = build_vocab(field="src", min_freq=src_min_freq,
+                                max_size=src_max_size,
+                                dataset=train_data, vocab_file=src_vocab_file)
+        trg_vocab = build_vocab(field="trg", min_freq=trg_min_freq,
+                                max_size=trg_max_size,
+                                dataset=train_data, vocab_file=trg_vocab_file)
 
     random_train_subset = data_cfg.get("random_train_subset", -1)
     if random_train_subset > -1:
         # select this many training examples randomly and discard the rest
-        keep_ratio = random_train_subset / len(train_data)
-        keep, _ = train_data.split(
-            split_ratio=[keep_ratio, 1 - keep_ratio],
-            random_state=random.getstate())
-        train_data = keep
+        if isinstance(train_data, BinarizedDataset):
+            train_data = train_data.random_subset(random_train_subset)
+        elif isinstance(train_data, StreamingDataset):
+            raise ConfigurationError("random_train_subset can't be used "
+                                     "with streaming training data.")
+        else:
+            keep_ratio = random_train_subset / len(train_data)
+            keep, _ = train_data.split(
+                split_ratio=[keep_ratio, 1 - keep_ratio],
+                random_state=random.getstate())
+            train_data = keep
+
+    src_field.vocab = src_vocab
+    trg_field.vocab = trg_vocab
+    dev_data, test_data = load_eval_data(data_cfg, src_vocab, trg_vocab)
+    return train_data, dev_data, test_data, src_vocab, trg_vocab
+
+
+def load_eval_data(data_cfg: dict, src_vocab: Vocabulary,
+                   trg_vocab: Vocabulary) -> (Dataset, Optional[Dataset]):
+    """
+    Load dev and optionally test data as specified in configuration,
+    without reading the training data.
+
+    :param data_cfg: configuration dictionary for data
+        ("data" part of configuation file)
+    :param src_vocab: source vocabulary
+    :param trg_vocab: target vocabulary
+    :return:
+        - dev_data: development dataset
+        - test_data: testdata set if given, otherwise None
+    """
+    src_lang = data_cfg["src"]
+    trg_lang = data_cfg["trg"]
+    dev_path = data_cfg["dev"]
+    test_path = data_cfg.get("test", None)
+
+    src_field, trg_field = make_fields(data_cfg)
+    src_field.vocab = src_vocab
+    trg_field.vocab = trg_vocab
 
     dev_data = TranslationDataset(path=dev_path,
                                   exts=("." + src_lang, "." + trg_lang),
@@ -110,9 +173,35 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
             # no target is given -> create dataset from src only
             test_data = MonoDataset(path=test_path, ext="." + src_lang,
                                     field=src_field)
-    src_field.vocab = src_vocab
-    trg_field.vocab = trg_vocab
-    return train_data, dev_data, test_data, src_vocab, trg_vocab
+    return dev_data, test_data
+
+
+def make_fields(data_cfg: dict) -> (Field, Field):
+    """
+    Create the torchtext fields for source and target data,
+    with tokenization and lowercasing as specified in configuration.
+
+    :param data_cfg: configuration dictionary for data
+        ("data" part of configuation file)
+    :return: source field, target field
+    """
+    level = data_cfg["level"]
+    lowercase = data_cfg["lowercase"]
+
+    tok_fun = lambda s: list(s) if level == "char" else s.split()
+
+    src_field = data.Field(init_token=None, eos_token=EOS_TOKEN,
+                           pad_token=PAD_TOKEN, tokenize=tok_fun,
+                           batch_first=True, lower=lowercase,
+                           unk_token=UNK_TOKEN,
+                           include_lengths=True)
+
+    trg_field = data.Field(init_token=BOS_TOKEN, eos_token=EOS_TOKEN,
+                           pad_token=PAD_TOKEN, tokenize=tok_fun,
+                           unk_token=UNK_TOKEN,
+                           batch_first=True, lower=lowercase,
+                           include_lengths=True)
+    return src_field, trg_field
 
 
 # pylint: disable=global-at-module-level
@@ -153,24 +242,27 @@ def make_data_iter(dataset: Dataset,
         (no effect if set to True for testing)
     :return: torchtext iterator
     """
-
-    batch_size_fn = token_batch_size_fn if batch_type == "token" else None
+    if isinstance(dataset, BinarizedDataset):
+        return BinarizedIterator(dataset=dataset, batch_size=batch_size,
+                                 batch_type=batch_type, train=train,
+                                 shuffle=shuffle)
+    if isinstance(dataset, StreamingDataset):
+        return StreamingIterator(dataset=dataset, batch_size=batch_size,
+                                 batch_type=batch_type, train=train,
+                                 shuffle=shuffle)
 
     if train:
-        # optionally shuffle and sort during training
-        data_iter = data.BucketIterator(
-            repeat=False, sort=False, dataset=dataset,
-            batch_size=batch_size, batch_size_fn=batch_size_fn,
-            train=True, sort_within_batch=True,
-            sort_key=lambda x: len(x.src), shuffle=shuffle)
-    else:
-        # don't sort/shuffle for validation/inference
-        data_iter = data.BucketIterator(
-            repeat=False, dataset=dataset,
-            batch_size=batch_size, batch_size_fn=batch_size_fn,
-            train=False, sort=False)
+        # batches are planned from the example lengths to minimize padding,
+        # optionally shuffled
+        return BucketBatchIterator(dataset=dataset, batch_size=batch_size,
+                                   batch_type=batch_type, shuffle=shuffle)
 
-    return data_iter
+    # don't sort/shuffle for validation/inference
+    batch_size_fn = token_batch_size_fn if batch_type == "token" else None
+    return data.BucketIterator(
+        repeat=False, dataset=dataset,
+        batch_size=batch_size, batch_size_fn=batch_size_fn,
+        train=False, sort=False)
 
 
 class MonoDataset(Dataset):
@@ -208,3 +300,233 @@ class MonoDataset(Dataset):
         src_file.close()
 
         super(MonoDataset, self).__init__(examples, fields, **kwargs)
+
+
+def make_tokenizer(level: str, lowercase: bool) -> Callable[[str], List[str]]:
+    """
+    Tokenization as done by the torchtext fields in `load_data`.
+
+    :param level: segmentation level, one of "char", "bpe", "word"
+    :param lowercase: lowercase the tokens
+    :return: function that splits a line into tokens
+    """
+    def tok_fun(s: str) -> List[str]:
+        tokens = list(s) if level == "char" else s.split()
+        return [t.lower() for t in tokens] if lowercase else tokens
+    return tok_fun
+
+
+def _build_vocabs_from_stream(
+        data_cfg: dict,
+        token_pairs: Callable[[], Iterable[Tuple[List[str], List[str]]]]) \
+        -> (Vocabulary, Vocabulary, Optional[int]):
+    """
+    Build source and target vocabulary like `load_data`, but by counting
+    tokens while streaming over the training data.
+    Vocabularies given as `src_vocab`/`trg_vocab` are loaded instead.
+
+    :param data_cfg: configuration dictionary for data
+    :param token_pairs: function that returns a generator over the
+        (filtered) source and target tokens of the training data
+    :return: source vocabulary, target vocabulary, number of examples
+        (None if both vocabularies are loaded and the data isn't read)
+    """
+    vocabs = {}
+    n_examples = None
+    for side in ["src", "trg"]:
+        vocab_file = data_cfg.get("{}_vocab".format(side), None)
+        if vocab_file is not None:
+            vocabs[side] = Vocabulary(file=vocab_file)
+    if len(vocabs) < 2:
+        counters = {"src": Counter(), "trg": Counter()}
+        n_examples = 0
+        for src_tokens, trg_tokens in token_pairs():
+            counters["src"].update(src_tokens)
+            counters["trg"].update(trg_tokens)
+            n_examples += 1
+        for side in ["src", "trg"]:
+            if side not in vocabs:
+                vocabs[side] = build_vocab_from_counter(
+                    counter=counters[side],
+                    max_size=data_cfg.get(
+                        "{}_voc_limit".format(side), sys.maxsize),
+                    min_freq=data_cfg.get("{}_voc_min_freq".format(side), 1))
+    return vocabs["src"], vocabs["trg"], n_examples
+
+
+def _binarized_dtype(vocab: Vocabulary) -> np.dtype:
+    """
+    Smallest integer type that holds all token ids of the vocabulary.
+
+    :param vocab: vocabulary
+    :return: numpy dtype for the token ids
+    """
+    if len(vocab) <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+
+def preprocess(cfg_file: str) -> None:
+    """
+    Pre-process the training data for fast loading during training.
+
+    Builds the vocabularies from the training data (or loads them from
+    `src_vocab`/`trg_vocab`), and stores them together with the training data
+    as token ids in the directory given as `binarized` in the data
+    configuration. For each language, the ids of all sentences are
+    concatenated in a flat ``train.<lang>.bin`` file, and the offset and
+    length of every sentence are stored in ``train.<lang>.idx``.
+    Lines are read one by one, so the corpus never has to fit in memory.
+
+    Filtering by `max_sent_length` and `random_train_subset` are applied when
+    loading the data, so they can be changed without pre-processing again.
+
+    :param cfg_file: path to configuration file
+    """
+    cfg = load_config(cfg_file)
+    data_cfg = cfg["data"]
+    logger = make_logger()
+
+    binarized_path = data_cfg.get("binarized", None)
+    if binarized_path is None:
+        raise ValueError("Output directory 'binarized' must be specified in "
+                         "the data configuration.")
+    os.makedirs(binarized_path, exist_ok=True)
+
+    src_lang = data_cfg["src"]
+    trg_lang = data_cfg["trg"]
+    exts = ("." + src_lang, "." + trg_lang)
+    train_path = data_cfg["train"]
+    max_sent_length = data_cfg["max_sent_length"]
+    tok_fun = make_tokenizer(data_cfg["level"], data_cfg["lowercase"])
+
+    # build vocabularies like `load_data`, from the filtered training data
+    src_vocab, trg_vocab, _ = _build_vocabs_from_stream(
+        data_cfg, lambda: (
+            (src, trg) for src, trg in read_parallel(train_path, exts, tok_fun)
+            if len(src) <= max_sent_length and len(trg) <= max_sent_length))
+    src_vocab.to_file(os.path.join(binarized_path, "src_vocab.txt"))
+    trg_vocab.to_file(os.path.join(binarized_path, "trg_vocab.txt"))
+
+    # write token ids and index
+    prefix = os.path.join(binarized_path, "train")
+    vocabs = (src_vocab, trg_vocab)
+    lengths = ([], [])
+    bin_files = [open(prefix + ext + ".bin", "wb") for ext in exts]
+    try:
+        for pair in read_parallel(train_path, exts, tok_fun):
+            for side, tokens in enumerate(pair):
+                vocab = vocabs[side]
+                ids = [vocab.stoi.get(t, DEFAULT_UNK_ID()) for t in tokens]
+                np.asarray(ids, dtype=_binarized_dtype(vocab)).tofile(
+                    bin_files[side])
+                lengths[side].append(len(ids))
+    finally:
+        for bin_file in bin_files:
+            bin_file.close()
+
+    for ext, side_lengths in zip(exts, lengths):
+        side_lengths = np.asarray(side_lengths, dtype=np.int64)
+        offsets = np.zeros_like(side_lengths)
+        offsets[1:] = np.cumsum(side_lengths)[:-1]
+        with open(prefix + ext + ".idx", "wb") as idx_file:
+            np.save(idx_file, np.stack([offsets, side_lengths], axis=1))
+
+    logger.info("Pre-processed %d training examples. Data and vocabularies "
+                "saved to: %s", len(lengths[0]), binarized_path)
+
+
+class BinarizedDataset:
+    """
+    Defines a parallel dataset of token ids that are memory-mapped from
+    binary files written by `preprocess`.
+    Only the index of the examples is held in memory, so memory stays bounded
+    regardless of the size of the corpus.
+    """
+
+    def __init__(self, path: str, exts: tuple, vocabs: tuple,
+                 max_sent_length: int = None) -> None:
+        """
+        Open a binarized dataset.
+
+        :param path: Common prefix of paths to the data files.
+        :param exts: A tuple containing the extension to path for each
+            language.
+        :param vocabs: A tuple containing the source and target vocabulary
+            that were used for pre-processing.
+        :param max_sent_length: filter out longer examples (src or trg)
+        """
+        self.src_vocab, self.trg_vocab = vocabs
+        self.src_data, src_index = self._open(path + exts[0], self.src_vocab)
+        self.trg_data, trg_index = self._open(path + exts[1], self.trg_vocab)
+        assert len(src_index) == len(trg_index), \
+            "Source and target data have different numbers of examples."
+
+        self.src_offsets, self.src_lengths = src_index[:, 0], src_index[:, 1]
+        self.trg_offsets, self.trg_lengths = trg_index[:, 0], trg_index[:, 1]
+
+        # indices of the examples that are used
+        if max_sent_length is not None:
+            self.indices = np.nonzero(
+                (self.src_lengths <= max_sent_length)
+                & (self.trg_lengths <= max_sent_length))[0]
+        else:
+            self.indices = np.arange(len(src_index))
+
+    @staticmethod
+    def _open(path: str, vocab: Vocabulary) -> (np.memmap, np.array):
+        """
+        Memory-map the token ids and load the index for one language.
+
+        :param path: path to the data files (without ".bin" or ".idx")
+        :param vocab: vocabulary used for pre-processing
+        :return: token ids, index with offset and length of every example
+        """
+        index = np.load(path + ".idx")
+        if index.shape[0] > 0 and index[:, 1].sum() > 0:
+            ids = np.memmap(path + ".bin", dtype=_binarized_dtype(vocab),
+                            mode="r")
+        else:
+            # empty files can't be memory-mapped
+            ids = np.zeros(0, dtype=_binarized_dtype(vocab))
+        return ids, index
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, i: int) -> data.Example:
+        """
+        Get the i-th example with tokens (e.g. for logging).
+
+        :param i: position in the dataset
+        :return: example with `src` and `trg` tokens
+        """
+        src_ids, trg_ids = self.get_ids(self.indices[i])
+        example = data.Example()
+        example.src = [self.src_vocab.itos[t] for t in src_ids]
+        example.trg = [self.trg_vocab.itos[t] for t in trg_ids]
+        return example
+
+    def get_ids(self, index: int) -> (np.array, np.array):
+        """
+        Get the token ids of an example.
+
+        :param index: index of the example in the binarized files
+        :return: source ids, target ids
+        """
+        src_start = self.src_offsets[index]
+        trg_start = self.trg_offsets[index]
+        return self.src_data[src_start:src_start + self.src_lengths[index]], \
+            self.trg_data[trg_start:trg_start + self.trg_lengths[index]]
+
+    def random_subset(self, size: int) -> "BinarizedDataset":
+        """
+        Restrict the dataset to a random selection of examples.
+
+        :param size: number of examples to keep
+        :return: the dataset itself
+        """
+        keep = random.sample(range(len(self.indices)),
+                             min(size, len(self.indices)))
+        self.indices = self.indices[np.sort(keep)]
+        return self
@@ -3,7 +3,7 @@
 """
 Various decoders
 """
-from typing import Optional
+from typing import Optional, List
 
 import torch
 import torch.nn as nn
@@ -280,6 +280,7 @@ class RecurrentDecoder(Decoder):
                 unroll_steps: int,
                 hidden: Tensor = None,
                 prev_att_vector: Tensor = None,
+                skip_output_layer: bool = False,
                 **kwargs) \
             -> (Tensor, Tensor, Tensor, Tensor):
         """
@@ -321,6 +322,9 @@ class RecurrentDecoder(Decoder):
         :param prev_att_vector: previous attentional vector,
             if not given it's initialized with zeros,
             shape (batch_size, 1, hidden_size)
+        :param skip_output_layer: don't apply the output layer, `outputs`
+            are then the attentional vectors (e.g. for computing the loss
+            in slices, see `Model.get_loss_for_batch`)
         :return:
             - outputs: shape (batch_size, unroll_steps, vocab_size),
             - hidden: last hidden state (num_layers, batch_size, hidden_size),
@@ -376,6 +380,8 @@ class RecurrentDecoder(Decoder):
         # att_vectors: batch, unroll_steps, hidden_size
         att_probs = torch.cat(att_probs, dim=1)
         # att_probs: batch, unroll_steps, src_length
+        if skip_output_layer:
+            return att_vectors, hidden, att_probs, att_vectors
         outputs = self.output_layer(att_vectors)
         # outputs: batch, unroll_steps, vocab_size
         return outputs, hidden, att_probs, att_vectors
@@ -490,10 +496,17 @@ class TransformerDecoder(Decoder):
                 unroll_steps: int = None,
                 hidden: Tensor = None,
                 trg_mask: Tensor = None,
+                cache: List[dict] = None,
+                skip_output_layer: bool = False,
                 **kwargs):
         """
         Transformer decoder forward pass.
 
+        If a `cache` is given (see `self.init_cache`), the decoder runs
+        incrementally: `trg_embed` only contains the newest time steps,
+        and the self-attention keys and values of all previous steps are
+        taken from the cache (which is updated in place).
+
         :param trg_embed: embedded targets
         :param encoder_output: source representations
         :param encoder_hidden: unused
@@ -502,26 +515,64 @@ class TransformerDecoder(Decoder):
         :param hidden: unused
         :param trg_mask: to mask out target paddings
                          Note that a subsequent mask is applied here.
+        :param cache: per-layer caches for incremental decoding (optional)
+        :param skip_output_layer: don't apply the output layer, `output` is
+            then the final decoder states (e.g. for computing the loss
+            in slices, see `Model.get_loss_for_batch`)
         :param kwargs:
         :return:
         """
         assert trg_mask is not None, "trg_mask required for Transformer"
 
-        x = self.pe(trg_embed)  # add position encoding to word embedding
+        # number of previously decoded (and cached) steps
+        offset = 0
+        if cache is not None and "keys" in cache[0]:
+            offset = cache[0]["keys"].size(2)
+
+        # add position encoding to word embedding
+        x = self.pe(trg_embed, offset=offset)
         x = self.emb_dropout(x)
 
+        # new steps may attend to all cached steps and to themselves
+        trg_length = trg_embed.size(1)
         trg_mask = trg_mask & subsequent_mask(
-            trg_embed.size(1)).type_as(trg_mask)
+            offset + trg_length)[:, -trg_length:].type_as(trg_mask)
 
-        for layer in self.layers:
+        for i, layer in enumerate(self.layers):
             x = layer(x=x, memory=encoder_output,
-                      src_mask=src_mask, trg_mask=trg_mask)
+                      src_mask=src_mask, trg_mask=trg_mask,
+                      layer_cache=cache[i] if cache is not None else None)
 
         x = self.layer_norm(x)
+        if skip_output_layer:
+            return x, x, None, None
         output = self.output_layer(x)
 
         return output, x, None, None
 
+    def init_cache(self, encoder_output: Tensor = None) -> List[dict]:
+        """
+        Create per-layer caches for incremental decoding.
+        They hold the self-attention keys and values of all previous steps,
+        with shape (batch_size, num_heads, decoded_steps, head_size).
+        For beam search, the cached tensors are reordered along the batch
+        dimension with `index_select`.
+
+        If `encoder_output` is given, its projections for the source attention
+        of each layer are pre-computed and stored as well ("memory_keys" and
+        "memory_values"), since they don't change during decoding.
+
+        :param encoder_output: source representations (optional)
+        :return: list of dictionaries, one for each layer
+        """
+        cache = [{} for _ in self.layers]
+        if encoder_output is not None:
+            for layer, layer_cache in zip(self.layers, cache):
+                layer_cache["memory_keys"], layer_cache["memory_values"] = \
+                    layer.src_trg_att.compute_proj_keys_values(
+                        encoder_output, encoder_output)
+        return cache
+
     def __repr__(self):
         return "%s(num_layers=%r, num_heads=%r)" % (
             self.__class__.__name__, len(self.layers),
@@ -136,14 +136,20 @@ def log_data_info(train_data: Dataset, valid_data: Dataset, test_data: Dataset,
     :param trg_vocab:
     :param logging_function:
     """
+    try:
+        train_size = len(train_data)
+    except TypeError:
+        # streamed training data that wasn't counted
+        train_size = "unknown"
     logging_function(
-        "Data set sizes: \n\ttrain %d,\n\tvalid %d,\n\ttest %d",
-            len(train_data), len(valid_data),
+        "Data set sizes: \n\ttrain %s,\n\tvalid %d,\n\ttest %d",
+            train_size, len(valid_data),
             len(test_data) if test_data is not None else 0)
 
+    first_example = vars(train_data[0])
     logging_function("First training example:\n\t[SRC] %s\n\t[TRG] %s",
-        " ".join(vars(train_data[0])['src']),
-        " ".join(vars(train_data[0])['trg']))
+        " ".join(first_example['src']),
+        " ".join(first_example['trg']))
 
     logging_function("First 10 words (src): %s", " ".join(
         '(%d) %s' % (i, t) for i, t in enumerate(src_vocab.itos[:10])))
@@ -246,6 +252,25 @@ def load_checkpoint(path: str, use_cuda: bool = True) -> dict:
     return checkpoint
 
 
+def copy_to_cpu(state):
+    """
+    Copy all tensors in a (nested) state dictionary to CPU memory,
+    e.g. to write a checkpoint while training continues to update the
+    original tensors.
+
+    :param state: dictionary, list or tuple containing tensors
+    :return: copy of the state with CPU tensors
+    """
+    if isinstance(state, Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, copy_to_cpu(value))
+                           for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(copy_to_cpu(value) for value in state)
+    return copy.deepcopy(state)
+
+
 # from onmt
 def tile(x: Tensor, count: int, dim=0) -> Tensor:
     """
@@ -3,9 +3,11 @@
 Module to implement training loss
 """
 
+import math
+
 import torch
 from torch import nn, Tensor
-from torch.autograd import Variable
+import torch.nn.functional as F
 
 
 class XentLoss(nn.Module):
@@ -22,32 +24,47 @@ class XentLoss(nn.Module):
             self.criterion = nn.NLLLoss(ignore_index=self.pad_index,
                                         reduction='sum')
         else:
-            # custom label-smoothed loss, computed with KL divergence loss
-            self.criterion = nn.KLDivLoss(reduction='sum')
+            # custom label-smoothed loss, KL divergence to the smoothed
+            # targets is computed in closed form (see `_smoothed_loss`)
+            self.criterion = None
 
-    def _smooth_targets(self, targets: Tensor, vocab_size: int):
+    def _smoothed_loss(self, target_log_probs: Tensor, sum_log_probs: Tensor,
+                       pad_log_probs: Tensor, targets: Tensor,
+                       vocab_size: int) -> Tensor:
         """
-        Smooth target distribution. All non-reference words get uniform
-        probability mass according to "smoothing".
+        KL divergence between the smoothed target distributions and the
+        predicted distributions, summed over all non-pad targets. A smoothed
+        target distribution gives the target "1-smoothing" and all other
+        non-pad tokens smoothing/(vocab_size-2), padding targets get 0.
+
+        Computed in closed form from a few log probabilities per target,
+        without creating a batch*seq_len x vocab_size target tensor:
+        for each target, it's sum_j q_j log q_j - (1-smoothing) * log p(target)
+        - smoothing/(vocab_size-2) * (sum of log p over all other non-pad
+        tokens).
 
+        :param target_log_probs: log probabilities of the targets,
+            batch*seq_len
+        :param sum_log_probs: sum of log probabilities over the vocabulary,
+            batch*seq_len
+        :param pad_log_probs: log probabilities of padding, batch*seq_len
         :param targets: target indices, batch*seq_len
         :param vocab_size: size of the output vocabulary
-        :return: smoothed target distributions, batch*seq_len x vocab_size
+        :return: summed loss
         """
-        # batch*seq_len x vocab_size
-        smooth_dist = targets.new_zeros((targets.size(0), vocab_size)).float()
-        # fill distribution uniformly with smoothing
-        smooth_dist.fill_(self.smoothing / (vocab_size - 2))
-        # assign true label the probability of 1-smoothing ("confidence")
-        smooth_dist.scatter_(1, targets.unsqueeze(1).data, 1.0-self.smoothing)
-        # give padding probability of 0 everywhere
-        smooth_dist[:, self.pad_index] = 0
-        # masking out padding area (sum of probabilities for padding area = 0)
-        padding_positions = torch.nonzero(targets.data == self.pad_index)
-        # pylint: disable=len-as-condition
-        if len(padding_positions) > 0:
-            smooth_dist.index_fill_(0, padding_positions.squeeze(), 0.0)
-        return Variable(smooth_dist, requires_grad=False)
+        confidence = 1.0 - self.smoothing
+        uniform = self.smoothing / (vocab_size - 2)
+
+        # sum_j q_j log q_j of a smoothed target distribution (0 log 0 = 0)
+        neg_entropy = self.smoothing * math.log(uniform)
+        if confidence > 0:
+            neg_entropy += confidence * math.log(confidence)
+
+        other_log_probs = sum_log_probs - target_log_probs - pad_log_probs
+        loss = neg_entropy - confidence * target_log_probs \
+            - uniform * other_log_probs
+        # padding positions have a target distribution of 0
+        return loss.masked_select(targets != self.pad_index).sum()
 
     # pylint: disable=arguments-differ
     def forward(self, log_probs, targets):
@@ -62,16 +79,39 @@ class XentLoss(nn.Module):
         :param targets: target indices
         :return:
         """
+        log_probs = log_probs.contiguous().view(-1, log_probs.size(-1))
+        # targets: indices with batch*seq_len
+        targets = targets.contiguous().view(-1)
         if self.smoothing > 0:
-            targets = self._smooth_targets(
-                targets=targets.contiguous().view(-1),
-                vocab_size=log_probs.size(-1))
-            # targets: distributions with batch*seq_len x vocab_size
-            assert log_probs.contiguous().view(-1, log_probs.size(-1)).shape \
-                == targets.shape
-        else:
-            # targets: indices with batch*seq_len
-            targets = targets.contiguous().view(-1)
-        loss = self.criterion(
-            log_probs.contiguous().view(-1, log_probs.size(-1)), targets)
+            return self._smoothed_loss(
+                target_log_probs=log_probs.gather(
+                    1, targets.unsqueeze(1)).squeeze(1),
+                sum_log_probs=log_probs.sum(dim=-1),
+                pad_log_probs=log_probs[:, self.pad_index],
+                targets=targets, vocab_size=log_probs.size(-1))
+        loss = self.criterion(log_probs, targets)
         return loss
+
+    def loss_from_logits(self, logits: Tensor, targets: Tensor) -> Tensor:
+        """
+        Compute the same loss as `forward`, but directly from the logits,
+        fusing the log-softmax into the loss computation: no tensor of
+        log probabilities is created.
+
+        :param logits: unnormalized scores as predicted by model
+        :param targets: target indices
+        :return:
+        """
+        logits = logits.contiguous().view(-1, logits.size(-1))
+        targets = targets.contiguous().view(-1)
+        if self.smoothing <= 0:
+            return F.cross_entropy(logits, targets,
+                                   ignore_index=self.pad_index,
+                                   reduction='sum')
+        log_normalizer = torch.logsumexp(logits, dim=-1)
+        return self._smoothed_loss(
+            target_log_probs=logits.gather(
+                1, targets.unsqueeze(1)).squeeze(1) - log_normalizer,
+            sum_log_probs=logits.sum(dim=-1) - logits.size(-1) * log_normalizer,
+            pad_log_probs=logits[:, self.pad_index] - log_normalizer,
+            targets=targets, vocab_size=logits.size(-1))
@@ -3,11 +3,14 @@
 Module to represents whole models
 """
 
+import inspect
+
 import numpy as np
 
+import torch
 import torch.nn as nn
 from torch import Tensor
-import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from joeynmt.initialization import initialize_model
 from joeynmt.embeddings import Embeddings
@@ -19,6 +22,11 @@ from joeynmt.vocabulary import Vocabulary
 from joeynmt.batch import Batch
 from joeynmt.helpers import ConfigurationError
 
+# recent versions of torch (>=1.11) can checkpoint without reentrant autograd,
+# which they recommend, older ones don't accept the argument
+_CHECKPOINT_ARGS = {"use_reentrant": False} \
+    if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
+
 
 class Model(nn.Module):
     """
@@ -56,7 +64,8 @@ class Model(nn.Module):
 
     # pylint: disable=arguments-differ
     def forward(self, src: Tensor, trg_input: Tensor, src_mask: Tensor,
-                src_lengths: Tensor, trg_mask: Tensor = None) -> (
+                src_lengths: Tensor, trg_mask: Tensor = None,
+                skip_output_layer: bool = False) -> (
         Tensor, Tensor, Tensor, Tensor):
         """
         First encodes the source sentence.
@@ -67,6 +76,8 @@ class Model(nn.Module):
         :param src_mask: source mask
         :param src_lengths: length of source inputs
         :param trg_mask: target mask
+        :param skip_output_layer: return the decoder states before the output
+            layer instead of the logits
         :return: decoder outputs
         """
         encoder_output, encoder_hidden = self.encode(src=src,
@@ -77,7 +88,8 @@ class Model(nn.Module):
                            encoder_hidden=encoder_hidden,
                            src_mask=src_mask, trg_input=trg_input,
                            unroll_steps=unroll_steps,
-                           trg_mask=trg_mask)
+                           trg_mask=trg_mask,
+                           skip_output_layer=skip_output_layer)
 
     def encode(self, src: Tensor, src_length: Tensor, src_mask: Tensor) \
         -> (Tensor, Tensor):
@@ -94,7 +106,7 @@ class Model(nn.Module):
     def decode(self, encoder_output: Tensor, encoder_hidden: Tensor,
                src_mask: Tensor, trg_input: Tensor,
                unroll_steps: int, decoder_hidden: Tensor = None,
-               trg_mask: Tensor = None) \
+               trg_mask: Tensor = None, skip_output_layer: bool = False) \
         -> (Tensor, Tensor, Tensor, Tensor):
         """
         Decode, given an encoded source sentence.
@@ -106,6 +118,8 @@ class Model(nn.Module):
         :param unroll_steps: number of steps to unrol the decoder for
         :param decoder_hidden: decoder hidden state (optional)
         :param trg_mask: mask for target steps
+        :param skip_output_layer: return the decoder states before the output
+            layer instead of the logits
         :return: decoder outputs (outputs, hidden, att_probs, att_vectors)
         """
         return self.decoder(trg_embed=self.trg_embed(trg_input),
@@ -114,34 +128,74 @@ class Model(nn.Module):
                             src_mask=src_mask,
                             unroll_steps=unroll_steps,
                             hidden=decoder_hidden,
-                            trg_mask=trg_mask)
+                            trg_mask=trg_mask,
+                            skip_output_layer=skip_output_layer)
 
-    def get_loss_for_batch(self, batch: Batch, loss_function: nn.Module) \
-            -> Tensor:
+    def get_loss_for_batch(self, batch: Batch, loss_function: nn.Module,
+                           chunk_size: int = None,
+                           encoder_output: Tensor = None,
+                           encoder_hidden: Tensor = None) -> Tensor:
         """
         Compute non-normalized loss and number of tokens for a batch
 
+        The loss is computed directly from the logits
+        (see `XentLoss.loss_from_logits`), without an extra tensor of
+        log probabilities. With `chunk_size`, the output layer and the loss
+        are computed for `chunk_size` target steps at a time, and the logits
+        of each slice are recomputed during the backward pass instead of
+        being stored, so that only one slice of vocabulary-sized activations
+        is held in memory.
+
         :param batch: batch to compute loss for
         :param loss_function: loss function, computes for input and target
             a scalar loss for the complete batch
+        :param chunk_size: number of target steps per slice, default: all
+        :param encoder_output: encoder states of the batch, if it has been
+            encoded already (e.g. for decoding as well)
+        :param encoder_hidden: last encoder state of the batch,
+            if it has been encoded already
         :return: batch_loss: sum of losses over non-pad elements in the batch
         """
         # pylint: disable=unused-variable
-        out, hidden, att_probs, _ = self.forward(
-            src=batch.src, trg_input=batch.trg_input,
-            src_mask=batch.src_mask, src_lengths=batch.src_lengths,
-            trg_mask=batch.trg_mask)
-
-        # compute log probs
-        log_probs = F.log_softmax(out, dim=-1)
-
-        # compute batch loss
-        batch_loss = loss_function(log_probs, batch.trg)
+        if encoder_output is None:
+            states, hidden, att_probs, _ = self.forward(
+                src=batch.src, trg_input=batch.trg_input,
+                src_mask=batch.src_mask, src_lengths=batch.src_lengths,
+                trg_mask=batch.trg_mask, skip_output_layer=True)
+        else:
+            states, hidden, att_probs, _ = self.decode(
+                encoder_output=encoder_output, encoder_hidden=encoder_hidden,
+                src_mask=batch.src_mask, trg_input=batch.trg_input,
+                unroll_steps=batch.trg_input.size(1),
+                trg_mask=batch.trg_mask, skip_output_layer=True)
+
+        def slice_loss(slice_states: Tensor, slice_trg: Tensor) -> Tensor:
+            logits = self.decoder.output_layer(slice_states)
+            return loss_function.loss_from_logits(logits, slice_trg)
+
+        trg_length = states.size(1)
+        if chunk_size is None or chunk_size >= trg_length:
+            batch_loss = slice_loss(states, batch.trg)
+        else:
+            batch_loss = 0
+            for start in range(0, trg_length, chunk_size):
+                slice_states = states[:, start:start + chunk_size]
+                slice_trg = batch.trg[:, start:start + chunk_size]
+                if torch.is_grad_enabled():
+                    # don't store the logits, recompute them for backward
+                    batch_loss = batch_loss + checkpoint(
+                        slice_loss, slice_states, slice_trg,
+                        **_CHECKPOINT_ARGS)
+                else:
+                    batch_loss = batch_loss + slice_loss(slice_states,
+                                                         slice_trg)
         # return batch loss = sum over all elements in batch that are not pad
         return batch_loss
 
     def run_batch(self, batch: Batch, max_output_length: int, beam_size: int,
-                  beam_alpha: float) -> (np.array, np.array):
+                  beam_alpha: float, encoder_output: Tensor = None,
+                  encoder_hidden: Tensor = None,
+                  beam_early_stopping: bool = False) -> (np.array, np.array):
         """
         Get outputs and attentions scores for a given batch
 
@@ -149,12 +203,19 @@ class Model(nn.Module):
         :param max_output_length: maximum length of hypotheses
         :param beam_size: size of the beam for beam search, if 0 use greedy
         :param beam_alpha: alpha value for beam search
+        :param encoder_output: encoder states of the batch, if it has been
+            encoded already (e.g. for computing the loss as well)
+        :param encoder_hidden: last encoder state of the batch,
+            if it has been encoded already
+        :param beam_early_stopping: stop beam search for a sentence when its
+            unfinished hypotheses cannot beat the finished ones
         :return: stacked_output: hypotheses for batch,
             stacked_attention_scores: attention scores for batch
         """
-        encoder_output, encoder_hidden = self.encode(
-            batch.src, batch.src_lengths,
-            batch.src_mask)
+        if encoder_output is None:
+            encoder_output, encoder_hidden = self.encode(
+                batch.src, batch.src_lengths,
+                batch.src_mask)
 
         # if maximum output length is not globally specified, adapt to src len
         if max_output_length is None:
@@ -179,7 +240,8 @@ class Model(nn.Module):
                         alpha=beam_alpha, eos_index=self.eos_index,
                         pad_index=self.pad_index,
                         bos_index=self.bos_index,
-                        decoder=self.decoder)
+                        decoder=self.decoder,
+                        early_stopping=beam_early_stopping)
 
         return stacked_output, stacked_attention_scores
 
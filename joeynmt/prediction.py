@@ -2,23 +2,47 @@
 """
 This modules holds methods for generating predictions from a model.
 """
+import itertools
+import json
 import os
 import sys
-from typing import List, Optional
+from collections import OrderedDict
+from typing import Iterable, List, Optional
 from logging import Logger
 import numpy as np
 
 import torch
-from torchtext.data import Dataset, Field
+from torchtext.data import Dataset
 
 from joeynmt.helpers import bpe_postprocess, load_config, make_logger,\
     get_latest_checkpoint, load_checkpoint, store_attention_plots
 from joeynmt.metrics import bleu, chrf, token_accuracy, sequence_accuracy
 from joeynmt.model import build_model, Model
 from joeynmt.batch import Batch
-from joeynmt.data import load_data, make_data_iter, MonoDataset
-from joeynmt.constants import UNK_TOKEN, PAD_TOKEN, EOS_TOKEN
+from joeynmt.data import load_eval_data, make_tokenizer
+from joeynmt.batching import make_src_batches, LengthSortedIterator
+from joeynmt.constants import PAD_TOKEN
 from joeynmt.vocabulary import Vocabulary
+from joeynmt.profiling import TorchProfiler
+
+
+def _load_vocabs(cfg: dict) -> (Vocabulary, Vocabulary):
+    """
+    Load the vocabularies the model was trained with, from the vocabulary
+    files in the data configuration or else from the model directory.
+    The vocabularies are frozen, so that looking up unknown tokens doesn't
+    grow them.
+
+    :param cfg: configuration dictionary
+    :return: source vocabulary, target vocabulary
+    """
+    src_vocab_file = cfg["data"].get(
+        "src_vocab", cfg["training"]["model_dir"] + "/src_vocab.txt")
+    trg_vocab_file = cfg["data"].get(
+        "trg_vocab", cfg["training"]["model_dir"] + "/trg_vocab.txt")
+    src_vocab = Vocabulary(file=src_vocab_file, frozen=True)
+    trg_vocab = Vocabulary(file=trg_vocab_file, frozen=True)
+    return src_vocab, trg_vocab
 
 
 # pylint: disable=too-many-arguments,too-many-locals,no-member
@@ -29,7 +53,9 @@ def validate_on_data(model: Model, data: Dataset,
                      level: str, eval_metric: Optional[str],
                      loss_function: torch.nn.Module = None,
                      beam_size: int = 1, beam_alpha: int = -1,
-                     batch_type: str = "sentence"
+                     beam_early_stopping: bool = False,
+                     batch_type: str = "sentence",
+                     profiler: TorchProfiler = None
                      ) \
         -> (float, float, float, List[str], List[List[str]], List[str],
             List[str], List[List[str]], List[np.array]):
@@ -52,7 +78,10 @@ def validate_on_data(model: Model, data: Dataset,
         If <2 then greedy decoding (default).
     :param beam_alpha: beam search alpha for length penalty,
         disabled if set to -1 (default).
+    :param beam_early_stopping: stop beam search for a sentence when its
+        unfinished hypotheses cannot beat the finished ones
     :param batch_type: validation batch type (sentence or token)
+    :param profiler: profiles selected batches with torch.profiler (optional)
 
     :return:
         - current_valid_score: current validation score [eval_metric],
@@ -71,9 +100,9 @@ def validate_on_data(model: Model, data: Dataset,
             "this? 'batch_size' is > 1000 for sentence-batching. "
             "Consider decreasing it or switching to"
             " 'eval_batch_type: token'.")
-    valid_iter = make_data_iter(
-        dataset=data, batch_size=batch_size, batch_type=batch_type,
-        shuffle=False, train=False)
+    # batch examples of similar length together, across the whole data set
+    valid_iter = LengthSortedIterator(
+        dataset=data, batch_size=batch_size, batch_type=batch_type)
     valid_sources_raw = data.src
     pad_index = model.src_vocab.stoi[PAD_TOKEN]
     # disable dropout
@@ -85,17 +114,25 @@ def validate_on_data(model: Model, data: Dataset,
         total_loss = 0
         total_ntokens = 0
         total_nseqs = 0
-        for valid_batch in iter(valid_iter):
+        for i, valid_batch in enumerate(iter(valid_iter)):
+            if profiler is not None:
+                profiler.step(i)
             # run as during training to get validation loss (e.g. xent)
 
             batch = Batch(valid_batch, pad_index, use_cuda=use_cuda)
             # sort batch now by src length and keep track of order
             sort_reverse_index = batch.sort_by_src_lengths()
 
+            # encode once for both loss computation and decoding
+            encoder_output, encoder_hidden = model.encode(
+                batch.src, batch.src_lengths, batch.src_mask)
+
             # run as during training with teacher forcing
             if loss_function is not None and batch.trg is not None:
                 batch_loss = model.get_loss_for_batch(
-                    batch, loss_function=loss_function)
+                    batch, loss_function=loss_function,
+                    encoder_output=encoder_output,
+                    encoder_hidden=encoder_hidden)
                 total_loss += batch_loss
                 total_ntokens += batch.ntokens
                 total_nseqs += batch.nseqs
@@ -103,15 +140,26 @@ def validate_on_data(model: Model, data: Dataset,
             # run as during inference to produce translations
             output, attention_scores = model.run_batch(
                 batch=batch, beam_size=beam_size, beam_alpha=beam_alpha,
-                max_output_length=max_output_length)
+                max_output_length=max_output_length,
+                encoder_output=encoder_output, encoder_hidden=encoder_hidden,
+                beam_early_stopping=beam_early_stopping)
 
-            # sort outputs back to original order
+            # sort outputs back to the order of the batch
             all_outputs.extend(output[sort_reverse_index])
             valid_attention_scores.extend(
                 attention_scores[sort_reverse_index]
                 if attention_scores is not None else [])
 
+        if profiler is not None:
+            profiler.close()
+
         assert len(all_outputs) == len(data)
+        # restore the order of the data set
+        restore_index = np.argsort(valid_iter.order)
+        all_outputs = [all_outputs[i] for i in restore_index]
+        if valid_attention_scores:
+            valid_attention_scores = [valid_attention_scores[i]
+                                      for i in restore_index]
 
         if loss_function is not None and total_ntokens > 0:
             # total validation loss
@@ -210,9 +258,11 @@ def test(cfg_file,
     eval_metric = cfg["training"]["eval_metric"]
     max_output_length = cfg["training"].get("max_output_length", None)
 
-    # load the data
-    _, dev_data, test_data, src_vocab, trg_vocab = load_data(
-        data_cfg=cfg["data"])
+    # load the vocabularies of the model and the data to translate
+    # (the training data isn't needed)
+    src_vocab, trg_vocab = _load_vocabs(cfg)
+    dev_data, test_data = load_eval_data(
+        data_cfg=cfg["data"], src_vocab=src_vocab, trg_vocab=trg_vocab)
 
     data_to_predict = {"dev": dev_data, "test": test_data}
 
@@ -230,9 +280,11 @@ def test(cfg_file,
     if "testing" in cfg.keys():
         beam_size = cfg["testing"].get("beam_size", 1)
         beam_alpha = cfg["testing"].get("alpha", -1)
+        beam_early_stopping = cfg["testing"].get("early_stopping", False)
     else:
         beam_size = 1
         beam_alpha = -1
+        beam_early_stopping = False
 
     for data_set_name, data_set in data_to_predict.items():
 
@@ -243,7 +295,8 @@ def test(cfg_file,
             batch_type=batch_type, level=level,
             max_output_length=max_output_length, eval_metric=eval_metric,
             use_cuda=use_cuda, loss_function=None, beam_size=beam_size,
-            beam_alpha=beam_alpha, logger=logger)
+            beam_alpha=beam_alpha, beam_early_stopping=beam_early_stopping,
+            logger=logger)
         #pylint: enable=unused-variable
 
         if "trg" in data_set.fields:
@@ -281,6 +334,286 @@ def test(cfg_file,
             logger.info("Translations saved to: %s", output_path_set)
 
 
+class TranslationCache:
+    """
+    Bounded cache of translations that evicts the least recently used
+    entries. Optionally, the entries are loaded from and saved to a file,
+    so that they are kept across processes.
+    """
+
+    def __init__(self, max_size: int = 10000, path: str = None) -> None:
+        """
+        Create a cache, with the entries of `path` if it exists.
+
+        :param max_size: maximum number of entries
+        :param path: JSON file to load entries from and save them to
+        """
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.isfile(path):
+            with open(path, encoding="utf-8") as opened_file:
+                for key, value in json.load(opened_file):
+                    self.entries[key] = value
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a translation and mark it as recently used.
+
+        :param key: cache key
+        :return: cached translation or None
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        """
+        Add a translation, evicting the least recently used one if the
+        cache is full.
+
+        :param key: cache key
+        :param value: translation
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        :return: number of entries, hits, misses and evictions
+        """
+        return {"size": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def save(self) -> None:
+        """
+        Write the entries to the cache file (if any), from least to most
+        recently used.
+        """
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as opened_file:
+            json.dump(list(self.entries.items()), opened_file,
+                      ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class Translator:
+    """
+    Translates sentences in memory with a model that stays loaded,
+    e.g. for interactive translation or for serving translations.
+
+    Input sentences are tokenized, numericalized and batched directly,
+    without creating files or torchtext datasets.
+    Repeated sentences are only decoded once, and with a `TranslationCache`
+    translations are reused across calls.
+    """
+
+    def __init__(self, model: Model, level: str, lowercase: bool,
+                 batch_size: int = 1, batch_type: str = "sentence",
+                 beam_size: int = 1, beam_alpha: float = -1,
+                 beam_early_stopping: bool = False,
+                 max_output_length: int = None,
+                 use_cuda: bool = False, cache: TranslationCache = None,
+                 model_id: str = "") -> None:
+        """
+        Create a translator for a model with loaded parameters.
+
+        :param model: model to translate with (moved to GPU if `use_cuda`)
+        :param level: segmentation level, one of "char", "bpe", "word"
+        :param lowercase: lowercase the input
+        :param batch_size: size of the batches sentences are decoded in
+        :param batch_type: measure batch size by sentence count or by token
+            count
+        :param beam_size: size of the beam for beam search, <2: greedy
+        :param beam_alpha: alpha value for beam search
+        :param beam_early_stopping: stop beam search for a sentence when its
+            unfinished hypotheses cannot beat the finished ones
+        :param max_output_length: maximum length of hypotheses
+        :param use_cuda: decode on GPU
+        :param cache: cache for translations
+        :param model_id: identifies the model parameters in the cache keys,
+            e.g. the checkpoint
+        """
+        self.model = model
+        self.model.eval()
+        self.level = level
+        self.tokenize = make_tokenizer(level, lowercase)
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+        self.beam_size = beam_size
+        self.beam_alpha = beam_alpha
+        self.beam_early_stopping = beam_early_stopping
+        self.max_output_length = max_output_length
+        self.use_cuda = use_cuda
+        self.cache = cache
+        self.model_id = model_id
+
+    @classmethod
+    def from_config(cls, cfg: dict, ckpt: str = None) -> "Translator":
+        """
+        Load the model of a configuration for translation.
+
+        :param cfg: configuration dictionary
+        :param ckpt: path to checkpoint to load,
+            default: latest checkpoint in the model directory
+        :return: translator for the model
+        """
+        # when checkpoint is not specified, take latest from model dir
+        if ckpt is None:
+            model_dir = cfg["training"]["model_dir"]
+            ckpt = get_latest_checkpoint(model_dir)
+            if ckpt is None:
+                raise FileNotFoundError("No checkpoint found in directory {}."
+                                        .format(model_dir))
+        use_cuda = cfg["training"].get("use_cuda", False)
+
+        src_vocab, trg_vocab = _load_vocabs(cfg)
+        model_checkpoint = load_checkpoint(ckpt, use_cuda=use_cuda)
+        model = build_model(cfg["model"], src_vocab=src_vocab,
+                            trg_vocab=trg_vocab)
+        model.load_state_dict(model_checkpoint["model_state"])
+        if use_cuda:
+            model.cuda()
+
+        # whether to use beam search for decoding, <2: greedy decoding
+        testing_cfg = cfg.get("testing", {})
+        cache = None
+        if testing_cfg.get("cache_size", 0) > 0:
+            cache = TranslationCache(max_size=testing_cfg["cache_size"],
+                                     path=testing_cfg.get("cache_file", None))
+        # the checkpoint file and its modification time identify the model
+        model_id = "{}@{}".format(os.path.realpath(ckpt),
+                                  os.path.getmtime(ckpt))
+        return cls(model=model, level=cfg["data"]["level"],
+                   lowercase=cfg["data"]["lowercase"],
+                   batch_size=cfg["training"].get(
+                       "eval_batch_size", cfg["training"].get("batch_size", 1)),
+                   batch_type=cfg["training"].get(
+                       "eval_batch_type",
+                       cfg["training"].get("batch_type", "sentence")),
+                   beam_size=testing_cfg.get("beam_size", 1),
+                   beam_alpha=testing_cfg.get("alpha", -1),
+                   beam_early_stopping=testing_cfg.get("early_stopping",
+                                                       False),
+                   max_output_length=cfg["training"].get(
+                       "max_output_length", None),
+                   use_cuda=use_cuda, cache=cache, model_id=model_id)
+
+    def postprocess(self, tokens: List[str]) -> str:
+        """
+        Join the tokens of a hypothesis like in `validate_on_data`.
+
+        :param tokens: tokens of the hypothesis
+        :return: hypothesis string
+        """
+        join_char = " " if self.level in ["word", "bpe"] else ""
+        hypothesis = join_char.join(tokens)
+        if self.level == "bpe":
+            hypothesis = bpe_postprocess(hypothesis)
+        return hypothesis
+
+    def _cache_key(self, tokens: List[str]) -> str:
+        """
+        Key of a source sentence in the cache: the pre-processed sentence
+        and everything else that determines its translation.
+
+        :param tokens: source tokens
+        :return: cache key
+        """
+        return json.dumps([self.model_id, self.beam_size, self.beam_alpha,
+                           self.max_output_length, tokens],
+                          ensure_ascii=False)
+
+    def translate(self, sentences: List[str]) -> List[str]:
+        """
+        Translate pre-processed (e.g. tokenized, BPE-split) sentences.
+        Sentences are decoded in batches of similar length.
+        Empty sentences are translated to empty strings.
+
+        :param sentences: source sentences
+        :return: translations in the order of `sentences`
+        """
+        hypotheses = [""] * len(sentences)
+        # positions of every distinct sentence that has to be decoded
+        to_decode = OrderedDict()
+        for i, sentence in enumerate(sentences):
+            tokens = tuple(self.tokenize(sentence.strip()))
+            if tokens:
+                to_decode.setdefault(tokens, []).append(i)
+
+        if self.cache is not None:
+            for tokens in list(to_decode):
+                hypothesis = self.cache.get(self._cache_key(list(tokens)))
+                if hypothesis is not None:
+                    for i in to_decode.pop(tokens):
+                        hypotheses[i] = hypothesis
+
+        src_tokens = list(to_decode)
+        with torch.no_grad():
+            for indices, torch_batch in make_src_batches(
+                    src_tokens, src_vocab=self.model.src_vocab,
+                    batch_size=self.batch_size, batch_type=self.batch_type):
+                batch = Batch(torch_batch, self.model.pad_index,
+                              use_cuda=self.use_cuda)
+                output, _ = self.model.run_batch(
+                    batch=batch, beam_size=self.beam_size,
+                    beam_alpha=self.beam_alpha,
+                    max_output_length=self.max_output_length,
+                    beam_early_stopping=self.beam_early_stopping)
+                decoded = self.model.trg_vocab.arrays_to_sentences(
+                    arrays=output, cut_at_eos=True)
+                for index, tokens in zip(indices, decoded):
+                    hypothesis = self.postprocess(tokens)
+                    for i in to_decode[src_tokens[index]]:
+                        hypotheses[i] = hypothesis
+                    if self.cache is not None:
+                        self.cache.put(
+                            self._cache_key(list(src_tokens[index])),
+                            hypothesis)
+        return hypotheses
+
+    def translate_stream(self, lines: Iterable[str],
+                         chunk_size: int = 10000) -> Iterable[List[str]]:
+        """
+        Translate a stream of sentences chunk by chunk, so that only one
+        chunk is held in memory and translations are available as soon as
+        their chunk is done. Within a chunk, sentences are decoded in
+        batches of similar length.
+
+        :param lines: source sentences, e.g. an open file
+        :param chunk_size: number of sentences translated together
+        :return: generator of the translations of every chunk,
+            in the order of `lines`
+        """
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield self.translate(chunk)
+
+    def close(self) -> None:
+        """
+        Save the translation cache (if it has a file).
+        """
+        if self.cache is not None:
+            self.cache.save()
+
+
 def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
     """
     Interactive translation function.
@@ -294,114 +627,30 @@ def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
     :param ckpt: path to checkpoint to load
     :param output_path: path to output file
     """
-
-    def _load_line_as_data(line):
-        """ Create a dataset from one line via a temporary file. """
-        # write src input to temporary file
-        tmp_name = "tmp"
-        tmp_suffix = ".src"
-        tmp_filename = tmp_name+tmp_suffix
-        with open(tmp_filename, "w") as tmp_file:
-            tmp_file.write("{}\n".format(line))
-
-        test_data = MonoDataset(path=tmp_name, ext=tmp_suffix,
-                                field=src_field)
-
-        # remove temporary file
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
-
-        return test_data
-
     logger = make_logger()
-
-    def _translate_data(test_data):
-        """ Translates given dataset, using parameters from outer scope. """
-        # pylint: disable=unused-variable
-        score, loss, ppl, sources, sources_raw, references, hypotheses, \
-        hypotheses_raw, attention_scores = validate_on_data(
-            model, data=test_data, batch_size=batch_size,
-            batch_type=batch_type, level=level,
-            max_output_length=max_output_length, eval_metric="",
-            use_cuda=use_cuda, loss_function=None, beam_size=beam_size,
-            beam_alpha=beam_alpha, logger=logger)
-        return hypotheses
-
     cfg = load_config(cfg_file)
-
-    # when checkpoint is not specified, take oldest from model dir
-    if ckpt is None:
-        model_dir = cfg["training"]["model_dir"]
-        ckpt = get_latest_checkpoint(model_dir)
-
-    batch_size = cfg["training"].get(
-        "eval_batch_size", cfg["training"].get("batch_size", 1))
-    batch_type = cfg["training"].get(
-        "eval_batch_type", cfg["training"].get("batch_type", "sentence"))
-    use_cuda = cfg["training"].get("use_cuda", False)
-    level = cfg["data"]["level"]
-    max_output_length = cfg["training"].get("max_output_length", None)
-
-    # read vocabs
-    src_vocab_file = cfg["data"].get(
-        "src_vocab", cfg["training"]["model_dir"] + "/src_vocab.txt")
-    trg_vocab_file = cfg["data"].get(
-        "trg_vocab", cfg["training"]["model_dir"] + "/trg_vocab.txt")
-    src_vocab = Vocabulary(file=src_vocab_file)
-    trg_vocab = Vocabulary(file=trg_vocab_file)
-
-    data_cfg = cfg["data"]
-    level = data_cfg["level"]
-    lowercase = data_cfg["lowercase"]
-
-    tok_fun = lambda s: list(s) if level == "char" else s.split()
-
-    src_field = Field(init_token=None, eos_token=EOS_TOKEN,
-                      pad_token=PAD_TOKEN, tokenize=tok_fun,
-                      batch_first=True, lower=lowercase,
-                      unk_token=UNK_TOKEN,
-                      include_lengths=True)
-    src_field.vocab = src_vocab
-
-    # load model state from disk
-    model_checkpoint = load_checkpoint(ckpt, use_cuda=use_cuda)
-
-    # build model and load parameters into it
-    model = build_model(cfg["model"], src_vocab=src_vocab, trg_vocab=trg_vocab)
-    model.load_state_dict(model_checkpoint["model_state"])
-
-    if use_cuda:
-        model.cuda()
-
-    # whether to use beam search for decoding, <2: greedy decoding
-    if "testing" in cfg.keys():
-        beam_size = cfg["testing"].get("beam_size", 1)
-        beam_alpha = cfg["testing"].get("alpha", -1)
-    else:
-        beam_size = 1
-        beam_alpha = -1
+    translator = Translator.from_config(cfg, ckpt=ckpt)
 
     if not sys.stdin.isatty():
-        # input file given
-        test_data = MonoDataset(path=sys.stdin, ext="", field=src_field)
-        hypotheses = _translate_data(test_data)
-
-        if output_path is not None:
-            # write to outputfile if given
-            output_path_set = "{}".format(output_path)
-            with open(output_path_set, mode="w", encoding="utf-8") as out_file:
+        # input file given: translate it chunk by chunk and write the
+        # translations of every chunk right away, one line per input line
+        chunk_size = cfg.get("testing", {}).get("chunk_size", 10000)
+        out_file = sys.stdout if output_path is None \
+            else open(output_path, mode="w", encoding="utf-8")
+        try:
+            for hypotheses in translator.translate_stream(
+                    sys.stdin, chunk_size=chunk_size):
                 for hyp in hypotheses:
                     out_file.write(hyp + "\n")
-            logger.info("Translations saved to: %s.", output_path_set)
-        else:
-            # print to stdout
-            for hyp in hypotheses:
-                print(hyp)
+                out_file.flush()
+        finally:
+            if output_path is not None:
+                out_file.close()
+        if output_path is not None:
+            logger.info("Translations saved to: %s.", output_path)
 
     else:
         # enter interactive mode
-        batch_size = 1
-        batch_type = "sentence"
         while True:
             try:
                 src_input = input("\nPlease enter a source sentence "
@@ -409,12 +658,13 @@ def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
                 if not src_input.strip():
                     break
 
-                # every line has to be made into dataset
-                test_data = _load_line_as_data(line=src_input)
-
-                hypotheses = _translate_data(test_data)
+                hypotheses = translator.translate([src_input])
                 print("JoeyNMT: {}".format(hypotheses[0]))
 
             except (KeyboardInterrupt, EOFError):
                 print("\nBye.")
                 break
+
+    if translator.cache is not None:
+        logger.info("Translation cache: %s", translator.cache.stats())
+    translator.close()
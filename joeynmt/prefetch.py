@@ -0,0 +1,116 @@
+# coding: utf-8
+"""
+Prefetching module: prepares batches in background threads
+"""
+import itertools
+import queue
+import threading
+
+from joeynmt.batch import Batch
+
+
+class PrefetchIterator:
+    """
+    Wraps a batch iterator and turns its batches into `joeynmt.batch.Batch`
+    objects.
+
+    With `num_batches` > 0, batches are created ahead of time by background
+    threads (batching, numericalization, padding, masking and the copy to
+    GPU) and held in a bounded queue, so that the training loop does not wait
+    for them. The order of the batches is the same as without prefetching.
+    """
+
+    def __init__(self, data_iter, pad_index: int, use_cuda: bool = False,
+                 pin_memory: bool = False, num_batches: int = 0,
+                 num_workers: int = 1) -> None:
+        """
+        Create a prefetching iterator.
+
+        :param data_iter: iterator over torchtext (or compatible) batches
+        :param pad_index: padding index
+        :param use_cuda: move the batches to GPU
+        :param pin_memory: copy the batches to page-locked memory before
+            moving them to GPU
+        :param num_batches: maximum number of batches prepared ahead of time,
+            0: create batches when they are needed
+        :param num_workers: number of threads that prepare batches
+        """
+        self.data_iter = data_iter
+        self.pad_index = pad_index
+        self.use_cuda = use_cuda
+        self.pin_memory = pin_memory
+        self.num_batches = num_batches
+        self.num_workers = max(num_workers, 1)
+
+    def __len__(self) -> int:
+        return len(self.data_iter)
+
+    def _make_batch(self, torch_batch) -> Batch:
+        return Batch(torch_batch, self.pad_index, use_cuda=self.use_cuda,
+                     pin_memory=self.pin_memory)
+
+    def __iter__(self):
+        if self.num_batches <= 0:
+            for torch_batch in self.data_iter:
+                yield self._make_batch(torch_batch)
+            return
+
+        source = iter(self.data_iter)
+        positions = itertools.count()
+        source_lock = threading.Lock()
+        ready = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def work():
+            while not stop.is_set():
+                # the source iterator can only be advanced by one thread
+                with source_lock:
+                    position = next(positions)
+                    try:
+                        torch_batch = next(source)
+                    except StopIteration:
+                        put((position, None, None))
+                        return
+                    except Exception as e:  # pylint: disable=broad-except
+                        put((position, None, e))
+                        return
+                try:
+                    put((position, self._make_batch(torch_batch), None))
+                except Exception as e:  # pylint: disable=broad-except
+                    put((position, None, e))
+                    return
+
+        workers = [threading.Thread(target=work, daemon=True)
+                   for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+
+        # restore the order of the batches
+        pending = {}
+        next_position = 0
+        end = None
+        try:
+            while end is None or next_position < end:
+                if next_position in pending:
+                    yield pending.pop(next_position)
+                    next_position += 1
+                    continue
+                position, batch, error = ready.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    end = position if end is None else min(end, position)
+                else:
+                    pending[position] = batch
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
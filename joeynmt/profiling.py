@@ -0,0 +1,243 @@
+# coding: utf-8
+"""
+Profiling utilities for training
+"""
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterable, List
+
+import numpy as np
+import torch
+import torch.profiler
+from torch.utils.tensorboard import SummaryWriter
+
+
+class StepProfiler:
+    """
+    Measures the time spent in the phases of training steps
+    (e.g. batch construction, forward pass, backward pass, optimizer step).
+
+    The durations are collected over a logging window and then summarized
+    with percentiles, which are written to TensorBoard and appended as one
+    JSON line to a file.
+    If the profiler is disabled, timing a phase does nothing.
+    """
+
+    percentiles = [50, 90, 99]
+
+    def __init__(self, enabled: bool = False, output_file: str = None,
+                 tb_writer: SummaryWriter = None,
+                 use_cuda: bool = False) -> None:
+        """
+        Create a step profiler.
+
+        :param enabled: whether to measure anything
+        :param output_file: JSONL file the summaries are appended to
+        :param tb_writer: TensorBoard writer for the summaries
+        :param use_cuda: synchronize CUDA before taking times, so that
+            asynchronously launched kernels count for the phase that launched
+            them
+        """
+        self.enabled = enabled
+        self.output_file = output_file
+        self.tb_writer = tb_writer
+        self.use_cuda = use_cuda
+        self.durations = defaultdict(list)
+
+    def _now(self) -> float:
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Measure the time spent inside the `with` block.
+
+        :param name: name of the phase
+        """
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.durations[name].append(self._now() - start)
+
+    def iterate(self, iterable: Iterable, name: str):
+        """
+        Iterate and measure the time it takes to get each element,
+        e.g. for creating batches.
+
+        :param iterable: iterable to measure
+        :param name: name of the phase
+        :return: generator over the elements of `iterable`
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    return
+            yield element
+
+    def summary(self) -> dict:
+        """
+        Summarize the durations of every phase in the current window.
+
+        :return: dictionary with count, total, mean, max and percentiles
+            (in seconds) for every phase
+        """
+        summary = {}
+        for name, durations in self.durations.items():
+            durations = np.asarray(durations)
+            stats = {"count": len(durations),
+                     "total": float(durations.sum()),
+                     "mean": float(durations.mean()),
+                     "max": float(durations.max())}
+            for p, value in zip(self.percentiles,
+                                np.percentile(durations, self.percentiles)):
+                stats["p{}".format(p)] = float(value)
+            summary[name] = stats
+        return summary
+
+    def write(self, steps: int) -> None:
+        """
+        Write the summary of the current window to TensorBoard and the output
+        file, and start a new window.
+
+        :param steps: current training step
+        """
+        if not self.enabled or not self.durations:
+            return
+        summary = self.summary()
+        if self.tb_writer is not None:
+            for name, stats in summary.items():
+                for stat in ["mean", "total"] + \
+                        ["p{}".format(p) for p in self.percentiles]:
+                    self.tb_writer.add_scalar(
+                        "profile/{}/{}".format(name, stat), stats[stat], steps)
+        if self.output_file is not None:
+            with open(self.output_file, "a") as opened_file:
+                opened_file.write(json.dumps(
+                    {"steps": steps, "phases": summary}) + "\n")
+        self.durations = defaultdict(list)
+
+
+class TorchProfiler:
+    """
+    Profiles selected ranges of training steps (or validation batches)
+    with `torch.profiler`.
+
+    For every range, a Chrome trace (open with chrome://tracing or
+    Perfetto) and a table of the most expensive operators are written to the
+    output directory. Each range is only profiled once.
+    """
+
+    def __init__(self, output_dir: str, name: str,
+                 ranges: List[List[int]] = None, use_cuda: bool = False,
+                 record_shapes: bool = False, profile_memory: bool = False,
+                 with_stack: bool = False, sort_by: str = None,
+                 row_limit: int = 50) -> None:
+        """
+        Create a profiler for the given ranges.
+
+        :param output_dir: directory for traces and summaries
+        :param name: prefix of the output files, e.g. "train"
+        :param ranges: list of [start, end) ranges of positions to profile
+        :param use_cuda: also profile CUDA kernels
+        :param record_shapes: record the input shapes of operators
+        :param profile_memory: record memory allocations
+        :param with_stack: record source locations of operators
+        :param sort_by: column to sort the operator table by,
+            default: self time on CUDA if `use_cuda`, else on CPU
+        :param row_limit: number of operators in the table
+        """
+        self.output_dir = output_dir
+        self.name = name
+        self.ranges = sorted(ranges) if ranges else []
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if use_cuda:
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        if sort_by is None:
+            sort_by = "self_cuda_time_total" if use_cuda \
+                else "self_cpu_time_total"
+        self.sort_by = sort_by
+        self.row_limit = row_limit
+        self.profiler = None
+        self.current_range = None
+
+    def step(self, position: int) -> None:
+        """
+        Start or stop profiling before processing the given position
+        (training step or batch index).
+
+        :param position: position that is processed next
+        """
+        if self.profiler is not None and position >= self.current_range[1]:
+            self.close()
+        # skip ranges that were missed (e.g. when continuing training)
+        while self.ranges and self.ranges[0][1] <= position:
+            self.ranges.pop(0)
+        if self.profiler is None and self.ranges \
+                and self.ranges[0][0] <= position < self.ranges[0][1]:
+            self.current_range = self.ranges.pop(0)
+            self.profiler = torch.profiler.profile(
+                activities=self.activities,
+                record_shapes=self.record_shapes,
+                profile_memory=self.profile_memory,
+                with_stack=self.with_stack)
+            self.profiler.start()
+
+    def close(self) -> None:
+        """
+        Stop profiling (if active) and write the trace and operator table.
+        """
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, "{}_{}-{}".format(
+            self.name, *self.current_range))
+        self.profiler.export_chrome_trace(prefix + ".trace.json")
+        with open(prefix + ".txt", "w") as opened_file:
+            opened_file.write(self.profiler.key_averages().table(
+                sort_by=self.sort_by, row_limit=self.row_limit))
+        self.profiler = None
+        self.current_range = None
+
+
+def build_torch_profilers(config: dict, model_dir: str,
+                          use_cuda: bool = False) \
+        -> (TorchProfiler, TorchProfiler):
+    """
+    Create the profilers for training steps and validation batches as
+    specified in the "profiling" section of the training configuration.
+
+    :param config: dictionary with profiling configurations
+    :param model_dir: model directory, outputs are written to
+        "profiles" in there
+    :param use_cuda: also profile CUDA kernels
+    :return: profiler for training steps, profiler for validation batches
+    """
+    output_dir = os.path.join(model_dir, "profiles")
+    options = dict(use_cuda=use_cuda,
+                   record_shapes=config.get("record_shapes", False),
+                   profile_memory=config.get("profile_memory", False),
+                   with_stack=config.get("with_stack", False),
+                   sort_by=config.get("sort_by", None),
+                   row_limit=config.get("row_limit", 50))
+    valid_batches = config.get("validation_batches", None)
+    return TorchProfiler(output_dir, "train", ranges=config.get("steps", []),
+                         **options), \
+        TorchProfiler(output_dir, "validation",
+                      ranges=[valid_batches] if valid_batches else [],
+                      **options)
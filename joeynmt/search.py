@@ -51,6 +51,7 @@ def recurrent_greedy(
     """
     Greedy decoding: in each step, choose the word that gets highest score.
     Version for recurrent decoder.
+    Sentences that reached </s> are not decoded any further.
 
     :param src_mask: mask for source inputs, 0 for positions after </s>
     :param embed: target embedding
@@ -67,11 +68,15 @@ def recurrent_greedy(
     batch_size = src_mask.size(0)
     prev_y = src_mask.new_full(size=[batch_size, 1], fill_value=bos_index,
                                dtype=torch.long)
+    # pylint: disable=protected-access
+    hidden = decoder._init_hidden(encoder_hidden)
+    prev_att_vector = None
+    # indices of the sentences that are still decoded, finished sentences
+    # are removed from the decoder inputs and states
+    active = np.arange(batch_size)
+    active_steps = []
     output = []
     attention_scores = []
-    hidden = None
-    prev_att_vector = None
-    finished = src_mask.new_zeros((batch_size, 1)).byte()
 
     # pylint: disable=unused-variable
     for t in range(max_output_length):
@@ -88,20 +93,40 @@ def recurrent_greedy(
 
         # greedy decoding: choose arg max over vocabulary in each step
         next_word = torch.argmax(logits, dim=-1)  # batch x time=1
-        output.append(next_word.squeeze(1).detach().cpu().numpy())
-        prev_y = next_word
+        words = next_word.squeeze(1).detach().cpu().numpy()
+        active_steps.append(active)
+        output.append(words)
         attention_scores.append(att_probs.squeeze(1).detach().cpu().numpy())
         # batch, max_src_lengths
 
-        # check if previous symbol was <eos>
-        is_eos = torch.eq(next_word, eos_index)
-        finished += is_eos
+        # remove the sentences that reached <eos>
+        non_finished = np.flatnonzero(words != eos_index)
         # stop predicting if <eos> reached for all elements in batch
-        if (finished >= 1).sum() == batch_size:
+        if len(non_finished) == 0:
             break
+        if len(non_finished) < len(active):
+            active = active[non_finished]
+            select_indices = torch.from_numpy(non_finished).to(
+                next_word.device)
+            next_word = next_word.index_select(0, select_indices)
+            encoder_output = encoder_output.index_select(0, select_indices)
+            if encoder_hidden is not None:
+                encoder_hidden = encoder_hidden.index_select(
+                    0, select_indices)
+            src_mask = src_mask.index_select(0, select_indices)
+            prev_att_vector = prev_att_vector.index_select(0, select_indices)
+            if isinstance(hidden, tuple):
+                # for LSTMs, states are tuples of tensors
+                hidden = tuple(h.index_select(1, select_indices)
+                               for h in hidden)
+            else:
+                hidden = hidden.index_select(1, select_indices)
+        prev_y = next_word
 
-    stacked_output = np.stack(output, axis=1)  # batch, time
-    stacked_attention_scores = np.stack(attention_scores, axis=1)
+    stacked_output = _stack_steps(active_steps, output, batch_size,
+                                  fill_value=eos_index)  # batch, time
+    stacked_attention_scores = _stack_steps(active_steps, attention_scores,
+                                            batch_size, fill_value=0)
     return stacked_output, stacked_attention_scores
 
 
@@ -114,6 +139,9 @@ def transformer_greedy(
     """
     Special greedy function for transformer, since it works differently.
     The transformer remembers all previous states and attends to them.
+    Decoding is incremental: the keys and values of previous steps are kept
+    in a cache, so that only the newest token is fed to the decoder.
+    Sentences that reached </s> are not decoded any further.
 
     :param src_mask: mask for source inputs, 0 for positions after </s>
     :param embed: target embedding layer
@@ -131,16 +159,27 @@ def transformer_greedy(
     batch_size = src_mask.size(0)
 
     # start with BOS-symbol for each sentence in the batch
-    ys = encoder_output.new_full([batch_size, 1], bos_index, dtype=torch.long)
+    next_word = encoder_output.new_full([batch_size], bos_index,
+                                        dtype=torch.long)
 
     # a subsequent mask is intersected with this in decoder forward pass
     trg_mask = src_mask.new_ones([1, 1, 1])
 
-    finished = src_mask.new_zeros((batch_size)).byte()
+    # indices of the sentences that are still decoded, finished sentences
+    # are removed from the decoder inputs and the cache
+    active = np.arange(batch_size)
+    active_steps = []
+    output = []
+
+    # self-attention keys and values of previous steps,
+    # and pre-computed projections of the encoder output
+    with torch.no_grad():
+        cache = decoder.init_cache(encoder_output=encoder_output)
 
     for _ in range(max_output_length):
 
-        trg_embed = embed(ys)  # embed the previous tokens
+        # embed only the latest token, the previous ones are cached
+        trg_embed = embed(next_word.unsqueeze(-1))
 
         # pylint: disable=unused-variable
         with torch.no_grad():
@@ -151,38 +190,100 @@ def transformer_greedy(
                 src_mask=src_mask,
                 unroll_steps=None,
                 hidden=None,
-                trg_mask=trg_mask
+                trg_mask=trg_mask,
+                cache=cache
             )
 
             logits = logits[:, -1]
             _, next_word = torch.max(logits, dim=1)
             next_word = next_word.data
-            ys = torch.cat([ys, next_word.unsqueeze(-1)], dim=1)
 
-        # check if previous symbol was <eos>
-        is_eos = torch.eq(next_word, eos_index)
-        finished += is_eos
+        words = next_word.cpu().numpy()
+        active_steps.append(active)
+        output.append(words)
+
+        # remove the sentences that reached <eos>
+        non_finished = np.flatnonzero(words != eos_index)
         # stop predicting if <eos> reached for all elements in batch
-        if (finished >= 1).sum() == batch_size:
+        if len(non_finished) == 0:
             break
+        if len(non_finished) < len(active):
+            active = active[non_finished]
+            select_indices = torch.from_numpy(non_finished).to(
+                next_word.device)
+            next_word = next_word.index_select(0, select_indices)
+            encoder_output = encoder_output.index_select(0, select_indices)
+            src_mask = src_mask.index_select(0, select_indices)
+            for layer_cache in cache:
+                for key in layer_cache:
+                    layer_cache[key] = layer_cache[key].index_select(
+                        0, select_indices)
+
+    return _stack_steps(active_steps, output, batch_size,
+                        fill_value=eos_index), None
+
+
+def _stack_steps(active_steps: list, step_outputs: list, batch_size: int,
+                 fill_value) -> np.array:
+    """
+    Stack the outputs of greedy decoding steps in which only the
+    non-finished sentences were decoded.
+
+    :param active_steps: for every step, indices of the decoded sentences
+    :param step_outputs: for every step, outputs of the decoded sentences
+        (arrays with the sentences in the first dimension)
+    :param batch_size: number of sentences in the batch
+    :param fill_value: output for the steps after a sentence was finished
+    :return: array with shape (batch_size, steps, ...)
+    """
+    first = step_outputs[0]
+    stacked = np.full((batch_size, len(step_outputs)) + first.shape[1:],
+                      fill_value, dtype=first.dtype)
+    for t, (active, step_output) in enumerate(zip(active_steps,
+                                                  step_outputs)):
+        stacked[active, t] = step_output
+    return stacked
 
-    ys = ys[:, 1:]  # remove BOS-symbol
-    return ys.detach().cpu().numpy(), None
 
+def _stable_descending_order(scores: Tensor) -> Tensor:
+    """
+    Sort the rows of a small score matrix in descending order, keeping equal
+    scores in their original order (`Tensor.sort(stable=True)` needs
+    torch>=1.9). Every score is ranked by the number of scores that come
+    before it: higher scores and equal scores at earlier positions.
 
-# pylint: disable=too-many-statements,too-many-branches
+    :param scores: scores with shape (batch_size, n)
+    :return: indices that sort every row, shape (batch_size, n)
+    """
+    n = scores.size(1)
+    # [b, i, j]: whether score j comes before score i
+    higher = scores.unsqueeze(1) > scores.unsqueeze(2)
+    earlier = torch.ones(n, n, dtype=torch.bool,
+                         device=scores.device).tril(-1)
+    equal_earlier = (scores.unsqueeze(1) == scores.unsqueeze(2)) & earlier
+    rank = (higher | equal_earlier).sum(-1)
+    # the ranks are unique, so any sort is deterministic
+    return rank.argsort(dim=1)
+
+
+# pylint: disable=too-many-statements,too-many-branches,too-many-arguments
 def beam_search(
         decoder: Decoder,
         size: int,
         bos_index: int, eos_index: int, pad_index: int,
         encoder_output: Tensor, encoder_hidden: Tensor,
         src_mask: Tensor, max_output_length: int, alpha: float,
-        embed: Embeddings, n_best: int = 1) -> (np.array, np.array):
+        embed: Embeddings, n_best: int = 1,
+        early_stopping: bool = False) -> (np.array, np.array):
     """
     Beam search with size k.
     Inspired by OpenNMT-py, adapted for Transformer.
 
     In each decoding step, find the k most likely partial hypotheses.
+    An element of the batch is finished when its top hypothesis ends, or,
+    with `early_stopping`, as soon as none of its unfinished hypotheses can
+    get a better score than the n_best finished ones. Early stopping does
+    not change the results.
 
     :param decoder:
     :param size: size of the beam
@@ -196,6 +297,8 @@ def beam_search(
     :param alpha: `alpha` factor for length penalty
     :param embed:
     :param n_best: return this many hypotheses, <= beam (currently only 1)
+    :param early_stopping: stop decoding an element of the batch when its
+        unfinished hypotheses cannot beat the finished ones
     :return:
         - stacked_output: output hypotheses (2d array of indices),
         - stacked_attention_scores: attention scores (3d array)
@@ -215,6 +318,15 @@ def beam_search(
     else:
         hidden = None
 
+    # Transformer only: create target mask and cache for incremental decoding
+    # (with projected encoder states, computed once before tiling)
+    if transformer:
+        trg_mask = src_mask.new_ones([1, 1, 1])  # transformer only
+        cache = decoder.init_cache(encoder_output=encoder_output)
+    else:
+        trg_mask = None
+        cache = None
+
     # tile encoder states and decoder initial states beam_size times
     if hidden is not None:
         hidden = tile(hidden, size, dim=1)  # layers x batch*k x dec_hidden_size
@@ -223,11 +335,12 @@ def beam_search(
                           dim=0)  # batch*k x src_len x enc_hidden_size
     src_mask = tile(src_mask, size, dim=0)  # batch*k x 1 x src_len
 
-    # Transformer only: create target mask
-    if transformer:
-        trg_mask = src_mask.new_ones([1, 1, 1])  # transformer only
-    else:
-        trg_mask = None
+    if cache is not None:
+        for layer_cache in cache:
+            for key in layer_cache:
+                # batch*k x heads x src_len x head_size
+                layer_cache[key] = tile(layer_cache[key].contiguous(), size,
+                                        dim=0)
 
     # numbering elements in the batch
     batch_offset = torch.arange(
@@ -254,25 +367,22 @@ def beam_search(
     topk_log_probs = torch.zeros(batch_size, size, device=encoder_output.device)
     topk_log_probs[:, 1:] = float("-inf")
 
-    # Structure that holds finished hypotheses.
-    hypotheses = [[] for _ in range(batch_size)]
-
-    results = {
-        "predictions": [[] for _ in range(batch_size)],
-        "scores": [[] for _ in range(batch_size)],
-        "gold_score": [0] * batch_size,
-    }
+    # The n_best finished hypotheses for each element in the batch, ordered by
+    # score (of equal scores, the one that finished first comes first),
+    # padded to max_output_length
+    best_scores = torch.full([batch_size, n_best], float("-inf"),
+                             device=encoder_output.device)
+    best_hyps = torch.full([batch_size, n_best, max_output_length], pad_index,
+                           dtype=torch.long, device=encoder_output.device)
+    best_lengths = torch.zeros([batch_size, n_best], dtype=torch.long,
+                               device=encoder_output.device)
 
     for step in range(max_output_length):
 
-        # This decides which part of the predicted sentence we feed to the
-        # decoder to make the next prediction.
-        # For Transformer, we feed the complete predicted sentence so far.
-        # For Recurrent models, only feed the previous target word prediction
-        if transformer:  # Transformer
-            decoder_input = alive_seq  # complete prediction so far
-        else:  # Recurrent
-            decoder_input = alive_seq[:, -1].view(-1, 1)  # only the last word
+        # We only feed the previous target word prediction to the decoder.
+        # Recurrent models keep track of the history in their hidden state,
+        # the Transformer in the cached keys and values of previous steps.
+        decoder_input = alive_seq[:, -1].view(-1, 1)  # only the last word
 
         # expand current hypotheses
         # decode one single step
@@ -287,13 +397,13 @@ def beam_search(
             hidden=hidden,
             prev_att_vector=att_vectors,
             unroll_steps=1,
-            trg_mask=trg_mask  # subsequent mask for Transformer only
+            trg_mask=trg_mask,  # subsequent mask for Transformer only
+            cache=cache  # Transformer only
         )
 
-        # For the Transformer we made predictions for all time steps up to
-        # this point, so we only want to know about the last time step.
+        # For the Transformer we only fed the last time step.
         if transformer:
-            logits = logits[:, -1]  # keep only the last time step
+            logits = logits[:, -1]  # remove the time dimension
             hidden = None           # we don't need to keep it for transformer
 
         # batch*k x trg_vocab
@@ -321,7 +431,8 @@ def beam_search(
             topk_log_probs = topk_scores.clone()
 
         # reconstruct beam origin and true word ids from flattened order
-        topk_beam_index = topk_ids.div(decoder.output_size)
+        topk_beam_index = topk_ids.div(decoder.output_size,
+                                       rounding_mode="floor")
         topk_ids = topk_ids.fmod(decoder.output_size)
 
         # map beam_index to batch_index in the flat representation
@@ -344,32 +455,47 @@ def beam_search(
         # save finished hypotheses
         if is_finished.any():
             predictions = alive_seq.view(-1, size, alive_seq.size(-1))
-            for i in range(is_finished.size(0)):
-                b = batch_offset[i]
-                if end_condition[i]:
-                    is_finished[i].fill_(1)
-                finished_hyp = is_finished[i].nonzero().view(-1)
-                # store finished hypotheses for this batch
-                for j in finished_hyp:
-                    # Check if the prediction has more than one EOS.
-                    # If it has more than one EOS, it means that the
-                    # prediction should have already been added to
-                    # the hypotheses, so you don't have to add them again.
-                    if (predictions[i, j, 1:] == eos_index).nonzero().numel() \
-                            < 2:
-                        # ignore start_token
-                        hypotheses[b].append(
-                            (topk_scores[i, j], predictions[i, j, 1:])
-                        )
-                # if the batch reached the end, save the n_best hypotheses
-                if end_condition[i]:
-                    best_hyp = sorted(
-                        hypotheses[b], key=lambda x: x[0], reverse=True)
-                    for n, (score, pred) in enumerate(best_hyp):
-                        if n >= n_best:
-                            break
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
+            # if the batch reached the end, all its hypotheses are finished
+            is_finished |= end_condition.unsqueeze(1)
+            # If a prediction has more than one EOS, it has already been
+            # added to the hypotheses, so it is not added again.
+            is_new = is_finished & \
+                predictions[:, :, 1:].eq(eos_index).sum(-1).lt(2)
+            # merge the new hypotheses (ignoring start_token) into the best
+            # ones, and keep the n_best
+            new_hyps = predictions.new_full(
+                [predictions.size(0), size, max_output_length], pad_index)
+            new_hyps[:, :, :step + 1] = predictions[:, :, 1:]
+            scores = torch.cat(
+                [best_scores[batch_offset],
+                 topk_scores.masked_fill(~is_new, float("-inf"))], dim=1)
+            hyps = torch.cat([best_hyps[batch_offset], new_hyps], dim=1)
+            lengths = torch.cat(
+                [best_lengths[batch_offset],
+                 best_lengths.new_full([predictions.size(0), size],
+                                       step + 1)], dim=1)
+            order = _stable_descending_order(scores)[:, :n_best]
+            best_scores[batch_offset] = scores.gather(1, order)
+            best_lengths[batch_offset] = lengths.gather(1, order)
+            best_hyps[batch_offset] = hyps.gather(
+                1, order.unsqueeze(-1).expand(-1, -1, max_output_length))
+
+        if early_stopping and step + 1 < max_output_length:
+            # Log probs only decrease, so an alive hypothesis can at best
+            # finish with its current log prob under the most favourable
+            # length penalty. If that cannot beat the n_best finished
+            # hypotheses, the batch is done.
+            max_length_penalty = 1.0
+            if alpha > -1:
+                max_length_penalty = max(
+                    ((5.0 + (step + 2)) / 6.0) ** alpha,
+                    ((5.0 + max_output_length) / 6.0) ** alpha)
+            best_alive_scores = (topk_log_probs / max_length_penalty) \
+                .masked_fill(is_finished, float("-inf")).max(dim=1)[0]
+            end_condition |= best_alive_scores.le(
+                best_scores[batch_offset, -1])
+
+        if end_condition.any():
             non_finished = end_condition.eq(False).nonzero().view(-1)
             # if all sentences are translated, no need to go further
             # pylint: disable=len-as-condition
@@ -379,8 +505,8 @@ def beam_search(
             topk_log_probs = topk_log_probs.index_select(0, non_finished)
             batch_index = batch_index.index_select(0, non_finished)
             batch_offset = batch_offset.index_select(0, non_finished)
-            alive_seq = predictions.index_select(0, non_finished) \
-                .view(-1, alive_seq.size(-1))
+            alive_seq = alive_seq.view(-1, size, alive_seq.size(-1)) \
+                .index_select(0, non_finished).view(-1, alive_seq.size(-1))
 
         # reorder indices, outputs and masks
         select_indices = batch_index.view(-1)
@@ -401,19 +527,17 @@ def beam_search(
         if att_vectors is not None:
             att_vectors = att_vectors.index_select(0, select_indices)
 
-    def pad_and_stack_hyps(hyps, pad_value):
-        filled = np.ones((len(hyps), max([h.shape[0] for h in hyps])),
-                         dtype=int) * pad_value
-        for j, h in enumerate(hyps):
-            for k, i in enumerate(h):
-                filled[j, k] = i
-        return filled
+        if cache is not None:
+            # for Transformers, cached keys and values follow their beams,
+            # projected encoder states are pruned like `encoder_output`
+            for layer_cache in cache:
+                for key in layer_cache:
+                    layer_cache[key] = layer_cache[key].index_select(
+                        0, select_indices)
 
-    # from results to stacked outputs
+    # from the best hypotheses to stacked outputs
     assert n_best == 1
     # only works for n_best=1 for now
-    final_outputs = pad_and_stack_hyps([r[0].cpu().numpy() for r in
-                                        results["predictions"]],
-                                       pad_value=pad_index)
+    final_outputs = best_hyps[:, 0, :int(best_lengths[:, 0].max())]
 
-    return final_outputs, None
+    return final_outputs.cpu().numpy(), None
@@ -0,0 +1,238 @@
+# coding: utf-8
+"""
+Translation server with dynamic micro-batching
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from logging import Logger
+from socketserver import ThreadingMixIn
+from typing import Callable, List
+
+from joeynmt.helpers import load_config, make_logger
+from joeynmt.prediction import Translator
+
+
+class MicroBatcher:
+    """
+    Collects concurrent translation requests and translates them together.
+
+    A worker thread waits for a request, then keeps collecting further
+    requests for at most `max_wait` seconds or until `max_tokens` source
+    tokens are pending. All collected sentences are translated in one call,
+    where they are batched by length, and every request gets its own
+    translations back.
+    """
+
+    def __init__(self, translate_fn: Callable[[List[str]], List[str]],
+                 max_wait: float = 0.01, max_tokens: int = 4096) -> None:
+        """
+        Create a micro-batcher and start its worker thread.
+
+        :param translate_fn: function translating a list of sentences,
+            e.g. `Translator.translate`
+        :param max_wait: maximum time (in seconds) to wait for further
+            requests after the first one
+        :param max_tokens: translate as soon as this many source tokens
+            (whitespace-separated) are pending
+        """
+        self.translate_fn = translate_fn
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.requests = queue.Queue()
+        # no requests are accepted after `stop`, so that none is queued
+        # behind the stop signal of the worker thread
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentences: List[str]) -> Future:
+        """
+        Request translations without waiting for them.
+
+        :param sentences: source sentences
+        :return: future for the list of translations, which fails with a
+            RuntimeError if the batcher is stopped
+        """
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                future.set_exception(
+                    RuntimeError("The translation server is shutting down."))
+            else:
+                self.requests.put((sentences, future))
+        return future
+
+    def translate(self, sentences: List[str]) -> List[str]:
+        """
+        Translate sentences together with other pending requests.
+
+        :param sentences: source sentences
+        :return: translations in the order of `sentences`
+        """
+        return self.submit(sentences).result()
+
+    def stop(self) -> None:
+        """
+        Stop accepting requests, translate the pending ones and stop the
+        worker thread.
+        """
+        with self.lock:
+            if not self.stopped:
+                self.stopped = True
+                self.requests.put(None)
+        self.thread.join()
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            request = self.requests.get()
+            if request is None:
+                return
+            pending = [request]
+            n_tokens = _count_tokens(request[0])
+            deadline = time.perf_counter() + self.max_wait
+            # collect more requests until the time or token budget is used
+            while n_tokens < self.max_tokens:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                pending.append(request)
+                n_tokens += _count_tokens(request[0])
+            self._translate(pending)
+
+    def _translate(self, pending: List[tuple]) -> None:
+        """
+        Translate the sentences of all pending requests at once and
+        distribute the translations.
+
+        :param pending: list of sentences and futures of the requests
+        """
+        sentences = [sentence for request_sentences, _ in pending
+                     for sentence in request_sentences]
+        try:
+            translations = self.translate_fn(sentences)
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        start = 0
+        for request_sentences, future in pending:
+            future.set_result(
+                translations[start:start + len(request_sentences)])
+            start += len(request_sentences)
+
+
+def _count_tokens(sentences: List[str]) -> int:
+    return sum(len(sentence.split()) for sentence in sentences)
+
+
+class TranslationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles translation requests: POST a JSON object with a list of
+    pre-processed source sentences, e.g. ``{"sentences": ["Hallo Welt"]}``,
+    to ``/translate`` and receive ``{"translations": [...]}``.
+    """
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.path.rstrip("/") != "/translate":
+            self._respond(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            sentences = json.loads(self.rfile.read(length).decode("utf-8"))[
+                "sentences"]
+            if not isinstance(sentences, list) or not all(
+                    isinstance(sentence, str) for sentence in sentences):
+                raise ValueError("sentences must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond(400, {"error": "Invalid request: {}".format(e)})
+            return
+        try:
+            translations = self.server.batcher.translate(sentences)
+        except Exception as e:  # pylint: disable=broad-except
+            self.server.logger.exception("Translation failed.")
+            self._respond(500, {"error": str(e)})
+            return
+        self._respond(200, {"translations": translations})
+
+    def _respond(self, status: int, content: dict) -> None:
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        self.server.logger.debug(format, *args)
+
+
+class TranslationServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that handles every connection in its own thread,
+    so that concurrent requests can be batched by the `MicroBatcher`.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, batcher: MicroBatcher,
+                 logger: Logger = None) -> None:
+        """
+        Create a translation server.
+
+        :param address: host and port to listen on (port 0: any free port)
+        :param batcher: micro-batcher translating the requests
+        :param logger: logger for requests and errors
+        """
+        super().__init__(address, TranslationRequestHandler)
+        self.batcher = batcher
+        self.logger = logger if logger is not None \
+            else logging.getLogger(__name__)
+
+
+def serve(cfg_file, ckpt: str = None) -> None:
+    """
+    Serve translations of a model over HTTP, as configured in the "serving"
+    section of the configuration. Concurrent requests are translated
+    together in batches (see `MicroBatcher`).
+
+    :param cfg_file: path to configuration file
+    :param ckpt: path to checkpoint to load,
+        default: latest checkpoint in the model directory
+    """
+    logger = make_logger()
+    cfg = load_config(cfg_file)
+    serving_cfg = cfg.get("serving", {})
+
+    translator = Translator.from_config(cfg, ckpt=ckpt)
+    batcher = MicroBatcher(
+        translator.translate,
+        max_wait=serving_cfg.get("max_wait_ms", 10) / 1000,
+        max_tokens=serving_cfg.get("max_batch_tokens", 4096))
+    server = TranslationServer(
+        (serving_cfg.get("host", "127.0.0.1"), serving_cfg.get("port", 8000)),
+        batcher, logger=logger)
+    logger.info("Serving translations on http://%s:%d/translate",
+                *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+        if translator.cache is not None:
+            logger.info("Translation cache: %s", translator.cache.stats())
+        translator.close()
@@ -0,0 +1,242 @@
+# coding: utf-8
+"""
+Streaming module: reads training data lazily from text files
+"""
+import glob
+import itertools
+import math
+import os
+import random
+from typing import List, Callable, Iterable, Tuple
+
+import numpy as np
+from torchtext import data
+
+from joeynmt.batching import split_into_batches, create_batch
+from joeynmt.constants import DEFAULT_UNK_ID
+
+
+def read_parallel(path: str, exts: tuple,
+                   tok_fun: Callable[[str], List[str]]) \
+        -> Iterable[Tuple[List[str], List[str]]]:
+    """
+    Stream over the non-empty sentence pairs of a parallel corpus,
+    reading one line at a time.
+
+    :param path: Common prefix of paths to the data files.
+    :param exts: A tuple containing the extension to path for each language.
+    :param tok_fun: tokenization function
+    :return: generator of source and target tokens
+    """
+    with open(os.path.expanduser(path + exts[0]),
+              encoding="utf-8") as src_file, \
+            open(os.path.expanduser(path + exts[1]),
+                 encoding="utf-8") as trg_file:
+        for src_line, trg_line in zip(src_file, trg_file):
+            src_line, trg_line = src_line.strip(), trg_line.strip()
+            if src_line != '' and trg_line != '':
+                yield tok_fun(src_line), tok_fun(trg_line)
+
+
+class StreamingDataset:
+    """
+    Defines a parallel dataset that is read lazily from (possibly sharded)
+    text files, so that the corpus does not have to fit in memory.
+    The examples are only tokenized and numericalized when iterating over
+    batches (see `StreamingIterator`).
+    """
+
+    def __init__(self, path: str, exts: tuple,
+                 tok_fun: Callable[[str], List[str]],
+                 max_sent_length: int = None,
+                 buffer_size: int = 100000) -> None:
+        """
+        Create a streaming dataset.
+
+        :param path: Common prefix of paths to the data files. May contain
+            wildcards to match several shards, e.g. "data/train.*" for
+            "data/train.00.de", "data/train.01.de", ...
+        :param exts: A tuple containing the extension to path for each
+            language.
+        :param tok_fun: tokenization function
+        :param max_sent_length: filter out longer examples (src or trg)
+        :param buffer_size: number of examples held in the shuffle buffer
+        """
+        self.exts = exts
+        self.tok_fun = tok_fun
+        self.max_sent_length = max_sent_length
+        self.buffer_size = buffer_size
+        if glob.has_magic(path):
+            files = glob.glob(os.path.expanduser(path + exts[0]))
+            self.shards = [f[:-len(exts[0])] for f in sorted(files)]
+        else:
+            self.shards = [path]
+        if not self.shards:
+            raise FileNotFoundError("No training data found for {}{}."
+                                    .format(path, exts[0]))
+        # set once the vocabularies are built
+        self.src_vocab = None
+        self.trg_vocab = None
+        # counted while building the vocabularies (unless they are loaded)
+        self.num_examples = None
+
+    def token_pairs(self, shards: List[str] = None) \
+            -> Iterable[Tuple[List[str], List[str]]]:
+        """
+        Stream over the (filtered) examples.
+
+        :param shards: read these shards in this order, default: all
+        :return: generator of source and target tokens
+        """
+        for shard in shards if shards is not None else self.shards:
+            for src_tokens, trg_tokens in read_parallel(shard, self.exts,
+                                                         self.tok_fun):
+                if self.max_sent_length is None or \
+                        (len(src_tokens) <= self.max_sent_length
+                         and len(trg_tokens) <= self.max_sent_length):
+                    yield src_tokens, trg_tokens
+
+    def __len__(self) -> int:
+        """
+        Number of examples, if they were counted while building the
+        vocabularies. The data is not read again to count them.
+        """
+        if self.num_examples is None:
+            raise TypeError("The number of streamed examples is unknown.")
+        return self.num_examples
+
+    def __getitem__(self, i: int) -> data.Example:
+        """
+        Get the i-th example with tokens by streaming over the data up to it
+        (slow for large i, e.g. for logging the first example).
+
+        :param i: position in the dataset
+        :return: example with `src` and `trg` tokens
+        """
+        token_pairs = self.token_pairs()
+        try:
+            for src_tokens, trg_tokens in itertools.islice(token_pairs, i,
+                                                           None):
+                example = data.Example()
+                example.src = src_tokens
+                example.trg = trg_tokens
+                return example
+        finally:
+            # close the files
+            token_pairs.close()
+        raise IndexError("Dataset index out of range.")
+
+
+class StreamingIterator:
+    """
+    Iterator over batches of a `StreamingDataset`.
+
+    During training, the shards are read in random order and examples pass
+    through a bounded shuffle buffer. Batches are then formed like in
+    torchtext's `BucketIterator`: a rolling pool of examples is sorted by
+    source length, split into batches and the batches are shuffled.
+    Memory is bounded by the buffer and pool size, not the corpus size.
+    """
+
+    def __init__(self, dataset: StreamingDataset, batch_size: int,
+                 batch_type: str = "sentence", train: bool = False,
+                 shuffle: bool = False) -> None:
+        """
+        Create an iterator over a streaming dataset.
+
+        :param dataset: streaming dataset
+        :param batch_size: size of the batches the iterator prepares
+        :param batch_type: measure batch size by sentence count or by token
+            count
+        :param train: whether it's training time, when turned off,
+            bucketing, sorting within batches and shuffling is disabled
+        :param shuffle: whether to shuffle the data before each epoch
+        """
+        self.dataset = dataset
+        self.train = train
+        self.shuffle = shuffle and train
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+
+    def _examples(self) -> Iterable[Tuple[np.array, np.array]]:
+        """
+        Stream over the numericalized examples, shuffled within a bounded
+        buffer if `self.shuffle`.
+
+        :return: generator of source and target ids
+        """
+        shards = list(self.dataset.shards)
+        if self.shuffle:
+            random.shuffle(shards)
+        src_stoi = self.dataset.src_vocab.stoi
+        trg_stoi = self.dataset.trg_vocab.stoi
+        buffer = []
+        for src_tokens, trg_tokens in self.dataset.token_pairs(shards):
+            example = (
+                np.asarray([src_stoi.get(t, DEFAULT_UNK_ID())
+                            for t in src_tokens], dtype=np.int64),
+                np.asarray([trg_stoi.get(t, DEFAULT_UNK_ID())
+                            for t in trg_tokens], dtype=np.int64))
+            if not self.shuffle:
+                yield example
+            elif len(buffer) < self.dataset.buffer_size:
+                buffer.append(example)
+            else:
+                # emit a random example from the buffer and replace it
+                j = random.randrange(len(buffer))
+                yield buffer[j]
+                buffer[j] = example
+        random.shuffle(buffer)
+        yield from buffer
+
+    def _pool_batches(self, pool: List[Tuple[np.array, np.array]]) \
+            -> List[List[Tuple[np.array, np.array]]]:
+        """
+        Split a pool of examples into batches, sorted by length for training.
+
+        :param pool: source and target ids of the examples
+        :return: list of batches of examples
+        """
+        if self.train:
+            pool = sorted(pool, key=lambda ex: len(ex[0]))
+        positions = split_into_batches(
+            src_lengths=np.asarray([len(ex[0]) for ex in pool]),
+            trg_lengths=np.asarray([len(ex[1]) for ex in pool]),
+            batch_size=self.batch_size, batch_type=self.batch_type)
+        batches = [[pool[i] for i in batch_positions]
+                   for batch_positions in positions]
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __len__(self) -> int:
+        if self.batch_type == "token":
+            # token batches depend on which examples share a pool
+            raise TypeError("The number of token batches of a streaming "
+                            "dataset is only known after iterating.")
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        pool_size = self.batch_size * 100
+        pool = []
+        pool_tokens = 0
+        for example in self._examples():
+            pool.append(example)
+            pool_tokens += max(len(example[0]), len(example[1]) + 2)
+            filled = pool_tokens if self.batch_type == "token" else len(pool)
+            if filled >= pool_size:
+                for batch in self._pool_batches(pool):
+                    yield self._to_batch(batch)
+                pool = []
+                pool_tokens = 0
+        if pool:
+            for batch in self._pool_batches(pool):
+                yield self._to_batch(batch)
+
+    def _to_batch(self, examples: List[Tuple[np.array, np.array]]) \
+            -> data.Batch:
+        src_ids, trg_ids = zip(*examples)
+        return create_batch(src_ids=list(src_ids), trg_ids=list(trg_ids),
+                            src_vocab=self.dataset.src_vocab,
+                            trg_vocab=self.dataset.trg_vocab,
+                            sort_within_batch=self.train)
@@ -7,11 +7,11 @@ Training module
 import argparse
 import time
 import shutil
-from typing import List
+from typing import List, Optional, Iterable, Tuple
 import os
 import queue
+from concurrent.futures import ThreadPoolExecutor
 
-import math
 import numpy as np
 
 import torch
@@ -24,14 +24,17 @@ from joeynmt.model import build_model
 from joeynmt.batch import Batch
 from joeynmt.helpers import log_data_info, load_config, log_cfg, \
     store_attention_plots, load_checkpoint, make_model_dir, \
-    make_logger, set_seed, symlink_update, ConfigurationError
+    make_logger, set_seed, symlink_update, copy_to_cpu, ConfigurationError
 from joeynmt.model import Model
 from joeynmt.prediction import validate_on_data
 from joeynmt.loss import XentLoss
+from joeynmt.profiling import StepProfiler, build_torch_profilers
 from joeynmt.data import load_data, make_data_iter
+from joeynmt.prefetch import PrefetchIterator
 from joeynmt.builders import build_optimizer, build_scheduler, \
     build_gradient_clipper
 from joeynmt.prediction import test
+from joeynmt.validation import ValidationWorker
 
 
 # pylint: disable=too-many-instance-attributes
@@ -47,6 +50,7 @@ class TrainManager:
         :param config: dictionary containing the training configurations
         """
         train_config = config["training"]
+        self.config = config
 
         # files for logging and storing
         self.model_dir = make_model_dir(train_config["model_dir"],
@@ -68,6 +72,7 @@ class TrainManager:
         self.label_smoothing = train_config.get("label_smoothing", 0.0)
         self.loss = XentLoss(pad_index=self.pad_index,
                              smoothing=self.label_smoothing)
+        self.loss_chunk_size = train_config.get("loss_chunk_size", None)
         self.normalization = train_config.get("normalization", "batch")
         if self.normalization not in ["batch", "tokens", "none"]:
             raise ConfigurationError("Invalid normalization option."
@@ -86,32 +91,21 @@ class TrainManager:
         self.log_valid_sents = train_config.get("print_valid_sents", [0, 1, 2])
         self.ckpt_queue = queue.Queue(
             maxsize=train_config.get("keep_last_ckpts", 5))
+        # write checkpoints in a background thread
+        self.ckpt_executor = ThreadPoolExecutor(max_workers=1) \
+            if train_config.get("async_checkpoint", False) else None
+        self.ckpt_future = None
+        # validate in separate processes while training continues
+        self.async_validation = train_config.get("async_validation", False)
+        self.validation_workers = train_config.get("validation_workers", 1)
+        self.max_pending_validations = train_config.get(
+            "max_pending_validations", 2)
+        self.validation_worker = None
         self.eval_metric = train_config.get("eval_metric", "bleu")
-        if self.eval_metric not in ['bleu',
-                                    'chrf',
-                                    'token_accuracy',
-                                    'sequence_accuracy']:
-            raise ConfigurationError("Invalid setting for 'eval_metric', "
-                                     "valid options: 'bleu', 'chrf', "
-                                     "'token_accuracy', 'sequence_accuracy'.")
         self.early_stopping_metric = train_config.get("early_stopping_metric",
                                                       "eval_metric")
-
-        # if we schedule after BLEU/chrf, we want to maximize it, else minimize
-        # early_stopping_metric decides on how to find the early stopping point:
-        # ckpts are written when there's a new high/low score for this metric
-        if self.early_stopping_metric in ["ppl", "loss"]:
-            self.minimize_metric = True
-        elif self.early_stopping_metric == "eval_metric":
-            if self.eval_metric in ["bleu", "chrf"]:
-                self.minimize_metric = False
-            # eval metric that has to get minimized (not yet implemented)
-            else:
-                self.minimize_metric = True
-        else:
-            raise ConfigurationError(
-                "Invalid setting for 'early_stopping_metric', "
-                "valid options: 'loss', 'ppl', 'eval_metric'.")
+        self.minimize_metric = _minimize_metric(self.eval_metric,
+                                                self.early_stopping_metric)
 
         # learning rate scheduling
         self.scheduler, self.scheduler_step_at = build_scheduler(
@@ -136,6 +130,9 @@ class TrainManager:
 
         self.batch_multiplier = train_config.get("batch_multiplier", 1)
         self.current_batch_multiplier = self.batch_multiplier
+        self.prefetch_batches = train_config.get("prefetch_batches", 0)
+        self.prefetch_workers = train_config.get("prefetch_workers", 1)
+        self.pin_memory = train_config.get("pin_memory", False)
 
         # generation
         self.max_output_length = train_config.get("max_output_length", None)
@@ -146,6 +143,16 @@ class TrainManager:
             self.model.cuda()
             self.loss.cuda()
 
+        # time the phases of training steps, summarized every logging_freq
+        self.profiler = StepProfiler(
+            enabled=train_config.get("profile_steps", False),
+            output_file="{}/step_profile.jsonl".format(self.model_dir),
+            tb_writer=self.tb_writer, use_cuda=self.use_cuda)
+        # torch.profiler for selected training steps and validation batches
+        self.train_profiler, self.valid_profiler = build_torch_profilers(
+            train_config.get("profiling", {}), model_dir=self.model_dir,
+            use_cuda=self.use_cuda)
+
         # initialize accumalted batch loss (needed for batch_multiplier)
         self.norm_batch_loss_accumulated = 0
         # initialize training statistics
@@ -172,29 +179,69 @@ class TrainManager:
                                       reset_scheduler=reset_scheduler,
                                       reset_optimizer=reset_optimizer)
 
-    def _save_checkpoint(self) -> None:
+    def _training_state(self) -> dict:
         """
-        Save the model's current parameters and the training state to a
-        checkpoint.
-
-        The training state contains the total number of training steps,
-        the total number of training tokens,
-        the best checkpoint score and iteration so far,
-        and optimizer and scheduler states.
+        The current training state, except for the best checkpoint score
+        and iteration: the total number of training steps, the total number
+        of training tokens, model parameters, optimizer and scheduler states.
 
+        :return: dictionary with the (uncopied) training state
         """
-        model_path = "{}/{}.ckpt".format(self.model_dir, self.steps)
-        state = {
+        return {
             "steps": self.steps,
             "total_tokens": self.total_tokens,
-            "best_ckpt_score": self.best_ckpt_score,
-            "best_ckpt_iteration": self.best_ckpt_iteration,
             "model_state": self.model.state_dict(),
             "optimizer_state": self.optimizer.state_dict(),
             "scheduler_state": self.scheduler.state_dict() if
             self.scheduler is not None else None,
         }
-        torch.save(state, model_path)
+
+    def _save_checkpoint(self, snapshot: dict = None) -> None:
+        """
+        Save the model's current parameters and the training state to a
+        checkpoint.
+
+        The training state contains the total number of training steps,
+        the total number of training tokens,
+        the best checkpoint score and iteration so far,
+        and optimizer and scheduler states.
+
+        With `async_checkpoint`, the state is copied to CPU memory and
+        written to file in a background thread, so that training continues.
+
+        :param snapshot: training state (see `_training_state`) of an
+            earlier step to save instead of the current one, e.g. of a
+            snapshot that was validated asynchronously
+        """
+        state = dict(self._training_state() if snapshot is None
+                     else snapshot,
+                     best_ckpt_score=self.best_ckpt_score,
+                     best_ckpt_iteration=self.best_ckpt_iteration)
+        with self.profiler.phase("checkpoint"):
+            if self.ckpt_executor is None:
+                self._write_checkpoint(state)
+            else:
+                # snapshot the state, since training continues to modify it
+                # (snapshots of earlier steps are already copies)
+                if snapshot is None:
+                    state = copy_to_cpu(state)
+                # write one checkpoint at a time (and report errors of last)
+                self._wait_for_checkpoint()
+                self.ckpt_future = self.ckpt_executor.submit(
+                    self._write_checkpoint, state)
+
+    def _write_checkpoint(self, state: dict) -> None:
+        """
+        Write a checkpoint to file, delete the oldest checkpoint if
+        `keep_last_ckpts` is exceeded and point `best.ckpt` to it.
+
+        Files are written under a temporary name and then renamed, so that
+        there are never incomplete checkpoints.
+
+        :param state: checkpoint (see `self._save_checkpoint`)
+        """
+        model_path = "{}/{}.ckpt".format(self.model_dir, state["steps"])
+        self._atomic_save(state, model_path)
         if self.ckpt_queue.full():
             to_delete = self.ckpt_queue.get()  # delete oldest ckpt
             try:
@@ -208,10 +255,26 @@ class TrainManager:
         best_path = "{}/best.ckpt".format(self.model_dir)
         try:
             # create/modify symbolic link for best checkpoint
-            symlink_update("{}.ckpt".format(self.steps), best_path)
+            symlink_update("{}.ckpt".format(state["steps"]), best_path)
         except OSError:
             # overwrite best.ckpt
-            torch.save(state, best_path)
+            self._atomic_save(state, best_path)
+
+    @staticmethod
+    def _atomic_save(state: dict, path: str) -> None:
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _wait_for_checkpoint(self) -> None:
+        """
+        Wait until the checkpoint that is written in the background
+        (if any) is complete.
+        """
+        if self.ckpt_future is not None:
+            # raises the exception of the background thread, if any
+            self.ckpt_future.result()
+            self.ckpt_future = None
 
     def init_from_checkpoint(self, path: str,
                              reset_best_ckpt: bool = False,
@@ -275,15 +338,19 @@ class TrainManager:
         :param train_data: training data
         :param valid_data: validation data
         """
-        train_iter = make_data_iter(train_data,
+        batch_iter = make_data_iter(train_data,
                                     batch_size=self.batch_size,
                                     batch_type=self.batch_type,
                                     train=True, shuffle=self.shuffle)
+        # create Batch objects (optionally ahead of time in the background)
+        train_iter = PrefetchIterator(batch_iter, pad_index=self.pad_index,
+                                      use_cuda=self.use_cuda,
+                                      pin_memory=self.pin_memory,
+                                      num_batches=self.prefetch_batches,
+                                      num_workers=self.prefetch_workers)
 
-        # For last batch in epoch batch_multiplier needs to be adjusted
-        # to fit the number of leftover training examples
-        leftover_batch_size = len(
-            train_data) % (self.batch_multiplier * self.batch_size)
+        if self.async_validation:
+            self._start_validation_worker()
 
         for epoch_no in range(self.epochs):
             self.logger.info("EPOCH %d", epoch_no + 1)
@@ -300,12 +367,13 @@ class TrainManager:
             self.current_batch_multiplier = self.batch_multiplier
             count = self.current_batch_multiplier - 1
             epoch_loss = 0
+            n_batches = _num_batches(train_iter)
 
-            for i, batch in enumerate(iter(train_iter)):
+            for i, (batch, last_batch) in enumerate(_mark_last(
+                    self.profiler.iterate(train_iter, "batch"))):
+                self.train_profiler.step(self.steps)
                 # reactivate training
                 self.model.train()
-                # create a Batch object from torchtext batch
-                batch = Batch(batch, self.pad_index, use_cuda=self.use_cuda)
 
                 # only update every batch_multiplier batches
                 # see https://medium.com/@davidlmorton/
@@ -313,14 +381,17 @@ class TrainManager:
                 # memory-6794e10db672
 
                 # Set current_batch_mutliplier to fit
-                # number of leftover examples for last batch in epoch
-                if self.batch_multiplier > 1 and i == len(train_iter) - \
-                        math.ceil(leftover_batch_size / self.batch_size):
-                    self.current_batch_multiplier = math.ceil(
-                        leftover_batch_size / self.batch_size)
-                    count = self.current_batch_multiplier - 1
-
-                update = count == 0
+                # number of leftover batches for last update in epoch
+                if self.batch_multiplier > 1 and n_batches is not None:
+                    leftover_batches = n_batches % self.batch_multiplier
+                    if leftover_batches > 0 and \
+                            i == n_batches - leftover_batches:
+                        self.current_batch_multiplier = leftover_batches
+                        count = self.current_batch_multiplier - 1
+
+                # update with the leftover batches at the end of the epoch
+                # if their number wasn't known in advance
+                update = count == 0 or last_batch
                 # print(count, update, self.steps)
                 batch_loss = self._train_batch(
                     batch, update=update, count=count)
@@ -354,93 +425,23 @@ class TrainManager:
                     start = time.time()
                     total_valid_duration = 0
                     start_tokens = self.total_tokens
+                    self.profiler.write(self.steps)
+
+                if self.async_validation and update:
+                    # process results of validations that finished meanwhile
+                    self._collect_validation_results(valid_data)
 
                 # validate on the entire dev set
                 if self.steps % self.validation_freq == 0 and update:
-                    valid_start_time = time.time()
-
-                    valid_score, valid_loss, valid_ppl, valid_sources, \
-                        valid_sources_raw, valid_references, valid_hypotheses, \
-                        valid_hypotheses_raw, valid_attention_scores = \
-                        validate_on_data(
-                            logger=self.logger,
-                            batch_size=self.eval_batch_size,
-                            data=valid_data,
-                            eval_metric=self.eval_metric,
-                            level=self.level, model=self.model,
-                            use_cuda=self.use_cuda,
-                            max_output_length=self.max_output_length,
-                            loss_function=self.loss,
-                            beam_size=1,  # greedy validations
-                            batch_type=self.eval_batch_type
-                        )
-
-                    self.tb_writer.add_scalar("valid/valid_loss",
-                                              valid_loss, self.steps)
-                    self.tb_writer.add_scalar("valid/valid_score",
-                                              valid_score, self.steps)
-                    self.tb_writer.add_scalar("valid/valid_ppl",
-                                              valid_ppl, self.steps)
-
-                    if self.early_stopping_metric == "loss":
-                        ckpt_score = valid_loss
-                    elif self.early_stopping_metric in ["ppl", "perplexity"]:
-                        ckpt_score = valid_ppl
-                    else:
-                        ckpt_score = valid_score
-
-                    new_best = False
-                    if self.is_best(ckpt_score):
-                        self.best_ckpt_score = ckpt_score
-                        self.best_ckpt_iteration = self.steps
-                        self.logger.info(
-                            'Hooray! New best validation result [%s]!',
-                            self.early_stopping_metric)
-                        if self.ckpt_queue.maxsize > 0:
-                            self.logger.info("Saving new checkpoint.")
-                            new_best = True
-                            self._save_checkpoint()
-
-                    if self.scheduler is not None \
-                            and self.scheduler_step_at == "validation":
-                        self.scheduler.step(ckpt_score)
-
-                    # append to validation report
-                    self._add_report(
-                        valid_score=valid_score, valid_loss=valid_loss,
-                        valid_ppl=valid_ppl, eval_metric=self.eval_metric,
-                        new_best=new_best)
-
-                    self._log_examples(
-                        sources_raw=[v for v in valid_sources_raw],
-                        sources=valid_sources,
-                        hypotheses_raw=valid_hypotheses_raw,
-                        hypotheses=valid_hypotheses,
-                        references=valid_references
-                    )
-
-                    valid_duration = time.time() - valid_start_time
-                    total_valid_duration += valid_duration
-                    self.logger.info(
-                        'Validation result (greedy) at epoch %3d, '
-                        'step %8d: %s: %6.2f, loss: %8.4f, ppl: %8.4f, '
-                        'duration: %.4fs', epoch_no + 1, self.steps,
-                        self.eval_metric, valid_score, valid_loss,
-                        valid_ppl, valid_duration)
-
-                    # store validation set outputs
-                    self._store_outputs(valid_hypotheses)
-
-                    # store attention plots for selected valid sentences
-                    if valid_attention_scores:
-                        store_attention_plots(
-                            attentions=valid_attention_scores,
-                            targets=valid_hypotheses_raw,
-                            sources=[s for s in valid_data.src],
-                            indices=self.log_valid_sents,
-                            output_prefix="{}/att.{}".format(
-                                self.model_dir, self.steps),
-                            tb_writer=self.tb_writer, steps=self.steps)
+                    with self.profiler.phase("validation"):
+                        if self.async_validation:
+                            # validate a snapshot in the worker, continue
+                            # training
+                            total_valid_duration += self._request_validation(
+                                valid_data, epoch_no)
+                        else:
+                            total_valid_duration += self._validate(
+                                valid_data, epoch_no)
 
                 if self.stop:
                     break
@@ -452,15 +453,221 @@ class TrainManager:
 
             self.logger.info('Epoch %3d: total training loss %.2f',
                              epoch_no + 1, epoch_loss)
+            padding_ratio = getattr(batch_iter, "padding_ratio", None)
+            if padding_ratio is not None:
+                self.logger.info('Epoch %3d: padding ratio %.4f',
+                                 epoch_no + 1, padding_ratio)
+                self.tb_writer.add_scalar("train/padding_ratio",
+                                          padding_ratio, epoch_no + 1)
         else:
             self.logger.info('Training ended after %3d epochs.', epoch_no + 1)
+
+        if self.async_validation:
+            # wait for the pending validations
+            self._collect_validation_results(valid_data, wait=True)
+            self._stop_validation_worker()
+
         self.logger.info('Best validation result (greedy) at step '
                          '%8d: %6.2f %s.', self.best_ckpt_iteration,
                          self.best_ckpt_score,
                          self.early_stopping_metric)
 
+        self.train_profiler.close()
+
+        # make sure that all checkpoints are written
+        self._wait_for_checkpoint()
+        if self.ckpt_executor is not None:
+            self.ckpt_executor.shutdown(wait=True)
+
         self.tb_writer.close()  # close Tensorboard writer
 
+    def _validate(self, valid_data: Dataset, epoch_no: int) -> float:
+        """
+        Validate the current model on the validation set.
+
+        :param valid_data: validation data
+        :param epoch_no: current epoch (starting from 0)
+        :return: duration of the validation in seconds
+        """
+        valid_start_time = time.time()
+
+        valid_results = validate_on_data(
+            logger=self.logger,
+            batch_size=self.eval_batch_size,
+            data=valid_data,
+            eval_metric=self.eval_metric,
+            level=self.level, model=self.model,
+            use_cuda=self.use_cuda,
+            max_output_length=self.max_output_length,
+            loss_function=self.loss,
+            beam_size=1,  # greedy validations
+            batch_type=self.eval_batch_type,
+            profiler=self.valid_profiler
+        )
+
+        valid_duration = time.time() - valid_start_time
+        self._process_validation_results(
+            valid_results, valid_data=valid_data, epoch_no=epoch_no,
+            steps=self.steps, duration=valid_duration)
+        return valid_duration
+
+    def _process_validation_results(self, valid_results: tuple,
+                                    valid_data: Dataset, epoch_no: int,
+                                    steps: int, duration: float,
+                                    snapshot: dict = None) -> None:
+        """
+        Report the validation results, save a checkpoint for a new best
+        result and step the scheduler.
+
+        :param valid_results: outputs of `validate_on_data`
+        :param valid_data: validation data
+        :param epoch_no: epoch (starting from 0) of the validated model
+        :param steps: training step of the validated model
+        :param duration: duration of the validation in seconds
+        :param snapshot: training state of the validated model, if it
+            differs from the current state (asynchronous validation)
+        """
+        valid_score, valid_loss, valid_ppl, valid_sources, \
+            valid_sources_raw, valid_references, valid_hypotheses, \
+            valid_hypotheses_raw, valid_attention_scores = valid_results
+
+        self.tb_writer.add_scalar("valid/valid_loss", valid_loss, steps)
+        self.tb_writer.add_scalar("valid/valid_score", valid_score, steps)
+        self.tb_writer.add_scalar("valid/valid_ppl", valid_ppl, steps)
+
+        if self.early_stopping_metric == "loss":
+            ckpt_score = valid_loss
+        elif self.early_stopping_metric in ["ppl", "perplexity"]:
+            ckpt_score = valid_ppl
+        else:
+            ckpt_score = valid_score
+
+        new_best = False
+        if self.is_best(ckpt_score):
+            self.best_ckpt_score = ckpt_score
+            self.best_ckpt_iteration = steps
+            self.logger.info(
+                'Hooray! New best validation result [%s]!',
+                self.early_stopping_metric)
+            if self.ckpt_queue.maxsize > 0:
+                self.logger.info("Saving new checkpoint.")
+                new_best = True
+                self._save_checkpoint(snapshot=snapshot)
+
+        if self.scheduler is not None \
+                and self.scheduler_step_at == "validation":
+            self.scheduler.step(ckpt_score)
+
+        # append to validation report
+        self._add_report(
+            valid_score=valid_score, valid_loss=valid_loss,
+            valid_ppl=valid_ppl, eval_metric=self.eval_metric,
+            new_best=new_best, steps=steps)
+
+        self._log_examples(
+            sources_raw=[v for v in valid_sources_raw],
+            sources=valid_sources,
+            hypotheses_raw=valid_hypotheses_raw,
+            hypotheses=valid_hypotheses,
+            references=valid_references
+        )
+
+        self.logger.info(
+            'Validation result (greedy) at epoch %3d, '
+            'step %8d: %s: %6.2f, loss: %8.4f, ppl: %8.4f, '
+            'duration: %.4fs', epoch_no + 1, steps,
+            self.eval_metric, valid_score, valid_loss,
+            valid_ppl, duration)
+
+        # store validation set outputs
+        self._store_outputs(valid_hypotheses, steps=steps)
+
+        # store attention plots for selected valid sentences
+        if valid_attention_scores:
+            store_attention_plots(
+                attentions=valid_attention_scores,
+                targets=valid_hypotheses_raw,
+                sources=[s for s in valid_data.src],
+                indices=self.log_valid_sents,
+                output_prefix="{}/att.{}".format(
+                    self.model_dir, steps),
+                tb_writer=self.tb_writer, steps=steps)
+
+    def _start_validation_worker(self) -> None:
+        """
+        Start the processes that validate snapshots of the model parameters
+        (see `ValidationWorker`).
+        """
+        self.validation_worker = ValidationWorker(
+            self.config, self.model.src_vocab.itos, self.model.trg_vocab.itos,
+            dict(batch_size=self.eval_batch_size,
+                 eval_metric=self.eval_metric, level=self.level,
+                 use_cuda=self.use_cuda,
+                 max_output_length=self.max_output_length,
+                 beam_size=1,  # greedy validations
+                 batch_type=self.eval_batch_type),
+            self.log_valid_sents, num_workers=self.validation_workers,
+            max_pending=self.max_pending_validations,
+            profiler=self.valid_profiler)
+
+    def _stop_validation_worker(self) -> None:
+        self.validation_worker.stop()
+        self.validation_worker = None
+
+    def _request_validation(self, valid_data: Dataset,
+                            epoch_no: int) -> float:
+        """
+        Send a snapshot of the current model parameters to the validation
+        worker. The results are processed once they arrive
+        (see `_collect_validation_results`). A copy of the rest of the
+        training state is kept until then, to checkpoint the validated step.
+        If `max_pending_validations` are in flight, this first waits for
+        the oldest one to finish.
+
+        :param valid_data: validation data
+        :param epoch_no: current epoch (starting from 0)
+        :return: time spent waiting for earlier validations in seconds
+        """
+        wait_start_time = time.time()
+        while self.validation_worker.full():
+            self._process_async_result(
+                self.validation_worker.result(wait=True), valid_data)
+        wait_duration = time.time() - wait_start_time
+        snapshot = copy_to_cpu(self._training_state())
+        model_state = snapshot.pop("model_state")
+        self.validation_worker.request(model_state, steps=self.steps,
+                                       epoch_no=epoch_no, train_state=snapshot)
+        return wait_duration
+
+    def _collect_validation_results(self, valid_data: Dataset,
+                                    wait: bool = False) -> None:
+        """
+        Process the results of the asynchronous validations that are
+        finished, in the order of the requests.
+
+        :param valid_data: validation data
+        :param wait: wait for all validations in flight to finish
+        """
+        result = self.validation_worker.result(wait=wait)
+        while result is not None:
+            self._process_async_result(result, valid_data)
+            result = self.validation_worker.result(wait=wait)
+
+    def _process_async_result(self, result: tuple,
+                              valid_data: Dataset) -> None:
+        """
+        Process the results of one asynchronous validation.
+
+        :param result: outputs of `ValidationWorker.result`
+        :param valid_data: validation data
+        """
+        steps, epoch_no, duration, valid_results, model_state, \
+            train_state = result
+        self._process_validation_results(
+            valid_results, valid_data=valid_data, epoch_no=epoch_no,
+            steps=steps, duration=duration,
+            snapshot=dict(train_state, model_state=model_state))
+
     def _train_batch(self, batch: Batch, update: bool = True,
                      count: int = 1) -> Tensor:
         """
@@ -468,11 +675,16 @@ class TrainManager:
 
         :param batch: training batch
         :param update: if False, only store gradient. if True also make update
+            (with fewer batches than `current_batch_multiplier` if `count`
+            is not 0, see `_rescale_leftover`)
         :param count: number of portions (batch_size) left before update
-        :return: loss for batch (sum)
+        :return: loss for batch (sum), accumulated over the batches of the
+            current update
         """
-        batch_loss = self.model.get_loss_for_batch(
-            batch=batch, loss_function=self.loss)
+        with self.profiler.phase("forward"):
+            batch_loss = self.model.get_loss_for_batch(
+                batch=batch, loss_function=self.loss,
+                chunk_size=self.loss_chunk_size)
 
         # normalize batch loss
         if self.normalization == "batch":
@@ -487,43 +699,70 @@ class TrainManager:
                 "or summation of loss 'none' implemented")
 
         norm_batch_loss = batch_loss / normalizer
+        if self.normalization != "none":
+            # average over the batches that are accumulated for one update
+            norm_batch_loss = norm_batch_loss / self.current_batch_multiplier
+
+        # accumulate gradients, so that the graph of this batch can be freed
+        # before the next batch (keeps memory constant for batch_multiplier)
+        with self.profiler.phase("backward"):
+            norm_batch_loss.backward()
+
+        if count == self.current_batch_multiplier - 1:
+            self.norm_batch_loss_accumulated = norm_batch_loss.detach()
+        else:
+            # accumulate loss of current batch_size * batch_multiplier loss
+            self.norm_batch_loss_accumulated = \
+                self.norm_batch_loss_accumulated + norm_batch_loss.detach()
 
         if update:
-            if self.current_batch_multiplier > 1:
-                norm_batch_loss = self.norm_batch_loss_accumulated + \
-                    norm_batch_loss
-                norm_batch_loss = norm_batch_loss / \
-                    self.current_batch_multiplier if \
-                    self.normalization != "none" else \
-                    norm_batch_loss
+            if count > 0:
+                self._rescale_leftover(self.current_batch_multiplier - count)
+            self._update()
 
-            norm_batch_loss.backward()
+        # increment token counter
+        self.total_tokens += batch.ntokens
 
-            if self.clip_grad_fun is not None:
-                # clip gradients (in-place)
+        return self.norm_batch_loss_accumulated
+
+    def _update(self) -> None:
+        """
+        Make a gradient step with the accumulated gradients.
+        """
+        if self.clip_grad_fun is not None:
+            # clip gradients (in-place)
+            with self.profiler.phase("clip_grad"):
                 self.clip_grad_fun(params=self.model.parameters())
 
-            # make gradient step
+        # make gradient step
+        with self.profiler.phase("optimizer"):
             self.optimizer.step()
             self.optimizer.zero_grad()
 
-            # increment step counter
-            self.steps += 1
-
-        else:
-            if count == self.current_batch_multiplier - 1:
-                self.norm_batch_loss_accumulated = norm_batch_loss
-            else:
-                # accumulate loss of current batch_size * batch_multiplier loss
-                self.norm_batch_loss_accumulated += norm_batch_loss
-        # increment token counter
-        self.total_tokens += batch.ntokens
+        # increment step counter
+        self.steps += 1
 
-        return norm_batch_loss
+    def _rescale_leftover(self, n_batches: int) -> None:
+        """
+        Rescale the accumulated gradients and loss of the last batches of an
+        epoch, when the number of batches wasn't known in advance
+        (see `_num_batches`) and they are fewer than
+        `current_batch_multiplier`. Their losses were averaged over
+        `current_batch_multiplier` batches, so they are rescaled to average
+        over `n_batches`.
+
+        :param n_batches: number of accumulated batches
+        """
+        if self.normalization != "none":
+            scale = self.current_batch_multiplier / n_batches
+            for param in self.model.parameters():
+                if param.grad is not None:
+                    param.grad.mul_(scale)
+            self.norm_batch_loss_accumulated *= scale
 
     def _add_report(self, valid_score: float, valid_ppl: float,
                     valid_loss: float, eval_metric: str,
-                    new_best: bool = False) -> None:
+                    new_best: bool = False, steps: int = None) -> None:
         """
         Append a one-line report to validation logging file.
 
@@ -532,6 +771,8 @@ class TrainManager:
         :param valid_loss: validation loss (sum over whole validation set)
         :param eval_metric: evaluation metric, e.g. "bleu"
         :param new_best: whether this is a new best model
+        :param steps: training step of the validated model,
+            default: current step
         """
         current_lr = -1
         # ignores other param groups for now
@@ -545,7 +786,8 @@ class TrainManager:
             opened_file.write(
                 "Steps: {}\tLoss: {:.5f}\tPPL: {:.5f}\t{}: {:.5f}\t"
                 "LR: {:.8f}\t{}\n".format(
-                    self.steps, valid_loss, valid_ppl, eval_metric,
+                    self.steps if steps is None else steps, valid_loss,
+                    valid_ppl, eval_metric,
                     valid_score, current_lr, "*" if new_best else ""))
 
     def _log_parameters_list(self) -> None:
@@ -594,19 +836,85 @@ class TrainManager:
             self.logger.info("\tReference:  %s", references[p])
             self.logger.info("\tHypothesis: %s", hypotheses[p])
 
-    def _store_outputs(self, hypotheses: List[str]) -> None:
+    def _store_outputs(self, hypotheses: List[str], steps: int = None) -> None:
         """
         Write current validation outputs to file in `self.model_dir.`
 
         :param hypotheses: list of strings
+        :param steps: training step of the validated model,
+            default: current step
         """
-        current_valid_output_file = "{}/{}.hyps".format(self.model_dir,
-                                                        self.steps)
+        current_valid_output_file = "{}/{}.hyps".format(
+            self.model_dir, self.steps if steps is None else steps)
         with open(current_valid_output_file, 'w') as opened_file:
             for hyp in hypotheses:
                 opened_file.write("{}\n".format(hyp))
 
 
+def _num_batches(data_iter) -> Optional[int]:
+    """
+    Number of batches of an iterator, if it is known before iterating.
+    For streamed token batches (and torchtext iterators with a
+    `batch_size_fn`) it is unknown.
+
+    :param data_iter: iterator over batches
+    :return: number of batches or None
+    """
+    try:
+        return len(data_iter)
+    except (TypeError, NotImplementedError):
+        return None
+
+
+def _mark_last(iterable: Iterable) -> Iterable[Tuple[object, bool]]:
+    """
+    Iterate and tell for every element whether it is the last one.
+    The next element is fetched ahead of time to find out.
+
+    :param iterable: iterable, e.g. over batches
+    :return: generator of elements and whether they are the last one
+    """
+    iterator = iter(iterable)
+    try:
+        current = next(iterator)
+    except StopIteration:
+        return
+    for element in iterator:
+        yield current, False
+        current = element
+    yield current, True
+
+
+def _minimize_metric(eval_metric: str, early_stopping_metric: str) -> bool:
+    """
+    Check the evaluation and early stopping metrics and decide whether
+    checkpoint scores are minimized.
+
+    :param eval_metric: evaluation metric
+    :param early_stopping_metric: metric that decides on the early stopping
+        point: checkpoints are written when there's a new high/low score
+    :return: True if lower scores are better
+    """
+    if eval_metric not in ['bleu',
+                           'chrf',
+                           'token_accuracy',
+                           'sequence_accuracy']:
+        raise ConfigurationError("Invalid setting for 'eval_metric', "
+                                 "valid options: 'bleu', 'chrf', "
+                                 "'token_accuracy', 'sequence_accuracy'.")
+
+    # if we schedule after BLEU/chrf, we want to maximize it, else minimize
+    if early_stopping_metric in ["ppl", "loss"]:
+        return True
+    if early_stopping_metric == "eval_metric":
+        # eval metrics other than BLEU/chrf have to get minimized
+        # (not yet implemented)
+        return eval_metric not in ["bleu", "chrf"]
+    raise ConfigurationError(
+        "Invalid setting for 'early_stopping_metric', "
+        "valid options: 'loss', 'ppl', 'eval_metric'.")
+
+
 def train(cfg_file: str) -> None:
     """
     Main training function. After training, also test on test data if given.
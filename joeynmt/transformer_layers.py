@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import math
+from typing import Optional
 import torch
 import torch.nn as nn
 from torch import Tensor
@@ -38,29 +39,70 @@ class MultiHeadedAttention(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, k: Tensor, v: Tensor, q: Tensor, mask: Tensor = None):
+    def compute_proj_keys_values(self, k: Tensor, v: Tensor) \
+            -> (Tensor, Tensor):
+        """
+        Project the keys and values and split them into heads.
+        Is efficient if pre-computed before receiving individual queries,
+        e.g. for the encoder states during decoding.
+
+        :param k: keys   [B, M, D] with M being the sentence length.
+        :param v: values [B, M, D]
+        :return: projected keys and values [B, num_heads, M, head_size]
+        """
+        batch_size = k.size(0)
+
+        k = self.k_layer(k)
+        v = self.v_layer(v)
+
+        k = k.view(batch_size, -1, self.num_heads,
+                   self.head_size).transpose(1, 2)
+        v = v.view(batch_size, -1, self.num_heads,
+                   self.head_size).transpose(1, 2)
+        return k, v
+
+    def forward(self, k: Tensor, v: Tensor, q: Tensor, mask: Tensor = None,
+                cache: Optional[dict] = None,
+                proj_keys_values: Optional[tuple] = None):
         """
         Computes multi-headed attention.
 
+        For incremental decoding, a `cache` dictionary can be given.
+        The projected keys and values of previous steps are stored there,
+        and the keys and values of the current step are appended to them,
+        so that `k`, `v` and `q` only need to hold the newest time steps.
+
         :param k: keys   [B, M, D] with M being the sentence length.
         :param v: values [B, M, D]
         :param q: query  [B, M, D]
         :param mask: optional mask [B, 1, M]
+        :param cache: optional dictionary holding the keys and values of
+            previous decoding steps (updated in place)
+        :param proj_keys_values: optional pre-computed projections of `k` and
+            `v` (see `self.compute_proj_keys_values`), if given, `k` and `v`
+            are not projected again
         :return:
         """
-        batch_size = k.size(0)
+        batch_size = q.size(0)
         num_heads = self.num_heads
 
         # project the queries (q), keys (k), and values (v)
-        k = self.k_layer(k)
-        v = self.v_layer(v)
+        # and reshape them for our computation to [batch_size, num_heads, ..]
+        if proj_keys_values is not None:
+            k, v = proj_keys_values
+        else:
+            k, v = self.compute_proj_keys_values(k, v)
         q = self.q_layer(q)
-
-        # reshape q, k, v for our computation to [batch_size, num_heads, ..]
-        k = k.view(batch_size, -1, num_heads, self.head_size).transpose(1, 2)
-        v = v.view(batch_size, -1, num_heads, self.head_size).transpose(1, 2)
         q = q.view(batch_size, -1, num_heads, self.head_size).transpose(1, 2)
 
+        # incremental decoding: attend to previous steps as well
+        if cache is not None:
+            if "keys" in cache:
+                k = torch.cat([cache["keys"], k], dim=2)
+                v = torch.cat([cache["values"], v], dim=2)
+            cache["keys"] = k
+            cache["values"] = v
+
         # compute scores
         q = q / math.sqrt(self.head_size)
 
@@ -149,14 +191,16 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
         self.dim = size
 
-    def forward(self, emb):
+    def forward(self, emb, offset: int = 0):
         """Embed inputs.
         Args:
             emb (FloatTensor): Sequence of word vectors
                 ``(seq_len, batch_size, self.dim)``
+            offset (int): position of the first time step in `emb`
+                (for incremental decoding)
         """
         # Add position encodings
-        return emb + self.pe[:, :emb.size(1)]
+        return emb + self.pe[:, offset:offset + emb.size(1)]
 
 
 class TransformerEncoderLayer(nn.Module):
@@ -249,7 +293,8 @@ class TransformerDecoderLayer(nn.Module):
                 x: Tensor = None,
                 memory: Tensor = None,
                 src_mask: Tensor = None,
-                trg_mask: Tensor = None) -> Tensor:
+                trg_mask: Tensor = None,
+                layer_cache: Optional[dict] = None) -> Tensor:
         """
         Forward pass of a single Transformer decoder layer.
 
@@ -257,16 +302,25 @@ class TransformerDecoderLayer(nn.Module):
         :param memory: source representations
         :param src_mask: source mask
         :param trg_mask: target mask (so as to not condition on future steps)
+        :param layer_cache: cache of this layer for incremental decoding,
+            optionally with pre-computed projections of `memory`
+            (see `TransformerDecoder.init_cache`)
         :return: output tensor
         """
         # decoder/target self-attention
         x_norm = self.x_layer_norm(x)
-        h1 = self.trg_trg_att(x_norm, x_norm, x_norm, mask=trg_mask)
+        h1 = self.trg_trg_att(x_norm, x_norm, x_norm, mask=trg_mask,
+                              cache=layer_cache)
         h1 = self.dropout(h1) + x
 
         # source-target attention
         h1_norm = self.dec_layer_norm(h1)
-        h2 = self.src_trg_att(memory, memory, h1_norm, mask=src_mask)
+        memory_keys_values = None
+        if layer_cache is not None and "memory_keys" in layer_cache:
+            memory_keys_values = (layer_cache["memory_keys"],
+                                  layer_cache["memory_values"])
+        h2 = self.src_trg_att(memory, memory, h1_norm, mask=src_mask,
+                              proj_keys_values=memory_keys_values)
 
         # final position-wise feed-forward layer
         o = self.feed_forward(self.dropout(h2) + h1)
@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""
+Validation of model snapshots in a separate process
+"""
+
+import time
+import queue
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+
+from joeynmt.model import build_model
+from joeynmt.helpers import make_logger
+from joeynmt.prediction import validate_on_data
+from joeynmt.loss import XentLoss
+from joeynmt.vocabulary import Vocabulary
+from joeynmt.data import load_eval_data
+from joeynmt.profiling import TorchProfiler
+
+
+class ValidationWorker:
+    """
+    Validates snapshots of the model parameters in separate processes
+    (see `_validation_worker`) while training continues.
+    Up to `max_pending` validations are in flight, their results are
+    returned in the order of the requests.
+    """
+
+    def __init__(self, config: dict, src_itos: List[str],
+                 trg_itos: List[str], validation_args: dict,
+                 log_valid_sents: List[int], num_workers: int = 1,
+                 max_pending: int = 1, profiler: TorchProfiler = None) \
+            -> None:
+        """
+        Start the validation processes.
+
+        :param config: configuration dictionary
+        :param src_itos: tokens of the source vocabulary
+        :param trg_itos: tokens of the target vocabulary
+        :param validation_args: arguments for `validate_on_data`
+        :param log_valid_sents: indices of the sentences to plot attention for
+        :param num_workers: number of validation processes
+        :param max_pending: maximum number of validations in flight
+        :param profiler: profiles batches of the first validation of the
+            first process with torch.profiler (optional)
+        """
+        context = torch.multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.processes = []
+        for i in range(num_workers):
+            self.processes.append(context.Process(
+                target=_validation_worker, daemon=True,
+                args=(config, src_itos, trg_itos, validation_args,
+                      log_valid_sents, profiler if i == 0 else None,
+                      self.requests, self.results)))
+            self.processes[-1].start()
+        self.max_pending = max_pending
+        # training step, epoch and training state of the validations in
+        # flight, by request id in the order of the requests
+        self.pending = OrderedDict()
+        # results that arrived before the results of earlier requests
+        self.finished = {}
+        self.next_id = 0
+
+    def full(self) -> bool:
+        """
+        :return: whether `max_pending` validations are in flight
+        """
+        return len(self.pending) >= self.max_pending
+
+    def request(self, model_state: dict, steps: int, epoch_no: int,
+                train_state: dict = None) -> None:
+        """
+        Validate a snapshot of the model parameters. The tensors are moved
+        to shared memory and handed back with the results, so no other copy
+        is kept meanwhile.
+
+        :param model_state: parameters of the model on CPU
+        :param steps: training step of the model
+        :param epoch_no: epoch (starting from 0) of the model
+        :param train_state: rest of the training state at this step, which
+            is handed back with the results (e.g. for checkpoints)
+        """
+        assert not self.full(), "Too many validations in flight."
+        self.pending[self.next_id] = (steps, epoch_no, train_state)
+        self.requests.put((self.next_id, model_state))
+        self.next_id += 1
+
+    def result(self, wait: bool = False) -> Optional[tuple]:
+        """
+        Get the results of the oldest validation in flight, if it is
+        finished.
+
+        :param wait: wait for the validation to finish
+        :return: None if the oldest validation isn't finished, else
+            - training step of the validated model,
+            - epoch (starting from 0) of the validated model,
+            - duration of the validation in seconds,
+            - outputs of `validate_on_data`,
+            - parameters of the validated model,
+            - training state given with the request
+        """
+        while self.pending:
+            request_id = next(iter(self.pending))
+            if request_id in self.finished:
+                duration, valid_results, model_state = \
+                    self.finished.pop(request_id)
+                if isinstance(valid_results, Exception):
+                    raise valid_results
+                steps, epoch_no, train_state = self.pending.pop(request_id)
+                return (steps, epoch_no, duration, valid_results, model_state,
+                        train_state)
+            try:
+                finished_id, duration, valid_results, model_state = \
+                    self.results.get(block=wait, timeout=1 if wait else None)
+            except queue.Empty as err:
+                if not wait:
+                    return None
+                stopped = [process for process in self.processes
+                           if not process.is_alive()]
+                if not stopped:
+                    continue
+                raise RuntimeError("Validation worker stopped with exit "
+                                   "code {}.".format(
+                                       stopped[0].exitcode)) from err
+            self.finished[finished_id] = (duration, valid_results,
+                                          model_state)
+        return None
+
+    def stop(self) -> None:
+        """
+        Stop the validation processes.
+        """
+        for _ in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def _validation_worker(config: dict, src_itos: List[str],
+                       trg_itos: List[str], validation_args: dict,
+                       log_valid_sents: List[int],
+                       profiler: Optional[TorchProfiler], requests,
+                       results) -> None:
+    """
+    Validate model parameters in a separate process
+    (see `TrainManager._request_validation`).
+
+    Builds the model and loads the validation data as specified in the
+    configuration. Then validates every snapshot of model parameters from
+    `requests` and puts the results into `results`, until it receives None.
+
+    :param config: configuration dictionary
+    :param src_itos: tokens of the source vocabulary
+    :param trg_itos: tokens of the target vocabulary
+    :param validation_args: arguments for `validate_on_data`
+        (batch size, evaluation metric etc.)
+    :param log_valid_sents: indices of the sentences to plot attention for
+    :param profiler: profiles batches of the first validation (optional)
+    :param requests: queue with request ids and model parameters
+    :param results: queue for the request ids, durations, validation
+        results and validated model parameters
+    """
+    src_vocab = Vocabulary(tokens=src_itos, frozen=True)
+    trg_vocab = Vocabulary(tokens=trg_itos, frozen=True)
+    # the same validation data as in the training process, without test data
+    valid_data, _ = load_eval_data(dict(config["data"], test=None),
+                                   src_vocab, trg_vocab)
+
+    model = build_model(config["model"], src_vocab=src_vocab,
+                        trg_vocab=trg_vocab)
+    loss = XentLoss(pad_index=model.pad_index,
+                    smoothing=config["training"].get("label_smoothing", 0.0))
+    if validation_args["use_cuda"]:
+        model.cuda()
+        loss.cuda()
+    logger = make_logger()
+
+    for request_id, model_state in iter(requests.get, None):
+        try:
+            start_time = time.time()
+            model.load_state_dict(model_state)
+            valid_results = list(validate_on_data(
+                logger=logger, data=valid_data, model=model,
+                loss_function=loss, profiler=profiler, **validation_args))
+            # score, loss and perplexity are sent back as numbers, not as
+            # (CUDA) tensors shared with this process
+            valid_results[:3] = [float(value) for value in valid_results[:3]]
+            # the raw sources are a generator over the dataset, which can't
+            # be sent back
+            valid_results[4] = list(valid_results[4])
+            # only the attention scores of plotted sentences are sent back
+            if valid_results[-1]:
+                valid_results[-1] = [
+                    scores if i in log_valid_sents else None
+                    for i, scores in enumerate(valid_results[-1])]
+            results.put((request_id, time.time() - start_time,
+                         tuple(valid_results), model_state))
+        except Exception as e:  # pylint: disable=broad-except
+            results.put((request_id, None, e, None))
@@ -13,10 +13,37 @@ from joeynmt.constants import UNK_TOKEN, DEFAULT_UNK_ID, \
     EOS_TOKEN, BOS_TOKEN, PAD_TOKEN
 
 
+class FrozenStoi(dict):
+    """
+    Read-only mapping from tokens to indices.
+    Unknown tokens are mapped to the index of UNK without being inserted,
+    so that the mapping does not grow with every unseen token.
+    """
+
+    def __missing__(self, key: str) -> int:
+        return DEFAULT_UNK_ID()
+
+    def __reduce__(self):
+        # pickle and copy without calling the disabled __setitem__
+        return FrozenStoi, (dict(self),)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The vocabulary is frozen, tokens can't be changed.")
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+
 class Vocabulary:
     """ Vocabulary represents mapping between tokens and indices. """
 
-    def __init__(self, tokens: List[str] = None, file: str = None) -> None:
+    def __init__(self, tokens: List[str] = None, file: str = None,
+                 frozen: bool = False) -> None:
         """
         Create vocabulary from list of tokens or file.
 
@@ -25,19 +52,27 @@ class Vocabulary:
 
         :param tokens: list of tokens
         :param file: file to load vocabulary from
+        :param frozen: freeze the vocabulary after creating it
+            (see `freeze`)
         """
         # don't rename stoi and itos since needed for torchtext
-        # warning: stoi grows with unknown tokens, don't use for saving or size
+        # warning: stoi grows with unknown tokens unless the vocabulary is
+        # frozen, don't use for saving or size
 
         # special symbols
         self.specials = [UNK_TOKEN, PAD_TOKEN, BOS_TOKEN, EOS_TOKEN]
 
         self.stoi = defaultdict(DEFAULT_UNK_ID)
         self.itos = []
+        # itos as numpy array for converting many ids at once,
+        # created when first needed
+        self._itos_array = None
         if tokens is not None:
             self._from_list(tokens)
         elif file is not None:
             self._from_file(file)
+        if frozen:
+            self.freeze()
 
     def _from_list(self, tokens: List[str] = None) -> None:
         """
@@ -47,7 +82,7 @@ class Vocabulary:
 
         :param tokens: list of tokens
         """
-        self.add_tokens(tokens=self.specials+tokens)
+        self.add_tokens(tokens=self.specials+list(tokens))
         assert len(self.stoi) == len(self.itos)
 
     def _from_file(self, file: str) -> None:
@@ -83,11 +118,26 @@ class Vocabulary:
         :param tokens: list of tokens to add to the vocabulary
         """
         for t in tokens:
-            new_index = len(self.itos)
             # add to vocab if not already there
-            if t not in self.itos:
+            # (unknown tokens that were looked up are mapped to UNK in stoi)
+            index = self.stoi.get(t)
+            if index is None or self.itos[index] != t:
+                self.stoi[t] = len(self.itos)
                 self.itos.append(t)
-                self.stoi[t] = new_index
+        self._itos_array = None
+
+    def freeze(self) -> None:
+        """
+        Make `stoi` read-only: lookups of unknown tokens return the index of
+        UNK without adding them, so memory stays constant when translating
+        arbitrary input. No tokens can be added afterwards.
+        """
+        self.stoi = FrozenStoi((t, i) for i, t in enumerate(self.itos))
+
+    @property
+    def frozen(self) -> bool:
+        """ Whether the vocabulary is frozen (see `freeze`). """
+        return isinstance(self.stoi, FrozenStoi)
 
     def is_unk(self, token: str) -> bool:
         """
@@ -110,13 +160,8 @@ class Vocabulary:
         :param cut_at_eos: cut the decoded sentences at the first <eos>
         :return: list of strings (tokens)
         """
-        sentence = []
-        for i in array:
-            s = self.itos[i]
-            if cut_at_eos and s == EOS_TOKEN:
-                break
-            sentence.append(s)
-        return sentence
+        return self.arrays_to_sentences(arrays=[array],
+                                        cut_at_eos=cut_at_eos)[0]
 
     def arrays_to_sentences(self, arrays: np.array, cut_at_eos=True) \
             -> List[List[str]]:
@@ -124,15 +169,38 @@ class Vocabulary:
         Convert multiple arrays containing sequences of token IDs to their
         sentences, optionally cutting them off at the end-of-sequence token.
 
-        :param arrays: 2D array containing indices
+        All ids are looked up at once, so the arrays may also have different
+        lengths (e.g. hypotheses collected from several batches).
+
+        :param arrays: 2D array or list of 1D arrays containing indices
         :param cut_at_eos: cut the decoded sentences at the first <eos>
         :return: list of list of strings (tokens)
         """
-        sentences = []
-        for array in arrays:
-            sentences.append(
-                self.array_to_sentence(array=array, cut_at_eos=cut_at_eos))
-        return sentences
+        if isinstance(arrays, np.ndarray) and arrays.ndim == 2:
+            ids = arrays.reshape(-1)
+            lengths = np.full(arrays.shape[0], arrays.shape[1])
+        else:
+            arrays = [np.asarray(array).reshape(-1) for array in arrays]
+            if not arrays:
+                return []
+            ids = np.concatenate(arrays)
+            lengths = np.array([len(array) for array in arrays])
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+
+        if cut_at_eos:
+            # end each sentence at the first <eos> within its ids, if any
+            eos_positions = np.flatnonzero(ids == self.stoi[EOS_TOKEN])
+            first_eos = np.searchsorted(eos_positions, starts)
+            found = first_eos < len(eos_positions)
+            eos_ends = ends.copy()
+            eos_ends[found] = eos_positions[first_eos[found]]
+            ends = np.minimum(ends, eos_ends)
+
+        if self._itos_array is None:
+            self._itos_array = np.array(self.itos, dtype=object)
+        tokens = self._itos_array[ids].tolist()
+        return [tokens[start:end] for start, end in zip(starts, ends)]
 
 
 def build_vocab(field: str, max_size: int, min_freq: int, dataset: Dataset,
@@ -155,22 +223,6 @@ def build_vocab(field: str, max_size: int, min_freq: int, dataset: Dataset,
         vocab = Vocabulary(file=vocab_file)
     else:
         # create newly
-        def filter_min(counter: Counter, min_freq: int):
-            """ Filter counter by min frequency """
-            filtered_counter = Counter({t: c for t, c in counter.items()
-                                        if c >= min_freq})
-            return filtered_counter
-
-        def sort_and_cut(counter: Counter, limit: int):
-            """ Cut counter to most frequent,
-            sorted numerically and alphabetically"""
-            # sort by frequency, then alphabetically
-            tokens_and_frequencies = sorted(counter.items(),
-                                            key=lambda tup: tup[0])
-            tokens_and_frequencies.sort(key=lambda tup: tup[1], reverse=True)
-            vocab_tokens = [i[0] for i in tokens_and_frequencies[:limit]]
-            return vocab_tokens
-
         tokens = []
         for i in dataset.examples:
             if field == "src":
@@ -178,18 +230,49 @@ def build_vocab(field: str, max_size: int, min_freq: int, dataset: Dataset,
             elif field == "trg":
                 tokens.extend(i.trg)
 
-        counter = Counter(tokens)
-        if min_freq > -1:
-            counter = filter_min(counter, min_freq)
-        vocab_tokens = sort_and_cut(counter, max_size)
-        assert len(vocab_tokens) <= max_size
-
-        vocab = Vocabulary(tokens=vocab_tokens)
-        assert len(vocab) <= max_size + len(vocab.specials)
-        assert vocab.itos[DEFAULT_UNK_ID()] == UNK_TOKEN
+        vocab = build_vocab_from_counter(counter=Counter(tokens),
+                                         max_size=max_size, min_freq=min_freq)
 
     # check for all except for UNK token whether they are OOVs
     for s in vocab.specials[1:]:
         assert not vocab.is_unk(s)
 
     return vocab
+
+
+def build_vocab_from_counter(counter: Counter, max_size: int,
+                             min_freq: int) -> Vocabulary:
+    """
+    Builds vocabulary from token counts, e.g. collected while streaming
+    over a corpus.
+
+    :param counter: token frequencies
+    :param max_size: maximum size of vocabulary
+    :param min_freq: minimum frequency for an item to be included
+    :return: Vocabulary with the most frequent tokens of `counter`
+    """
+    def filter_min(counter: Counter, min_freq: int):
+        """ Filter counter by min frequency """
+        filtered_counter = Counter({t: c for t, c in counter.items()
+                                    if c >= min_freq})
+        return filtered_counter
+
+    def sort_and_cut(counter: Counter, limit: int):
+        """ Cut counter to most frequent,
+        sorted numerically and alphabetically"""
+        # sort by frequency, then alphabetically
+        tokens_and_frequencies = sorted(counter.items(),
+                                        key=lambda tup: tup[0])
+        tokens_and_frequencies.sort(key=lambda tup: tup[1], reverse=True)
+        vocab_tokens = [i[0] for i in tokens_and_frequencies[:limit]]
+        return vocab_tokens
+
+    if min_freq > -1:
+        counter = filter_min(counter, min_freq)
+    vocab_tokens = sort_and_cut(counter, max_size)
+    assert len(vocab_tokens) <= max_size
+
+    vocab = Vocabulary(tokens=vocab_tokens)
+    assert len(vocab) <= max_size + len(vocab.specials)
+    assert vocab.itos[DEFAULT_UNK_ID()] == UNK_TOKEN
+    return vocab
@@ -1,10 +1,12 @@
 import torch
 import random
+import numpy as np
 
 from torchtext.data.batch import Batch as TorchTBatch
 
 from joeynmt.batch import Batch
 from joeynmt.data import load_data, make_data_iter
+from joeynmt.prefetch import PrefetchIterator
 from joeynmt.constants import PAD_TOKEN
 from .test_helpers import TensorTestCase
 
@@ -32,6 +34,7 @@ class TestData(TensorTestCase):
         seed = 42
         torch.manual_seed(seed)
         random.seed(42)
+        np.random.seed(seed)
 
     def testBatchTrainIterator(self):
 
@@ -43,26 +46,24 @@ class TestData(TensorTestCase):
                                     batch_size=batch_size)
         self.assertEqual(train_iter.batch_size, batch_size)
         self.assertTrue(train_iter.shuffle)
-        self.assertTrue(train_iter.train)
-        self.assertEqual(train_iter.epoch, 0)
-        self.assertEqual(train_iter.iterations, 0)
+        self.assertEqual(len(train_iter), 7)
 
         expected_src0 = torch.Tensor(
-            [[21, 10, 4, 16, 4, 5, 21, 4, 12, 33, 6, 14, 4, 12, 23, 6, 18, 4,
-              6, 9, 3],
-             [20, 28, 4, 10, 28, 4, 6, 5, 14, 8, 6, 15, 4, 5, 7, 17, 11, 27,
-              6, 9, 3],
-             [24, 8, 7, 5, 24, 10, 12, 14, 5, 18, 4, 7, 17, 11, 4, 11, 4, 6,
-              25, 3, 1]]).long()
-        expected_src0_len = torch.Tensor([21, 21, 20]).long()
+            [[8, 31, 4, 12, 5, 6, 10, 17, 11, 13, 5, 11, 10, 4, 12, 9, 3],
+             [29, 4, 14, 4, 12, 5, 7, 8, 18, 13, 5, 14, 8, 7, 9, 3, 1],
+             [31, 33, 12, 4, 6, 5, 7, 20, 10, 4, 16, 4, 6, 9, 3, 1, 1],
+             [4, 12, 6, 7, 13, 5, 26, 23, 5, 7, 4, 10, 6, 9, 3, 1, 1]]).long()
+        expected_src0_len = torch.Tensor([17, 16, 15, 15]).long()
         expected_trg0 = torch.Tensor(
-            [[6,  4, 27,  5,  8,  4,  5, 31,  4, 26,  7,  6, 10, 20, 11,
-               9,  3],
-             [8,  7,  6, 10, 17,  4, 13,  5, 15,  9,  3,  1,  1,  1,  1,
-              1,  1],
-             [12,  5,  4, 25,  7,  6,  8,  4,  7,  6, 18, 18, 11, 10, 12,
-              23,  3]]).long()
-        expected_trg0_len = torch.Tensor([18, 12, 18]).long()
+            [[10, 5, 8, 4, 6, 10, 13, 28, 5, 16, 11, 9, 3, 1, 1, 1, 1, 1,
+              1, 1, 1],
+             [11, 29, 11, 16, 13, 24, 5, 19, 13, 4, 12, 6, 13, 12, 4, 8, 7,
+              6, 8, 9, 3],
+             [24, 11, 6, 16, 12, 4, 18, 27, 6, 13, 9, 3, 1, 1, 1, 1, 1, 1,
+              1, 1, 1],
+             [8, 5, 4, 24, 11, 4, 12, 11, 16, 14, 5, 15, 12, 9, 3, 1, 1, 1,
+              1, 1, 1]]).long()
+        expected_trg0_len = torch.Tensor([14, 22, 13, 16]).long()
 
         total_samples = 0
         for b in iter(train_iter):
@@ -72,9 +73,13 @@ class TestData(TensorTestCase):
                 self.assertTensorEqual(b.src_lengths, expected_src0_len)
                 self.assertTensorEqual(b.trg, expected_trg0)
                 self.assertTensorEqual(b.trg_lengths, expected_trg0_len)
+            # batches are sorted by source length
+            self.assertTensorEqual(
+                torch.sort(b.src_lengths, descending=True)[0], b.src_lengths)
             total_samples += b.nseqs
             self.assertLessEqual(b.nseqs, batch_size)
         self.assertEqual(total_samples, len(self.train_data))
+        self.assertGreaterEqual(train_iter.padding_ratio, 0.)
 
     def testBatchDevIterator(self):
 
@@ -133,4 +138,22 @@ class TestData(TensorTestCase):
             self.assertLessEqual(b.nseqs, batch_size)
         self.assertEqual(total_samples, len(self.dev_data))
 
-
+    def testPrefetchIterator(self):
+        # prefetched batches arrive in the same order as without prefetching
+        dev_iter = make_data_iter(self.dev_data, train=False, shuffle=False,
+                                  batch_size=3)
+        expected = [Batch(b, pad_index=self.pad_index) for b in dev_iter]
+
+        for num_batches, num_workers in [(0, 1), (1, 1), (2, 3)]:
+            prefetch_iter = PrefetchIterator(
+                dev_iter, pad_index=self.pad_index, num_batches=num_batches,
+                num_workers=num_workers)
+            self.assertEqual(len(prefetch_iter), len(expected))
+            batches = list(iter(prefetch_iter))
+            self.assertEqual(len(batches), len(expected))
+            for b, expected_b in zip(batches, expected):
+                self.assertEqual(type(b), Batch)
+                self.assertTensorEqual(b.src, expected_b.src)
+                self.assertTensorEqual(b.src_mask, expected_b.src_mask)
+                self.assertTensorEqual(b.trg, expected_b.trg)
+                self.assertEqual(b.ntokens, expected_b.ntokens)
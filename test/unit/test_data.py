@@ -1,9 +1,16 @@
 import unittest
+import os
+import shutil
+import tempfile
 
 import numpy as np
+import torch
+import yaml
 
 from joeynmt.data import MonoDataset, TranslationDataset, load_data, \
-    make_data_iter
+    make_data_iter, preprocess, BinarizedDataset, load_eval_data
+from joeynmt.batching import BucketBatchIterator, LengthSortedIterator
+from joeynmt.streaming import StreamingDataset
 
 class TestData(unittest.TestCase):
 
@@ -47,6 +54,46 @@ class TestData(unittest.TestCase):
         self.assertEqual(np.prod(batch.src[0].shape), 88)
         self.assertLessEqual(np.prod(batch.src[0].shape), 100)
 
+    def testBucketBatchIterator(self):
+        train_data, _, _, _, _ = load_data(self.data_cfg)
+
+        # token batches for training are packed up to the batch size,
+        # including padding, and cover all examples
+        train_iter = make_data_iter(train_data, batch_size=100,
+                                    batch_type="token", train=True,
+                                    shuffle=True)
+        self.assertIs(type(train_iter), BucketBatchIterator)
+        # every epoch is planned anew, the length before an epoch is the
+        # number of its batches
+        for _ in range(2):
+            expected_batches = len(train_iter)
+            n_examples = 0
+            n_batches = 0
+            for batch in train_iter:
+                self.assertLessEqual(np.prod(batch.src[0].shape), 100)
+                self.assertLessEqual(np.prod(batch.trg[0].shape), 100)
+                # sorted by descending source length
+                src_lengths = batch.src[1].tolist()
+                self.assertEqual(src_lengths,
+                                 sorted(src_lengths, reverse=True))
+                n_examples += batch.src[0].shape[0]
+                n_batches += 1
+            self.assertEqual(n_examples, len(train_data))
+            self.assertEqual(n_batches, expected_batches)
+
+        # much less padding than in batches of consecutive examples
+        sentence_iter = make_data_iter(train_data, batch_size=10,
+                                       batch_type="sentence", train=True,
+                                       shuffle=False)
+        padding = 0
+        positions = 0
+        for batch in sentence_iter:
+            padding += (batch.src[0] == 1).sum().item()
+            positions += batch.src[0].numel()
+        self.assertGreater(sentence_iter.padding_ratio, 0)
+        self.assertLess(sentence_iter.padding_ratio, 0.1)
+        self.assertLess(padding / positions, 0.1)
+
     def testDataLoading(self):
         # test all combinations of configuration settings
         for test_path in [None, self.test_path]:
@@ -142,6 +189,44 @@ class TestData(unittest.TestCase):
                     self.assertEqual(train_data.examples[0].src, comparison_src)
                     self.assertEqual(train_data.examples[0].trg, comparison_trg)
 
+    def testLengthSortedIterator(self):
+        _, dev_data, _, _, _ = load_data(self.data_cfg)
+        dev_iter = LengthSortedIterator(dev_data, batch_size=50,
+                                        batch_type="token")
+        self.assertEqual(sorted(dev_iter.order), list(range(len(dev_data))))
+
+        # batches of consecutive examples in order of descending length
+        lengths = []
+        for batch in dev_iter:
+            n_examples, max_length = batch.src[0].shape
+            if n_examples > 1:
+                # EOS is not counted
+                self.assertLessEqual(n_examples * (max_length - 1), 50)
+            lengths.extend(batch.src[1].tolist())
+        self.assertEqual(len(lengths), len(dev_data))
+        self.assertEqual(lengths, sorted(lengths, reverse=True))
+        self.assertEqual(lengths, [len(dev_data.examples[i].src) + 1
+                                   for i in dev_iter.order])
+
+    def testEvalDataLoading(self):
+        current_cfg = self.data_cfg.copy()
+        current_cfg["test"] = self.test_path
+        _, dev_data, test_data, src_vocab, trg_vocab = load_data(current_cfg)
+
+        # same dev and test data, without reading the training data
+        current_cfg["train"] = "does/not/exist"
+        eval_dev_data, eval_test_data = load_eval_data(
+            current_cfg, src_vocab, trg_vocab)
+        for data, eval_data in [(dev_data, eval_dev_data),
+                                (test_data, eval_test_data)]:
+            self.assertIs(type(eval_data), type(data))
+            self.assertEqual([vars(ex) for ex in eval_data.examples],
+                             [vars(ex) for ex in data.examples])
+            self.assertIs(eval_data.fields["src"].vocab, src_vocab)
+        self.assertIs(eval_dev_data.fields["trg"].vocab, trg_vocab)
+        # test has no target side
+        self.assertIs(type(eval_test_data), MonoDataset)
+
     def testRandomSubset(self):
         # only a random subset should be selected for training
         current_cfg = self.data_cfg.copy()
@@ -156,3 +241,114 @@ class TestData(unittest.TestCase):
         train_data, dev_data, test_data, src_vocab, trg_vocab = \
             load_data(current_cfg)
         assert len(train_data) == 10
+
+    def testBinarizedData(self):
+        # pre-process the training data into binary files
+        tmp_dir = tempfile.mkdtemp()
+        current_cfg = self.data_cfg.copy()
+        current_cfg["binarized"] = os.path.join(tmp_dir, "bin")
+        cfg_file = os.path.join(tmp_dir, "config.yaml")
+        with open(cfg_file, "w") as opened_file:
+            yaml.safe_dump({"data": current_cfg}, opened_file)
+        preprocess(cfg_file)
+
+        text_train_data, _, _, text_src_vocab, text_trg_vocab = \
+            load_data(self.data_cfg)
+        train_data, dev_data, _, src_vocab, trg_vocab = \
+            load_data(current_cfg)
+        shutil.rmtree(tmp_dir)
+
+        self.assertIs(type(train_data), BinarizedDataset)
+        self.assertIs(type(dev_data), TranslationDataset)
+        self.assertEqual(src_vocab.itos, text_src_vocab.itos)
+        self.assertEqual(trg_vocab.itos, text_trg_vocab.itos)
+
+        # same examples (filtered to max_sent_length) and batches
+        self.assertEqual(len(train_data), len(text_train_data))
+        self.assertEqual(vars(train_data[0]),
+                         vars(text_train_data.examples[0]))
+        text_iter = iter(make_data_iter(
+            text_train_data, batch_size=10, batch_type="sentence"))
+        train_iter = iter(make_data_iter(
+            train_data, batch_size=10, batch_type="sentence"))
+        for _ in range(3):
+            text_batch, batch = next(text_iter), next(train_iter)
+            for field in ["src", "trg"]:
+                for text_tensor, tensor in zip(getattr(text_batch, field),
+                                               getattr(batch, field)):
+                    self.assertTrue(torch.equal(text_tensor, tensor))
+
+        # token batches for training stay below the batch size
+        train_iter = make_data_iter(train_data, batch_size=100,
+                                    batch_type="token", train=True,
+                                    shuffle=True)
+        for _ in range(2):
+            expected_batches = len(train_iter)
+            n_examples = 0
+            n_batches = 0
+            for batch in train_iter:
+                self.assertLessEqual(np.prod(batch.src[0].shape), 100)
+                self.assertLessEqual(np.prod(batch.trg[0].shape), 100)
+                n_examples += batch.src[0].shape[0]
+                n_batches += 1
+            self.assertEqual(n_examples, len(train_data))
+            self.assertEqual(n_batches, expected_batches)
+        self.assertLess(train_iter.padding_ratio, 0.5)
+
+    def testStreamingData(self):
+        text_train_data, _, _, text_src_vocab, text_trg_vocab = \
+            load_data(self.data_cfg)
+        current_cfg = self.data_cfg.copy()
+        current_cfg["streaming"] = True
+        current_cfg["streaming_buffer_size"] = 50
+        train_data, dev_data, _, src_vocab, trg_vocab = \
+            load_data(current_cfg)
+
+        self.assertIs(type(train_data), StreamingDataset)
+        self.assertIs(type(dev_data), TranslationDataset)
+        self.assertEqual(src_vocab.itos, text_src_vocab.itos)
+        self.assertEqual(trg_vocab.itos, text_trg_vocab.itos)
+
+        # same examples (filtered to max_sent_length) and batches
+        self.assertEqual(len(train_data), len(text_train_data))
+        self.assertEqual(vars(train_data[0]),
+                         vars(text_train_data.examples[0]))
+        text_iter = iter(make_data_iter(
+            text_train_data, batch_size=10, batch_type="sentence"))
+        train_iter = iter(make_data_iter(
+            train_data, batch_size=10, batch_type="sentence"))
+        for _ in range(3):
+            text_batch, batch = next(text_iter), next(train_iter)
+            for field in ["src", "trg"]:
+                for text_tensor, tensor in zip(getattr(text_batch, field),
+                                               getattr(batch, field)):
+                    self.assertTrue(torch.equal(text_tensor, tensor))
+
+        # shuffled token batches for training cover all examples
+        train_iter = make_data_iter(train_data, batch_size=100,
+                                    batch_type="token", train=True,
+                                    shuffle=True)
+        n_examples = 0
+        for batch in train_iter:
+            self.assertLessEqual(np.prod(batch.src[0].shape), 100)
+            self.assertLessEqual(np.prod(batch.trg[0].shape), 100)
+            n_examples += batch.src[0].shape[0]
+        self.assertEqual(n_examples, len(train_data))
+        # the number of streamed token batches isn't known in advance
+        with self.assertRaises(TypeError):
+            len(train_iter)
+
+        # with given vocabularies, the examples aren't read to count them
+        vocab_dir = tempfile.mkdtemp()
+        for side, vocab in [("src", src_vocab), ("trg", trg_vocab)]:
+            current_cfg[side + "_vocab"] = os.path.join(vocab_dir, side)
+            vocab.to_file(current_cfg[side + "_vocab"])
+        train_data, _, _, _, _ = load_data(current_cfg)
+        shutil.rmtree(vocab_dir)
+        with self.assertRaises(TypeError):
+            len(train_data)
+        with self.assertRaises(TypeError):
+            len(make_data_iter(train_data, batch_size=10,
+                               batch_type="sentence", train=True))
+        self.assertEqual(vars(train_data[1]),
+                         vars(text_train_data.examples[1]))
@@ -1,9 +1,34 @@
+from types import SimpleNamespace
+
 import torch
 
+from joeynmt.batch import Batch
 from joeynmt.loss import XentLoss
+from joeynmt.model import build_model
+from joeynmt.vocabulary import Vocabulary
 from .test_helpers import TensorTestCase
 
 
+def smooth_targets(targets, vocab_size, smoothing, pad_index):
+    """
+    Dense smoothed target distributions, batch*seq_len x vocab_size, as a
+    reference for the closed form label-smoothed loss.
+    All non-reference words get uniform probability mass according to
+    "smoothing".
+    """
+    # batch*seq_len x vocab_size
+    smooth_dist = targets.new_zeros((targets.size(0), vocab_size)).float()
+    # fill distribution uniformly with smoothing
+    smooth_dist.fill_(smoothing / (vocab_size - 2))
+    # assign true label the probability of 1-smoothing ("confidence")
+    smooth_dist.scatter_(1, targets.unsqueeze(1), 1.0 - smoothing)
+    # give padding probability of 0 everywhere
+    smooth_dist[:, pad_index] = 0
+    # masking out padding area (sum of probabilities for padding area = 0)
+    smooth_dist[targets == pad_index] = 0
+    return smooth_dist
+
+
 class TestTransformerUtils(TensorTestCase):
 
     def setUp(self):
@@ -28,8 +53,9 @@ class TestTransformerUtils(TensorTestCase):
                                     [1, 0]])
 
         # test the smoothing function
-        smoothed_targets = criterion._smooth_targets(targets=targets.view(-1),
-                                      vocab_size=predict.size(-1))
+        smoothed_targets = smooth_targets(
+            targets=targets.view(-1), vocab_size=predict.size(-1),
+            smoothing=smoothing, pad_index=pad_index)
         self.assertTensorAlmostEqual(
             smoothed_targets,
             torch.Tensor(
@@ -64,8 +90,9 @@ class TestTransformerUtils(TensorTestCase):
                                     [1, 0]])
 
         # test the smoothing function: should still be one-hot
-        smoothed_targets = criterion._smooth_targets(targets=targets.view(-1),
-                                      vocab_size=predict.size(-1))
+        smoothed_targets = smooth_targets(
+            targets=targets.view(-1), vocab_size=predict.size(-1),
+            smoothing=smoothing, pad_index=pad_index)
 
         assert torch.max(smoothed_targets) == 1
         assert torch.min(smoothed_targets) == 0
@@ -83,3 +110,93 @@ class TestTransformerUtils(TensorTestCase):
 
         v = criterion(predict.log(), targets)
         self.assertTensorAlmostEqual(v, 5.6268)
+
+    def test_label_smoothing_closed_form(self):
+        # same loss and gradients as KL divergence to the dense targets
+        pad_index = 1
+        vocab_size = 7
+        for smoothing in [0.1, 0.4, 1.0]:
+            criterion = XentLoss(pad_index=pad_index, smoothing=smoothing)
+
+            # batch x seq_len x vocab_size: 4 x 3 x 7
+            logits = torch.rand(4, 3, vocab_size, requires_grad=True)
+            log_probs = torch.log_softmax(logits, dim=-1)
+            targets = torch.randint(0, vocab_size, (4, 3))
+            targets[0, 2] = pad_index
+
+            smoothed_targets = smooth_targets(
+                targets=targets.view(-1), vocab_size=vocab_size,
+                smoothing=smoothing, pad_index=pad_index)
+            expected = torch.nn.KLDivLoss(reduction='sum')(
+                log_probs.view(-1, vocab_size), smoothed_targets)
+            expected_grad, = torch.autograd.grad(expected, logits,
+                                                 retain_graph=True)
+
+            v = criterion(log_probs, targets)
+            grad, = torch.autograd.grad(v, logits)
+            self.assertTensorAlmostEqual(v, expected)
+            self.assertTensorAlmostEqual(grad, expected_grad)
+
+    def test_loss_from_logits(self):
+        # fused log-softmax gives the same loss as from log probabilities
+        pad_index = 1
+        logits = torch.rand(4, 3, 7) * 5
+        targets = torch.randint(0, 7, (4, 3))
+        targets[1, 1:] = pad_index
+        for smoothing in [0.0, 0.2]:
+            criterion = XentLoss(pad_index=pad_index, smoothing=smoothing)
+            expected = criterion(torch.log_softmax(logits, dim=-1), targets)
+            v = criterion.loss_from_logits(logits, targets)
+            self.assertTensorAlmostEqual(v, expected)
+
+
+class TestChunkedLoss(TensorTestCase):
+
+    def test_chunked_loss(self):
+        # the checkpointed loss over slices of target steps gives the same
+        # loss and parameter gradients as the loss over all steps at once
+        torch.manual_seed(42)
+        vocab = Vocabulary(tokens=["tok{:02d}".format(i) for i in range(30)])
+        pad_index = vocab.stoi["<pad>"]
+        src = torch.randint(4, 30, (3, 7))
+        src[2, 5:] = pad_index
+        trg = torch.randint(4, 30, (3, 6))
+        trg[1, 4:] = pad_index
+        # sorted by source length for the recurrent encoder
+        batch = Batch(SimpleNamespace(src=(src, torch.tensor([7, 7, 5])),
+                                      trg=(trg, torch.tensor([6, 4, 6]))),
+                      pad_index=pad_index)
+
+        transformer = {"type": "transformer", "hidden_size": 32,
+                       "embeddings": {"embedding_dim": 32}, "num_layers": 1,
+                       "num_heads": 4, "ff_size": 64}
+        recurrent = {"type": "recurrent", "hidden_size": 32,
+                     "embeddings": {"embedding_dim": 16}}
+        for layer in [transformer, recurrent]:
+            model = build_model({"encoder": layer, "decoder": dict(layer)},
+                                src_vocab=vocab, trg_vocab=vocab)
+            # no dropout, so that all forward passes are the same
+            model.eval()
+            for smoothing in [0.0, 0.1]:
+                loss_function = XentLoss(pad_index=pad_index,
+                                         smoothing=smoothing)
+                results = {}
+                # 5 target steps: slices of 1, slices of 2 and 2 and 1
+                for chunk_size in [None, 1, 2]:
+                    model.zero_grad()
+                    loss = model.get_loss_for_batch(
+                        batch, loss_function, chunk_size=chunk_size)
+                    loss.backward()
+                    results[chunk_size] = (loss.detach(), {
+                        name: param.grad.clone()
+                        for name, param in model.named_parameters()
+                        if param.grad is not None})
+
+                expected_loss, expected_grads = results[None]
+                for chunk_size in [1, 2]:
+                    loss, grads = results[chunk_size]
+                    self.assertTensorAlmostEqual(loss, expected_loss)
+                    self.assertEqual(grads.keys(), expected_grads.keys())
+                    for name, grad in grads.items():
+                        self.assertTensorAlmostEqual(grad,
+                                                     expected_grads[name])
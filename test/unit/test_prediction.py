@@ -0,0 +1,238 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import torch
+
+from joeynmt.batch import Batch
+from joeynmt.batching import LengthSortedIterator
+from joeynmt.data import load_data
+from joeynmt.helpers import make_logger
+from joeynmt.loss import XentLoss
+from joeynmt.model import build_model
+from joeynmt.prediction import Translator, TranslationCache, \
+    validate_on_data
+from joeynmt.vocabulary import Vocabulary
+
+
+class TestTranslator(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(42)
+        tokens = ["tok{:02d}".format(i) for i in range(30)]
+        self.vocab = Vocabulary(tokens=tokens, frozen=True)
+        layer = {"type": "transformer", "hidden_size": 32,
+                 "embeddings": {"embedding_dim": 32}, "num_layers": 1,
+                 "num_heads": 4, "ff_size": 64}
+        self.model = build_model({"encoder": layer, "decoder": dict(layer)},
+                                 src_vocab=self.vocab, trg_vocab=self.vocab)
+        self.sentences = ["tok01 tok02 tok03", "", "tok04 unknown",
+                          "tok05 tok06 tok07 tok08 tok09 tok10", "tok11"]
+
+    def test_translate(self):
+        for beam_size in [1, 3]:
+            translator = Translator(self.model, level="word", lowercase=False,
+                                    batch_size=20, batch_type="token",
+                                    beam_size=beam_size, beam_alpha=1,
+                                    max_output_length=10)
+            hypotheses = translator.translate(self.sentences)
+            self.assertEqual(len(hypotheses), len(self.sentences))
+            # empty input is not decoded
+            self.assertEqual(hypotheses[1], "")
+
+            # same translations when translated one by one
+            for sentence, hypothesis in zip(self.sentences, hypotheses):
+                self.assertEqual(translator.translate([sentence]),
+                                 [hypothesis])
+                self.assertLessEqual(len(hypothesis.split()), 10)
+                for token in hypothesis.split():
+                    self.assertIn(token, self.vocab.stoi)
+
+    def test_translate_stream(self):
+        translator = Translator(self.model, level="word", lowercase=False,
+                                batch_size=2, max_output_length=10)
+        lines = iter(sentence + "\n" for sentence in self.sentences)
+        chunks = list(translator.translate_stream(lines, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([hyp for chunk in chunks for hyp in chunk],
+                         translator.translate(self.sentences))
+
+    def test_cache(self):
+        cache = TranslationCache(max_size=10)
+        translator = Translator(self.model, level="word", lowercase=False,
+                                batch_size=2, cache=cache, model_id="model")
+        calls = []
+        run_batch = self.model.run_batch
+
+        def counting_run_batch(batch, **kwargs):
+            calls.append(batch.nseqs)
+            return run_batch(batch, **kwargs)
+        self.model.run_batch = counting_run_batch
+
+        sentences = self.sentences + self.sentences[:1]
+        hypotheses = translator.translate(sentences)
+        # duplicates are decoded once, empty sentences not at all
+        self.assertEqual(sum(calls), 4)
+        self.assertEqual(hypotheses[-1], hypotheses[0])
+        self.assertEqual(cache.stats()["size"], 4)
+
+        # cached translations are not decoded again
+        calls.clear()
+        self.assertEqual(translator.translate(sentences[::-1]),
+                         hypotheses[::-1])
+        self.assertEqual(calls, [])
+        self.assertEqual(cache.hits, 4)
+
+        # other decoding settings are cached separately
+        translator.beam_size = 2
+        translator.translate(self.sentences[:1])
+        self.assertEqual(calls, [1])
+
+    def test_postprocess(self):
+        translator = Translator(self.model, level="bpe", lowercase=False)
+        self.assertEqual(translator.postprocess(["a@@", "b", "c"]), "ab c")
+        translator = Translator(self.model, level="char", lowercase=False)
+        self.assertEqual(translator.postprocess(["a", " ", "b"]), "a b")
+
+
+class TestSharedEncoding(unittest.TestCase):
+
+    def test_loss_and_decoding(self):
+        torch.manual_seed(42)
+        vocab = Vocabulary(tokens=["tok{:02d}".format(i) for i in range(30)])
+        pad_index = vocab.stoi["<pad>"]
+        src = torch.randint(4, 30, (3, 7))
+        src[1, 5:] = pad_index
+        src[2, 3:] = pad_index
+        trg = torch.randint(4, 30, (3, 6))
+        trg[2, 4:] = pad_index
+        batch = Batch(SimpleNamespace(src=(src, torch.tensor([7, 5, 3])),
+                                      trg=(trg, torch.tensor([6, 6, 4]))),
+                      pad_index=pad_index)
+        loss_function = XentLoss(pad_index=pad_index)
+
+        transformer = {"type": "transformer", "hidden_size": 32,
+                       "embeddings": {"embedding_dim": 32}, "num_layers": 2,
+                       "num_heads": 4, "ff_size": 64}
+        recurrent = {"type": "recurrent", "hidden_size": 32,
+                     "embeddings": {"embedding_dim": 16}}
+        for layer in [transformer, recurrent]:
+            model = build_model({"encoder": layer, "decoder": dict(layer)},
+                                src_vocab=vocab, trg_vocab=vocab)
+            model.eval()
+            with torch.no_grad():
+                encoder_output, encoder_hidden = model.encode(
+                    batch.src, batch.src_lengths, batch.src_mask)
+                for beam_size in [1, 3]:
+                    # encoding once gives the same results as encoding
+                    # separately for loss computation and decoding
+                    shared = model.run_batch(
+                        batch, max_output_length=10, beam_size=beam_size,
+                        beam_alpha=-1, encoder_output=encoder_output,
+                        encoder_hidden=encoder_hidden)
+                    separate = model.run_batch(
+                        batch, max_output_length=10, beam_size=beam_size,
+                        beam_alpha=-1)
+                    self.assertEqual(shared[0].tolist(),
+                                     separate[0].tolist())
+                self.assertAlmostEqual(
+                    model.get_loss_for_batch(
+                        batch, loss_function, encoder_output=encoder_output,
+                        encoder_hidden=encoder_hidden).item(),
+                    model.get_loss_for_batch(batch, loss_function).item(),
+                    places=4)
+
+
+class UnsortedIterator(LengthSortedIterator):
+    """
+    Batches of consecutive examples in the order of the data set.
+    """
+
+    def __init__(self, dataset, batch_size, batch_type="sentence"):
+        super().__init__(dataset, batch_size, batch_type)
+        self.order = np.arange(len(dataset))
+        self._batches = [self.order[i:i + batch_size]
+                         for i in range(0, len(dataset), batch_size)]
+
+
+class TestValidateOnData(unittest.TestCase):
+
+    def test_dataset_order(self):
+        # outputs of length-sorted batches are in the order of the data set
+        torch.manual_seed(42)
+        data_cfg = {"src": "de", "trg": "en", "train": "test/data/toy/train",
+                    "dev": "test/data/toy/dev", "level": "word",
+                    "lowercase": False, "max_sent_length": 10}
+        _, dev_data, _, src_vocab, trg_vocab = load_data(data_cfg)
+        self.assertFalse(np.array_equal(
+            LengthSortedIterator(dev_data, batch_size=4).order,
+            np.arange(len(dev_data))))
+        loss_function = XentLoss(pad_index=src_vocab.stoi["<pad>"])
+        logger = make_logger()
+
+        transformer = {"type": "transformer", "hidden_size": 32,
+                       "embeddings": {"embedding_dim": 32}, "num_layers": 1,
+                       "num_heads": 4, "ff_size": 64}
+        recurrent = {"type": "recurrent", "hidden_size": 32,
+                     "embeddings": {"embedding_dim": 16}}
+        for layer in [transformer, recurrent]:
+            model = build_model({"encoder": layer, "decoder": dict(layer)},
+                                src_vocab=src_vocab, trg_vocab=trg_vocab)
+            kwargs = dict(model=model, data=dev_data, logger=logger,
+                          batch_size=4, use_cuda=False, max_output_length=10,
+                          level="word", eval_metric="bleu",
+                          loss_function=loss_function)
+            with mock.patch("joeynmt.prediction.LengthSortedIterator",
+                            UnsortedIterator):
+                unsorted = validate_on_data(**kwargs)
+            results = validate_on_data(**kwargs)
+
+            self.assertAlmostEqual(float(results[1]), float(unsorted[1]),
+                                   places=3)
+            # sources, raw sources, references, hypotheses, raw hypotheses
+            for i in range(3, 8):
+                self.assertEqual(list(results[i]), list(unsorted[i]))
+            attention_scores, unsorted_scores = results[8], unsorted[8]
+            # only the recurrent decoder returns attention scores
+            self.assertEqual(len(attention_scores),
+                             len(dev_data) if layer is recurrent else 0)
+            for src, hyp, scores, expected in zip(
+                    dev_data.src, results[7], attention_scores,
+                    unsorted_scores):
+                # compare up to EOS, without padding
+                steps, src_length = min(len(hyp) + 1, 10), len(src) + 1
+                self.assertTrue(np.allclose(
+                    scores[:steps, :src_length],
+                    expected[:steps, :src_length], atol=1e-5))
+
+
+class TestTranslationCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = TranslationCache(max_size=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        self.assertEqual(cache.get("a"), "A")
+        # "b" is the least recently used entry
+        cache.put("c", "C")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual(cache.stats(), {"size": 2, "hits": 2, "misses": 1,
+                                         "evictions": 1})
+
+    def test_file(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.json")
+        cache = TranslationCache(max_size=3, path=path)
+        for key in ["a", "b", "c"]:
+            cache.put(key, key.upper())
+        cache.get("a")
+        cache.save()
+
+        # the most recently used entries are kept
+        cache = TranslationCache(max_size=2, path=path)
+        os.remove(path)
+        self.assertEqual(list(cache.entries.items()),
+                         [("c", "C"), ("a", "A")])
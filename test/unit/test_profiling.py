@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+import unittest
+
+import torch
+
+from joeynmt.profiling import StepProfiler, TorchProfiler
+
+
+class TestStepProfiler(unittest.TestCase):
+
+    def test_disabled(self):
+        profiler = StepProfiler(enabled=False)
+        with profiler.phase("forward"):
+            pass
+        self.assertEqual(list(profiler.iterate(range(3), "batch")), [0, 1, 2])
+        self.assertEqual(profiler.summary(), {})
+
+    def test_summary(self):
+        output_file = os.path.join(tempfile.mkdtemp(), "profile.jsonl")
+        profiler = StepProfiler(enabled=True, output_file=output_file)
+
+        for _ in profiler.iterate(range(4), "batch"):
+            with profiler.phase("forward"):
+                pass
+        summary = profiler.summary()
+        # one more measurement for the end of the iteration
+        self.assertEqual(summary["batch"]["count"], 5)
+        self.assertEqual(summary["forward"]["count"], 4)
+        for stats in summary.values():
+            self.assertLessEqual(stats["p50"], stats["p90"])
+            self.assertLessEqual(stats["p99"], stats["max"])
+
+        # every window is written as one line, then the window is reset
+        profiler.write(steps=10)
+        with profiler.phase("forward"):
+            pass
+        profiler.write(steps=20)
+        with open(output_file) as opened_file:
+            lines = [json.loads(line) for line in opened_file]
+        os.remove(output_file)
+        self.assertEqual([line["steps"] for line in lines], [10, 20])
+        self.assertEqual(sorted(lines[0]["phases"]), ["batch", "forward"])
+        self.assertEqual(list(lines[1]["phases"]), ["forward"])
+        self.assertEqual(lines[1]["phases"]["forward"]["count"], 1)
+
+
+class TestTorchProfiler(unittest.TestCase):
+
+    def test_ranges(self):
+        output_dir = tempfile.mkdtemp()
+        # range [1, 3) is missed when starting at step 4
+        profiler = TorchProfiler(output_dir, "train", ranges=[[5, 7], [1, 3]])
+        for step in range(4, 10):
+            profiler.step(step)
+            self.assertEqual(profiler.profiler is not None, 5 <= step < 7)
+            torch.matmul(torch.rand(8, 8), torch.rand(8, 8))
+        profiler.close()
+
+        self.assertEqual(sorted(os.listdir(output_dir)),
+                         ["train_5-7.trace.json", "train_5-7.txt"])
+        with open(os.path.join(output_dir, "train_5-7.txt")) as opened_file:
+            self.assertIn("aten::matmul", opened_file.read())
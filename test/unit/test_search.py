@@ -2,7 +2,7 @@ import torch
 import numpy as np
 
 from joeynmt.search import greedy, recurrent_greedy, transformer_greedy
-from joeynmt.search import beam_search
+from joeynmt.search import beam_search, _stable_descending_order
 from joeynmt.decoders import RecurrentDecoder, TransformerDecoder
 from joeynmt.encoders import RecurrentEncoder
 from joeynmt.embeddings import Embeddings
@@ -29,6 +29,100 @@ class TestSearch(TensorTestCase):
         self.pad_index = 1
         self.eos_index = 3
 
+    def _test_greedy_finished(self, greedy_fun, eos_index,
+                              encoder_scale=1., batch_size=8,
+                              max_output_length=10):
+        # finished sentences are not decoded any further, the others
+        # get the same outputs as when they are decoded alone
+        # (`eos_index` is a token that only some of the sentences produce)
+        src_mask, embed, decoder, encoder_output, encoder_hidden = \
+            self._build(batch_size=batch_size)
+        encoder_output = encoder_output * encoder_scale
+        output, attention_scores = greedy_fun(
+            src_mask=src_mask, embed=embed, bos_index=self.bos_index,
+            eos_index=eos_index, max_output_length=max_output_length,
+            decoder=decoder, encoder_output=encoder_output,
+            encoder_hidden=encoder_hidden)
+        lengths = []
+        for i in range(batch_size):
+            single_output, single_attention_scores = greedy_fun(
+                src_mask=src_mask[i:i+1], embed=embed,
+                bos_index=self.bos_index, eos_index=eos_index,
+                max_output_length=max_output_length, decoder=decoder,
+                encoder_output=encoder_output[i:i+1],
+                encoder_hidden=encoder_hidden[i:i+1]
+                if encoder_hidden is not None else None)
+            length = single_output.shape[1]
+            lengths.append(length)
+            np.testing.assert_equal(output[i, :length], single_output[0])
+            # after </s>, only </s> is filled in
+            np.testing.assert_equal(output[i, length:], eos_index)
+            if attention_scores is not None:
+                np.testing.assert_array_almost_equal(
+                    attention_scores[i, :length], single_attention_scores[0])
+                np.testing.assert_equal(attention_scores[i, length:], 0)
+        self.assertEqual(output.shape[1], max(lengths))
+        self.assertLess(min(lengths), max(lengths))
+
+    def _test_beam_finished(self, eos_index, encoder_scale=1.,
+                            batch_size=8, beam_size=3, max_output_length=10):
+        # hypotheses that finish at different steps are padded, and are the
+        # same as when the sentences are decoded alone
+        src_mask, embed, decoder, encoder_output, encoder_hidden = \
+            self._build(batch_size=batch_size)
+        encoder_output = encoder_output * encoder_scale
+        output, _ = beam_search(
+            size=beam_size, eos_index=eos_index, pad_index=self.pad_index,
+            src_mask=src_mask, embed=embed, bos_index=self.bos_index,
+            max_output_length=max_output_length, decoder=decoder, alpha=1.,
+            encoder_output=encoder_output, encoder_hidden=encoder_hidden)
+        lengths = []
+        for i in range(batch_size):
+            single_output, _ = beam_search(
+                size=beam_size, eos_index=eos_index, pad_index=self.pad_index,
+                src_mask=src_mask[i:i+1], embed=embed,
+                bos_index=self.bos_index, max_output_length=max_output_length,
+                decoder=decoder, alpha=1.,
+                encoder_output=encoder_output[i:i+1],
+                encoder_hidden=encoder_hidden[i:i+1]
+                if encoder_hidden is not None else None)
+            length = single_output.shape[1]
+            lengths.append(length)
+            np.testing.assert_equal(output[i, :length], single_output[0])
+            np.testing.assert_equal(output[i, length:], self.pad_index)
+        self.assertEqual(output.shape[1], max(lengths))
+        self.assertLess(min(lengths), max(lengths))
+
+    def _test_beam_early_stopping(self, eos_index, batch_size=8,
+                                  beam_size=5, max_output_length=10):
+        # early stopping doesn't change the results, but decodes fewer rows
+        src_mask, embed, decoder, encoder_output, encoder_hidden = \
+            self._build(batch_size=batch_size)
+        decoded_rows = []
+        forward = decoder.forward
+
+        def counting_forward(*args, **kwargs):
+            decoded_rows[-1] += kwargs["trg_embed"].size(0)
+            return forward(*args, **kwargs)
+
+        decoder.forward = counting_forward
+        for alpha in [-1., 0., 1.]:
+            outputs = []
+            for early_stopping in [False, True]:
+                decoded_rows.append(0)
+                output, _ = beam_search(
+                    size=beam_size, eos_index=eos_index,
+                    pad_index=self.pad_index, src_mask=src_mask, embed=embed,
+                    bos_index=self.bos_index,
+                    max_output_length=max_output_length, decoder=decoder,
+                    alpha=alpha, encoder_output=encoder_output,
+                    encoder_hidden=encoder_hidden,
+                    early_stopping=early_stopping)
+                outputs.append(output)
+            np.testing.assert_equal(outputs[1], outputs[0])
+            self.assertLess(decoded_rows[-1], decoded_rows[-2])
+
+
 class TestSearchTransformer(TestSearch):
 
     def _build(self, batch_size):
@@ -71,6 +165,10 @@ class TestSearchTransformer(TestSearch):
         self.assertEqual(output.shape, (batch_size, max_output_length))
         np.testing.assert_equal(output, [[5, 5, 5], [5, 5, 5]])
 
+    def test_transformer_greedy_finished(self):
+        self._test_greedy_finished(transformer_greedy, eos_index=4,
+                                   encoder_scale=20.)
+
     def test_transformer_beam1(self):
         batch_size = 2
         beam_size = 1
@@ -97,6 +195,12 @@ class TestSearchTransformer(TestSearch):
             encoder_output=encoder_output, encoder_hidden=encoder_hidden)
         np.testing.assert_equal(output, greedy_output)
 
+    def test_transformer_beam_finished(self):
+        self._test_beam_finished(eos_index=6)
+
+    def test_transformer_beam_early_stopping(self):
+        self._test_beam_early_stopping(eos_index=6)
+
     def test_transformer_beam7(self):
         batch_size = 2
         beam_size = 7
@@ -177,6 +281,9 @@ class TestSearchRecurrent(TestSearch):
         self.assertEqual(attention_scores.shape, (batch_size, max_output_length,
                                                   4))
 
+    def test_recurrent_greedy_finished(self):
+        self._test_greedy_finished(recurrent_greedy, eos_index=0)
+
     def test_recurrent_beam1(self):
         # beam=1 and greedy should return the same result
         batch_size = 2
@@ -199,6 +306,12 @@ class TestSearchRecurrent(TestSearch):
             encoder_output=encoder_output, encoder_hidden=encoder_hidden)
         np.testing.assert_array_equal(greedy_output, output)
 
+    def test_recurrent_beam_finished(self):
+        self._test_beam_finished(eos_index=0)
+
+    def test_recurrent_beam_early_stopping(self):
+        self._test_beam_early_stopping(eos_index=0)
+
     def test_recurrent_beam7(self):
         batch_size = 2
         max_output_length = 3
@@ -215,3 +328,17 @@ class TestSearchRecurrent(TestSearch):
 
         self.assertEqual(output.shape, (2, 1))
         np.testing.assert_array_equal(output, [[3], [3]])
+
+
+class TestStableOrder(TensorTestCase):
+
+    def test_stable_descending_order(self):
+        inf = float("inf")
+        scores = torch.tensor([[-1.0, -inf, -0.5, -1.0, -inf, -0.5],
+                               [0.0, 0.0, 0.0, -inf, -inf, -inf]])
+        order = _stable_descending_order(scores)
+        # equal scores keep their order
+        self.assertTensorEqual(order, torch.tensor([[2, 5, 0, 3, 1, 4],
+                                                    [0, 1, 2, 3, 4, 5]]))
+        self.assertTensorEqual(scores.gather(1, order),
+                               scores.sort(dim=1, descending=True)[0])
@@ -0,0 +1,93 @@
+import json
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from joeynmt.server import MicroBatcher, TranslationServer
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def translate(sentences):
+            self.calls.append(list(sentences))
+            if "fail" in sentences:
+                raise ValueError("failed")
+            return [sentence.upper() for sentence in sentences]
+        self.translate = translate
+
+    def test_batching(self):
+        batcher = MicroBatcher(self.translate, max_wait=0.5, max_tokens=100)
+        futures = [batcher.submit(["a b", "c"]), batcher.submit([]),
+                   batcher.submit(["d"])]
+        self.assertEqual([future.result() for future in futures],
+                         [["A B", "C"], [], ["D"]])
+        # concurrent requests are translated together
+        self.assertEqual(self.calls, [["a b", "c", "d"]])
+        batcher.stop()
+        self.assertFalse(batcher.thread.is_alive())
+
+    def test_token_budget(self):
+        batcher = MicroBatcher(self.translate, max_wait=10, max_tokens=3)
+        futures = [batcher.submit(["a b"]), batcher.submit(["c d"]),
+                   batcher.submit(["e"])]
+        self.assertEqual(futures[1].result(), ["C D"])
+        # pending requests are translated when stopping
+        batcher.stop()
+        self.assertEqual(futures[2].result(), ["E"])
+        self.assertEqual(self.calls, [["a b", "c d"], ["e"]])
+        # later requests fail instead of waiting forever
+        with self.assertRaises(RuntimeError):
+            batcher.translate(["f"])
+        self.assertEqual(len(self.calls), 2)
+        batcher.stop()
+
+    def test_error(self):
+        batcher = MicroBatcher(self.translate, max_wait=0.5)
+        futures = [batcher.submit(["a"]), batcher.submit(["fail"])]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result()
+        # the batcher keeps working
+        self.assertEqual(batcher.translate(["b"]), ["B"])
+        batcher.stop()
+
+
+class TestTranslationServer(unittest.TestCase):
+
+    def setUp(self):
+        self.batcher = MicroBatcher(
+            lambda sentences: [s[::-1] for s in sentences], max_wait=0.01)
+        self.server = TranslationServer(("127.0.0.1", 0), self.batcher)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.batcher.stop()
+
+    def _post(self, path, content):
+        with urlopen(self.url + path,
+                     data=json.dumps(content).encode("utf-8")) as response:
+            return response.status, json.loads(response.read())
+
+    def test_translate(self):
+        status, content = self._post("/translate",
+                                     {"sentences": ["abc", "dé"]})
+        self.assertEqual(status, 200)
+        self.assertEqual(content, {"translations": ["cba", "éd"]})
+
+    def test_invalid_request(self):
+        for path, content, status in [("/translate", {"text": "abc"}, 400),
+                                      ("/translate", {"sentences": "a"}, 400),
+                                      ("/other", {"sentences": []}, 404)]:
+            with self.assertRaises(HTTPError) as context:
+                self._post(path, content)
+            self.assertEqual(context.exception.code, status)
+            context.exception.close()
@@ -0,0 +1,250 @@
+import itertools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from joeynmt import training
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.helpers import copy_to_cpu, load_checkpoint
+from joeynmt.model import build_model
+from joeynmt.prefetch import PrefetchIterator
+from joeynmt.training import TrainManager
+
+
+class TestTrainManager(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(42)
+        self.model_dir = os.path.join(tempfile.mkdtemp(), "model")
+        layer = {"type": "transformer", "hidden_size": 32,
+                 "embeddings": {"embedding_dim": 32}, "num_layers": 1,
+                 "num_heads": 4, "ff_size": 64}
+        self.config = {
+            "data": {"src": "de", "trg": "en",
+                     "train": "test/data/toy/train",
+                     "dev": "test/data/toy/dev", "level": "word",
+                     "lowercase": False, "max_sent_length": 10},
+            "model": {"encoder": layer, "decoder": dict(layer)},
+            "training": {"model_dir": self.model_dir, "overwrite": True,
+                         "epochs": 1,
+                         "batch_size": 10, "use_cuda": False,
+                         "optimizer": "adam", "learning_rate": 0.001,
+                         "early_stopping_metric": "loss",
+                         "max_output_length": 10, "print_valid_sents": [0]}}
+        self.train_data, self.dev_data, _, self.src_vocab, self.trg_vocab = \
+            load_data(self.config["data"])
+
+    def _trainer(self, **train_config) -> TrainManager:
+        config = dict(self.config,
+                      training=dict(self.config["training"], **train_config))
+        model = build_model(config["model"], src_vocab=self.src_vocab,
+                            trg_vocab=self.trg_vocab)
+        return TrainManager(model=model, config=config)
+
+    def _batches(self, trainer: TrainManager, n_batches: int,
+                 batch_size: int = 10) -> list:
+        data_iter = make_data_iter(self.train_data, batch_size=batch_size,
+                                   train=True, shuffle=False)
+        return list(itertools.islice(
+            PrefetchIterator(data_iter, pad_index=trainer.pad_index),
+            n_batches))
+
+    @staticmethod
+    def _gradients(model) -> dict:
+        return {name: param.grad.clone()
+                for name, param in model.named_parameters()
+                if param.grad is not None}
+
+    def _big_batch_gradients(self, trainer: TrainManager, n_batches: int,
+                             normalization: str) -> dict:
+        """
+        Gradients of a single backward pass over `n_batches` batches.
+        """
+        micro_batches = self._batches(trainer, n_batches)
+        # the same examples as the micro-batches together
+        big_batch, = self._batches(trainer, 1, batch_size=10 * n_batches)
+        self.assertEqual(big_batch.nseqs, 10 * n_batches)
+        model = trainer.model
+        model.zero_grad()
+        if normalization == "tokens":
+            # the token-normalized losses of the batches are averaged
+            loss = sum(model.get_loss_for_batch(batch, trainer.loss)
+                       / batch.ntokens for batch in micro_batches) / n_batches
+        else:
+            loss = model.get_loss_for_batch(big_batch, trainer.loss)
+            if normalization == "batch":
+                loss = loss / big_batch.nseqs
+        loss.backward()
+        gradients = self._gradients(model)
+        model.zero_grad()
+        return gradients
+
+    def _assert_state_equal(self, state, expected):
+        if isinstance(expected, torch.Tensor):
+            self.assertTrue(torch.equal(state, expected))
+        elif isinstance(expected, dict):
+            self.assertEqual(state.keys(), expected.keys())
+            for key in expected:
+                self._assert_state_equal(state[key], expected[key])
+        elif isinstance(expected, (list, tuple)):
+            self.assertEqual(len(state), len(expected))
+            for value, expected_value in zip(state, expected):
+                self._assert_state_equal(value, expected_value)
+        else:
+            self.assertEqual(state, expected)
+
+    def test_async_validation(self):
+        trainer = self._trainer(async_validation=True, validation_workers=2,
+                                max_pending_validations=3)
+        trainer._start_validation_worker()
+        snapshots = {}
+        try:
+            batches = self._batches(trainer, 4)
+            for batch in batches[:3]:
+                trainer._train_batch(batch)
+                snapshots[trainer.steps] = copy_to_cpu(
+                    trainer._training_state())
+                trainer._request_validation(self.dev_data, epoch_no=0)
+            # training continues while the snapshots are validated
+            trainer._train_batch(batches[3])
+            trainer._collect_validation_results(self.dev_data, wait=True)
+        finally:
+            trainer._stop_validation_worker()
+        self.assertEqual(trainer.steps, 4)
+
+        # results are processed in the order of the requests
+        with open(trainer.valid_report_file) as opened_file:
+            steps = [int(line.split("\t")[0].split()[1])
+                     for line in opened_file]
+        self.assertEqual(steps, [1, 2, 3])
+
+        # the first validation is a new best, its checkpoint holds the
+        # training state of the validated step, not of the current one
+        checkpoint = load_checkpoint(
+            os.path.join(self.model_dir, "1.ckpt"), use_cuda=False)
+        self.assertEqual(checkpoint["best_ckpt_iteration"], 1)
+        for key in ["steps", "total_tokens", "model_state",
+                    "optimizer_state"]:
+            self._assert_state_equal(checkpoint[key], snapshots[1][key])
+        self.assertNotEqual(checkpoint["total_tokens"], trainer.total_tokens)
+
+    def test_async_checkpoint(self):
+        trainer = self._trainer(async_checkpoint=True, keep_last_ckpts=2)
+        snapshots = {}
+        for batch in self._batches(trainer, 3):
+            trainer._train_batch(batch)
+            snapshots[trainer.steps] = copy_to_cpu(trainer._training_state())
+            trainer._save_checkpoint()
+            # training modifies the parameters while the checkpoint is
+            # written in the background
+            with torch.no_grad():
+                for param in trainer.model.parameters():
+                    param.add_(1.)
+        trainer._wait_for_checkpoint()
+
+        # only the last keep_last_ckpts checkpoints are kept
+        self.assertEqual(list(trainer.ckpt_queue.queue),
+                         ["{}/{}.ckpt".format(self.model_dir, steps)
+                          for steps in [2, 3]])
+        self.assertEqual(sorted(name for name in os.listdir(self.model_dir)
+                                if ".ckpt" in name),
+                         ["2.ckpt", "3.ckpt", "best.ckpt"])
+        # best.ckpt points to the last written checkpoint
+        self.assertEqual(
+            os.readlink(os.path.join(self.model_dir, "best.ckpt")), "3.ckpt")
+
+        # the files hold the state at the time of _save_checkpoint
+        for steps in [2, 3]:
+            checkpoint = load_checkpoint(
+                os.path.join(self.model_dir, "{}.ckpt".format(steps)),
+                use_cuda=False)
+            for key in ["steps", "total_tokens", "model_state",
+                        "optimizer_state"]:
+                self._assert_state_equal(checkpoint[key],
+                                         snapshots[steps][key])
+
+    def test_gradient_accumulation(self):
+        for normalization in ["batch", "tokens", "none"]:
+            trainer = self._trainer(batch_multiplier=3,
+                                    normalization=normalization)
+            # no dropout, so that all forward passes are the same
+            trainer.model.eval()
+            # keep the parameters and record the gradients of every update
+            updates = []
+            trainer.optimizer.step = lambda: updates.append(
+                self._gradients(trainer.model))
+            batches = self._batches(trainer, 3)
+
+            # backward per batch, update after batch_multiplier batches
+            for count, batch in zip([2, 1, 0], batches):
+                trainer._train_batch(batch, update=count == 0, count=count)
+            # leftover batches at the end of an epoch, when their number is
+            # known in advance
+            trainer.current_batch_multiplier = 2
+            for count, batch in zip([1, 0], batches[:2]):
+                trainer._train_batch(batch, update=count == 0, count=count)
+            # and when it isn't: update after the last batch
+            trainer.current_batch_multiplier = 3
+            for count, batch in zip([2, 1], batches[:2]):
+                trainer._train_batch(batch, update=count == 1, count=count)
+
+            self.assertEqual(len(updates), 3)
+            self.assertEqual(trainer.steps, 3)
+            expected = [
+                self._big_batch_gradients(trainer, 3, normalization),
+                self._big_batch_gradients(trainer, 2, normalization),
+                self._big_batch_gradients(trainer, 2, normalization)]
+            for gradients, expected_gradients in zip(updates, expected):
+                self.assertEqual(gradients.keys(), expected_gradients.keys())
+                for name, grad in gradients.items():
+                    self.assertTrue(torch.allclose(
+                        grad, expected_gradients[name], rtol=1e-4,
+                        atol=1e-6), name)
+
+    def test_gradient_accumulation_token_batches(self):
+        # shuffled token batches are planned anew every epoch, with a
+        # different number of batches
+        np.random.seed(42)
+        trainer = self._trainer(epochs=3, batch_type="token", batch_size=100,
+                                shuffle=True, batch_multiplier=4,
+                                validation_freq=1000, logging_freq=1000)
+        calls = []
+        train_batch = trainer._train_batch
+
+        def record_batch(batch, update=True, count=1):
+            calls.append((count, update, trainer.current_batch_multiplier))
+            return train_batch(batch, update=update, count=count)
+
+        trainer._train_batch = record_batch
+        trainer._rescale_leftover = mock.Mock()
+        # number of batches of every epoch, known before the epoch
+        epochs = []
+        num_batches = training._num_batches
+
+        def record_epoch(data_iter):
+            epochs.append((len(calls), num_batches(data_iter)))
+            return epochs[-1][1]
+
+        with mock.patch("joeynmt.training._num_batches", record_epoch):
+            trainer.train_and_validate(self.train_data, self.dev_data)
+
+        self.assertEqual(len(epochs), 3)
+        starts = [start for start, _ in epochs] + [len(calls)]
+        for (start, n_batches), end in zip(epochs, starts[1:]):
+            self.assertEqual(end - start, n_batches)
+        # every update accumulates exactly current_batch_multiplier batches,
+        # also the leftover batches at the end of an epoch
+        self.assertFalse(trainer._rescale_leftover.called)
+        group = []
+        for count, update, multiplier in calls:
+            group.append(count)
+            if update:
+                self.assertEqual(group, list(range(multiplier - 1, -1, -1)))
+                group = []
+        self.assertEqual(group, [])
+        self.assertEqual(trainer.steps,
+                         sum(1 for _, update, _ in calls if update))
@@ -141,3 +141,56 @@ class TestTransformerDecoder(TensorTestCase):
                 layer.feed_forward.pwff_layer[0].in_features, self.hidden_size)
             self.assertEqual(
                 layer.feed_forward.pwff_layer[0].out_features, self.ff_size)
+
+    def test_transformer_decoder_incremental(self):
+        batch_size = 2
+        src_time_dim = 4
+        trg_time_dim = 5
+        vocab_size = 7
+
+        trg_embed = torch.rand(size=(batch_size, trg_time_dim, self.emb_size))
+
+        decoder = TransformerDecoder(
+            num_layers=self.num_layers, num_heads=self.num_heads,
+            hidden_size=self.hidden_size, ff_size=self.ff_size,
+            dropout=self.dropout, emb_dropout=self.dropout,
+            vocab_size=vocab_size)
+
+        encoder_output = torch.rand(
+            size=(batch_size, src_time_dim, self.hidden_size))
+
+        for p in decoder.parameters():
+            torch.nn.init.uniform_(p, -0.5, 0.5)
+
+        src_mask = torch.ones(size=(batch_size, 1, src_time_dim)) == 1
+        trg_mask = torch.ones(size=(1, 1, 1)) == 1
+
+        # decode the full sequence at once
+        full_output, _, _, _ = decoder(
+            trg_embed=trg_embed, encoder_output=encoder_output,
+            src_mask=src_mask, trg_mask=trg_mask)
+
+        # decode one step at a time with cached keys and values,
+        # with and without pre-computed encoder projections
+        for memory in [None, encoder_output]:
+            cache = decoder.init_cache(encoder_output=memory)
+            step_outputs = []
+            for t in range(trg_time_dim):
+                step_output, _, _, _ = decoder(
+                    trg_embed=trg_embed[:, t:t+1],
+                    encoder_output=encoder_output,
+                    src_mask=src_mask, trg_mask=trg_mask, cache=cache)
+                step_outputs.append(step_output)
+            incremental_output = torch.cat(step_outputs, dim=1)
+
+            self.assertEqual(full_output.shape, incremental_output.shape)
+            self.assertTensorAlmostEqual(full_output, incremental_output)
+            head_size = self.hidden_size // self.num_heads
+            for layer_cache in cache:
+                self.assertEqual(layer_cache["keys"].shape,
+                                 (batch_size, self.num_heads, trg_time_dim,
+                                  head_size))
+                if memory is not None:
+                    self.assertEqual(layer_cache["memory_keys"].shape,
+                                     (batch_size, self.num_heads,
+                                      src_time_dim, head_size))
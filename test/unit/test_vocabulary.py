@@ -1,5 +1,8 @@
 import unittest
 import os
+import pickle
+
+import numpy as np
 
 from joeynmt.vocabulary import Vocabulary
 
@@ -51,3 +54,61 @@ class TestVocabulary(unittest.TestCase):
         self.assertFalse(self.word_vocab.is_unk("Die"))
         self.assertTrue(self.char_vocab.is_unk("x"))
         self.assertFalse(self.char_vocab.is_unk("d"))
+
+    def testAddTokens(self):
+        # unknown tokens that were looked up before can still be added
+        self.assertTrue(self.word_vocab.is_unk("BLA"))
+        size = len(self.word_vocab)
+        self.word_vocab.add_tokens(["BLA", "Die", "BLA"])
+        self.assertEqual(len(self.word_vocab), size + 1)
+        self.assertEqual(self.word_vocab.itos[-1], "BLA")
+        self.assertEqual(self.word_vocab.stoi["BLA"], size)
+        self.assertFalse(self.word_vocab.is_unk("BLA"))
+
+    def testArraysToSentences(self):
+        eos = self.word_vocab.stoi["</s>"]
+        arrays = np.array([[4, 5, eos, 6],
+                           [7, 8, 9, 10],
+                           [eos, 4, eos, 5]])
+        self.assertEqual(self.word_vocab.arrays_to_sentences(arrays),
+                         [["Die", "Geschichte"],
+                          ["Meer", "Titanic", "Wahrheit", "alle"],
+                          []])
+        self.assertEqual(
+            self.word_vocab.arrays_to_sentences(arrays, cut_at_eos=False)[2],
+            ["</s>", "Die", "</s>", "Geschichte"])
+        self.assertEqual(self.word_vocab.array_to_sentence(arrays[0]),
+                         ["Die", "Geschichte"])
+
+        # arrays of different lengths
+        ragged = [np.array([4]), np.array([], dtype=int), np.array([5, eos]),
+                  np.array([6, 7, 8])]
+        self.assertEqual(self.word_vocab.arrays_to_sentences(ragged),
+                         [["Die"], [], ["Geschichte"],
+                          ["Kinokassenrekorde", "Meer", "Titanic"]])
+
+    def testFrozen(self):
+        vocab = Vocabulary(tokens=sorted(set(self.word_list)), frozen=True)
+        self.assertTrue(vocab.frozen)
+        self.assertFalse(self.word_vocab.frozen)
+        self.assertEqual(vocab.itos, self.word_vocab.itos)
+        self.assertEqual(dict(vocab.stoi), dict(self.word_vocab.stoi))
+
+        # unknown tokens map to UNK without growing the vocabulary
+        size = len(vocab.stoi)
+        self.assertTrue(vocab.is_unk("BLA"))
+        self.assertEqual(vocab.stoi["BLA"], vocab.stoi["<unk>"])
+        self.assertNotIn("BLA", vocab.stoi)
+        self.assertEqual(len(vocab.stoi), size)
+
+        with self.assertRaises(TypeError):
+            vocab.add_tokens(["BLA"])
+        with self.assertRaises(TypeError):
+            vocab.stoi["BLA"] = 1
+        self.assertEqual(len(vocab), size)
+
+        # frozen vocabularies can be copied
+        copied = pickle.loads(pickle.dumps(vocab))
+        self.assertTrue(copied.frozen)
+        self.assertEqual(copied.stoi["Die"], vocab.stoi["Die"])
+        self.assertEqual(copied.stoi["BLA"], vocab.stoi["<unk>"])